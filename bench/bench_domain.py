@@ -0,0 +1,546 @@
+"""
+Benchmark suite for Domain operations on synthetic domains
+
+    python bench/bench_domain.py [--sizes 1000,10000,100000,1000000] [--fanout 16] [--depth levels] [--ipv6]
+                                 [--ops 1000] [--repeat 3] [--seed 1] [--only group,...] [--processes N]
+                                 [--redis host:port | --no-redis] [-o results.json]
+    python bench/bench_domain.py --compare base.json new.json [--threshold 0.1]
+
+Every size runs in a process of its own, so the peak resident memory reported is that of one size only.
+Per call latencies give the percentiles of each benchmark, throughput is counted in operations, or in the
+nodes or addresses handled per second for calls working on the whole domain or on batches.
+Redis benchmarks run against a throwaway redis-server without persistence started on a free port, unless
+--redis points at a server to use instead, and are skipped when neither is available.
+"""
+import argparse
+import datetime
+import distutils.spawn
+import gc
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import traceback
+
+import redis
+
+try:
+    from ipam import domain
+except ImportError:
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+    from ipam import domain
+from ipam.domain import Domain
+from ipam.hosts import MAX_HOSTS
+from ipam.iputil import network_prefix, address_string, block_size
+
+from generate import generate_domain, generate_records, random_addresses
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# (group name, Domain methods covered, needs redis, generator function) in the order they run
+BENCHMARKS = []
+
+def benchmark(*methods, **kwargs):
+    """
+    Register a generator function yielding measure results as a benchmark group covering Domain methods
+    """
+    def register(func):
+        BENCHMARKS.append((func.__name__, methods, kwargs.get("redis", False), func))
+        return func
+    return register
+
+def timed(func, items):
+    """
+    Return list of the seconds taken by func(item) for every item of items
+    """
+    timer = timeit.default_timer
+    ret = []
+    for item in items:
+        start = timer()
+        func(item)
+        ret.append(timer() - start)
+    return ret
+
+def percentile(ordered, p):
+    """
+    Return the nearest rank p-th percentile of sorted list ordered
+    """
+    return ordered[max(0, int(math.ceil(p / 100.0 * len(ordered))) - 1)]
+
+def measure(name, latencies, per_op=1, unit="ops"):
+    """
+    Return (name, summary dict) of latencies, per_op being the number of units each call handles
+    """
+    ordered = sorted(latencies)
+    total = sum(ordered)
+    return name, {
+        "ops": len(ordered),
+        "total": total,
+        "mean": total / len(ordered),
+        "p50": percentile(ordered, 50),
+        "p90": percentile(ordered, 90),
+        "p99": percentile(ordered, 99),
+        "max": ordered[-1],
+        "throughput": per_op * len(ordered) / total if total else None,
+        "unit": unit,
+    }
+
+def maxrss():
+    """
+    Return peak resident memory of this process in KB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class Run:
+    """
+    Domain of one size and the settings shared by its benchmarks
+    """
+    def __init__(self, dom, args, network, db=None):
+        self.dom = dom
+        self.args = args
+        self.network = network
+        self.db = db
+        self.rng = random.Random(args.seed)
+        self.size = sum(1 for _ in dom.root.iterdescendants())
+
+    def nodes(self, count, tag=None, parents=False):
+        """
+        Return count nodes drawn with replacement, of node type tag if set, only nodes with children if parents
+        """
+        nodes = [n for n in self.dom.root.iterdescendants()
+                if (tag is None or n.tag == tag) and (not parents or len(n))]
+        return [self.rng.choice(nodes) for _ in xrange(count)] if nodes else []
+
+    def leaves(self, count):
+        """
+        Return up to count distinct nodes of the last node type
+        """
+        leaves = [n for n in self.dom.root.iter(self.dom.groups[-1])]
+        return self.rng.sample(leaves, min(count, len(leaves)))
+
+    def addresses(self, count):
+        return random_addresses(self.rng, self.network, count)
+
+    def repeat(self):
+        return xrange(self.args.repeat)
+
+    def batches(self, size):
+        """
+        Return lists of size addresses, enough of them for ops lookups and at least one
+        """
+        return [self.addresses(size) for _ in xrange(max(1, self.args.ops // 100))]
+
+@benchmark("to_store")
+def indexes(run):
+    dom = run.dom
+    def trie(_):
+        dom._trie = None
+        dom._network_trie()
+    def node_index(_):
+        dom._nodes = None
+        dom._node_index()
+    def range_table(_):
+        dom._ranges = None
+        dom._range_table()
+    yield measure("build_trie", timed(trie, run.repeat()), run.size, "nodes")
+    yield measure("build_node_index", timed(node_index, run.repeat()), run.size, "nodes")
+    if not run.args.ipv6:
+        yield measure("build_range_table", timed(range_table, run.repeat()), run.size, "nodes")
+    yield measure("to_store", timed(lambda _: dom.to_store(), run.repeat()), run.size, "nodes")
+
+@benchmark("validate", "violations")
+def validation(run):
+    dom = run.dom
+    yield measure("validate", timed(lambda _: dom.validate(), run.repeat()), run.size, "nodes")
+    yield measure("violations", timed(lambda _: dom.violations(), run.repeat()), run.size, "nodes")
+    if run.args.processes:
+        pool = multiprocessing.Pool(run.args.processes)
+        try:
+            yield measure("validate_parallel", timed(lambda _: dom.validate(processes=pool), run.repeat()),
+                    run.size, "nodes")
+            yield measure("free_space_parallel", timed(lambda _: dom.free_space(processes=pool), run.repeat()),
+                    run.size, "nodes")
+        finally:
+            pool.close()
+            pool.join()
+
+@benchmark("get_node")
+def get_node(run):
+    dom = run.dom
+    dom._node_index()
+    nodes = run.nodes(run.args.ops)
+    yield measure("get_node_name", timed(lambda n: dom.get_node(node_type=n.tag, name=n.get("name")), nodes))
+    yield measure("get_node_network", timed(lambda n: dom.get_node(network=n.get("network")), nodes))
+    yield measure("get_node_type", timed(lambda n: dom.get_node(node_type=n.tag), nodes[:run.args.repeat]))
+
+@benchmark("lookup", "lookup_many", "resolve_many", "get_node_ids")
+def lookups(run):
+    dom = run.dom
+    dom._network_trie()
+    yield measure("lookup", timed(dom.lookup, run.addresses(run.args.ops)))
+    yield measure("_search_network", timed(lambda ip: dom._search_network(ip, dom.root),
+            run.addresses(run.args.ops)))
+    yield measure("lookup_many", timed(dom.lookup_many, run.batches(1000)), 1000, "addresses")
+    if not run.args.ipv6:
+        # the range table holds IPv4 networks only
+        dom._range_table()
+        yield measure("resolve_many", timed(dom.resolve_many, run.batches(10000)), 10000, "addresses")
+        yield measure("get_node_ids", timed(lambda _: dom.get_node_ids(), xrange(run.args.ops)))
+
+@benchmark("get_path", "find_path")
+def paths(run):
+    dom = run.dom
+    nodes = run.nodes(run.args.ops)
+    yield measure("get_path", timed(dom.get_path, nodes))
+    paths = [dom.get_path(n) for n in nodes]
+    # sibling indexes are built on first use
+    map(dom.find_path, paths)
+    yield measure("find_path", timed(dom.find_path, paths))
+
+@benchmark("get_available_networks", "iter_available_networks", "free_space")
+def free(run):
+    dom = run.dom
+    parents = run.nodes(run.args.ops, parents=True)
+    plen = network_prefix(dom.root.iter(dom.groups[-1]).next().get("network"))[1]
+    yield measure("get_available_networks", timed(lambda n: dom.get_available_networks(n, plen), parents))
+    yield measure("iter_available_networks", timed(lambda n: list(dom.iter_available_networks(n)), parents))
+    yield measure("free_space", timed(lambda _: dom.free_space(), run.repeat()), run.size, "nodes")
+
+@benchmark("utilization_report")
+def utilization(run):
+    dom = run.dom
+    yield measure("utilization_report", timed(lambda _: dom.utilization_report(), run.repeat()), run.size, "nodes")
+    dom.utilization_report(incremental=True)
+    def changed(n):
+        # an unchanged network still marks the node and its parent for recomputation
+        dom.set_node(n, network=n.get("network"))
+        start = timeit.default_timer()
+        dom.utilization_report(incremental=True)
+        return timeit.default_timer() - start
+    yield measure("utilization_report_incremental", [changed(n) for n in run.leaves(run.args.ops)])
+
+@benchmark("set_node", "remove_node", "add_node", "allocate")
+def changes(run):
+    dom = run.dom
+    leaves = run.leaves(run.args.ops)
+    def rename(n):
+        start = timeit.default_timer()
+        dom.set_node(n, name=n.get("name") + "x")
+        ret = timeit.default_timer() - start
+        dom.set_node(n, name=n.get("name")[:-1])
+        return ret
+    yield measure("set_node_name", [rename(n) for n in leaves])
+    yield measure("set_node_network", timed(lambda n: dom.set_node(n, network=n.get("network")), leaves))
+
+    # leaves are removed, added back, removed again and allocated back under the same parents
+    leaves = run.leaves(min(run.args.ops, run.size // 4))
+    records = [(n.getparent(), n.tag, n.get("name"), n.get("network")) for n in leaves]
+    yield measure("remove_node", timed(lambda n: dom.remove_node(n, force=True), leaves))
+    added = []
+    yield measure("add_node", timed(lambda r: added.append(dom.add_node(node_type=r[1], parent=r[0], name=r[2],
+            network=r[3])), records))
+    for n in added:
+        dom.remove_node(n, force=True)
+    yield measure("allocate", timed(lambda r: dom.allocate(r[0], network_prefix(r[3])[1], r[2]), records))
+
+@benchmark("bulk_add")
+def bulk(run):
+    records, groups = generate_records(run.size, run.args.fanout, run.args.depth, run.network)
+    def build(_):
+        Domain(domain="Bulk", groups=groups).bulk_add(records)
+    yield measure("bulk_add", timed(build, run.repeat()), run.size, "nodes")
+
+@benchmark("allocate_hosts", "assign_hosts", "release_hosts", "host_counts", "host_ranges")
+def hosts(run):
+    dom = run.dom
+    leaves = run.leaves(run.args.ops)
+    address, prefixlen = network_prefix(leaves[0].get("network"))
+    if block_size(address, prefixlen) > MAX_HOSTS:
+        # leaves too large for host bitmaps, skipped
+        return
+    yield measure("allocate_hosts", timed(lambda n: dom.allocate_hosts(n, 2), leaves))
+    last = lambda n: address_string(sum(network_prefix(n.get("network"))[:1]) + dom.host_counts(n)["size"] - 2)
+    ends = [(n, last(n)) for n in leaves]
+    yield measure("assign_hosts", timed(lambda r: dom.assign_hosts(r[0], r[1]), ends))
+    yield measure("host_counts", timed(dom.host_counts, leaves))
+    yield measure("host_ranges", timed(dom.host_ranges, leaves))
+    yield measure("release_hosts", timed(lambda r: dom.release_hosts(r[0], r[1]), ends))
+
+@benchmark("xml", "iter_xml", "save")
+def xml(run):
+    dom = run.dom
+    yield measure("xml", timed(lambda _: dom.xml(), run.repeat()), run.size, "nodes")
+    yield measure("iter_xml", timed(lambda _: "".join(dom.iter_xml()), run.repeat()), run.size, "nodes")
+    raw = dom.xml()
+    yield measure("xml_parse", timed(lambda _: Domain(raw_xml=raw), run.repeat()), run.size, "nodes")
+    path = os.path.join(run.args.tmpdir, "bench.xml")
+    yield measure("save", timed(lambda _: dom.save(path), run.repeat()), run.size, "nodes")
+    yield measure("xml_file_load", timed(lambda _: Domain(xml_file=path), run.repeat()), run.size, "nodes")
+
+@benchmark("save_snapshot", "load_snapshot")
+def snapshots(run):
+    dom = run.dom
+    path = os.path.join(run.args.tmpdir, "bench.snap")
+    yield measure("save_snapshot", timed(lambda _: dom.save_snapshot(path), run.repeat()), run.size, "nodes")
+    yield measure("load_snapshot", timed(lambda _: Domain.load_snapshot(path), run.repeat()), run.size, "nodes")
+
+@benchmark("save_to_db", "load_hosts", redis=True)
+def redis_xml(run):
+    dom, db = run.dom, run.db
+    def save(_):
+        if not dom.save_to_db(db):
+            raise RuntimeError("save_to_db lost its compare-and-set")
+    yield measure("save_to_db", timed(save, run.repeat()), run.size, "nodes")
+    raw = db.get(domain.DOMAIN_KEY % dom.domain)
+    yield measure("db_xml_load", timed(lambda _: Domain(raw_xml=raw), run.repeat()), run.size, "nodes")
+    loaded = Domain(raw_xml=raw)
+    yield measure("load_hosts", timed(lambda _: loaded.load_hosts(db), run.repeat()))
+
+@benchmark("save_delta", redis=True)
+def redis_delta(run):
+    dom, db = run.dom, run.db
+    def save(full):
+        if not dom.save_delta(db, full=full):
+            raise RuntimeError("save_delta lost its compare-and-set")
+    yield measure("save_delta_full", timed(lambda _: save(True), run.repeat()), run.size, "nodes")
+    def changed(n):
+        dom.set_node(n, name=n.get("name") + "x")
+        start = timeit.default_timer()
+        save(False)
+        return timeit.default_timer() - start
+    yield measure("save_delta", [changed(n) for n in run.leaves(run.args.ops)])
+    yield measure("db_delta_load", timed(lambda _: Domain(domain=dom.domain, redisdb=db), run.repeat()),
+            run.size, "nodes")
+    paths = [dom.get_path(n) for n in run.leaves(run.args.ops)]
+    yield measure("db_subtree_load", timed(lambda p: Domain(domain=dom.domain, redisdb=db, subtree=p, depth=0),
+            paths))
+
+def public_methods():
+    """
+    Return set of the public methods of Domain, but for those shadowed by attributes of the same name
+    """
+    return set(k for k, v in vars(Domain).items()
+            if not k.startswith("_") and k not in ("version", "timestamp") and (callable(v) or isinstance(v, classmethod)))
+
+def covered_methods():
+    return set(m for _, methods, _, _ in BENCHMARKS for m in methods)
+
+def drop_keys(db, name):
+    db.delete(*[key % name for key in (domain.DOMAIN_KEY, domain.VERSION_KEY, domain.NODES_KEY, domain.META_KEY,
+            domain.SUBTREES_KEY, domain.PATHS_KEY, domain.HOSTS_KEY)])
+
+def run_size(nodes, args, redis_address):
+    """
+    Return result dict of the benchmarks of a domain of nodes nodes
+    """
+    network = args.network or (args.ipv6 and "2001:db8::/32" or "10.0.0.0/8")
+    name = "bench-%d-%d" % (os.getpid(), nodes)
+    start = timeit.default_timer()
+    dom = generate_domain(nodes, args.fanout, args.depth, network, name)
+    generated = timeit.default_timer() - start
+    db = None
+    if redis_address is not None:
+        db = redis.StrictRedis(*redis_address)
+        drop_keys(db, name)
+    run = Run(dom, args, network, db)
+    ret = {"nodes": run.size, "fanout": args.fanout, "depth": len(dom.groups) - 1, "network": network,
+            "generate": generated, "benchmarks": {}, "memory": {}, "skipped": [], "errors": {}}
+    print "%d nodes, fanout %d, depth %d, %s (generated in %.2fs)" % (run.size, args.fanout, ret["depth"],
+            network, generated)
+    try:
+        for group, _, needs_redis, func in BENCHMARKS:
+            if args.only and group not in args.only:
+                continue
+            if needs_redis and db is None:
+                ret["skipped"].append(group)
+                continue
+            gc.collect()
+            try:
+                found = False
+                for name, summary in func(run):
+                    ret["benchmarks"][name] = summary
+                    ret["memory"][name] = maxrss()
+                    print_summary(name, summary)
+                    found = True
+                if not found:
+                    ret["skipped"].append(group)
+            except Exception:
+                ret["errors"][group] = traceback.format_exc()
+                print "%s failed:\n%s" % (group, ret["errors"][group])
+    finally:
+        if db is not None:
+            drop_keys(db, dom.domain)
+    ret["maxrss_kb"] = maxrss()
+    print "peak memory: %.1f MB\n" % (ret["maxrss_kb"] / 1024.0)
+    return ret
+
+def _run_size(queue, nodes, args, redis_address):
+    try:
+        queue.put(run_size(nodes, args, redis_address))
+    except Exception:
+        queue.put({"nodes": nodes, "errors": {"generate": traceback.format_exc()}})
+
+def format_time(seconds):
+    if seconds is None:
+        return "-"
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return "%.3g%s" % (seconds / scale, unit)
+    return "%.3gus" % (seconds / 1e-6)
+
+def print_summary(name, summary):
+    print "  %-32s %7d ops  p50 %8s  p90 %8s  p99 %8s  %12.0f %s/s" % (name, summary["ops"],
+            format_time(summary["p50"]), format_time(summary["p90"]), format_time(summary["p99"]),
+            summary["throughput"] or 0, summary["unit"])
+
+def start_redis():
+    """
+    Start a redis-server without persistence on a free local port
+    Return (process, (host, port)), (None, None) if redis-server cannot be found or does not answer
+    """
+    path = distutils.spawn.find_executable("redis-server")
+    if path is None:
+        return None, None
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    with open(os.devnull, "w") as devnull:
+        proc = subprocess.Popen([path, "--bind", "127.0.0.1", "--port", str(port), "--save", "", "--appendonly", "no"],
+                stdout=devnull, stderr=devnull)
+    db = redis.StrictRedis("127.0.0.1", port)
+    for _ in xrange(100):
+        try:
+            db.ping()
+            return proc, ("127.0.0.1", port)
+        except redis.ConnectionError:
+            time.sleep(0.05)
+    proc.terminate()
+    return None, None
+
+def git(*args):
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(("git",) + args, cwd=REPO, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment(args, redis_address):
+    import lxml, numpy
+    status = git("status", "--porcelain", "--untracked-files=no")
+    return {
+        "commit": git("rev-parse", "HEAD"),
+        "dirty": bool(status) if status is not None else None,
+        "date": datetime.datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": multiprocessing.cpu_count(),
+        "lxml": lxml.__version__,
+        "numpy": numpy.__version__,
+        "redis": redis_address and "%s:%d" % redis_address,
+        "args": dict((k, v) for k, v in vars(args).items() if k not in ("tmpdir", "compare")),
+    }
+
+def compare(base, new, threshold=0.1):
+    """
+    Print p50 latency and throughput changes of the benchmarks found in both result files
+    Return number of benchmarks whose p50 latency grew by more than threshold
+    """
+    def load(path):
+        with open(path) as f:
+            results = json.load(f)
+        return results["meta"], dict((r["nodes"], r) for r in results["sizes"])
+    base_meta, base_sizes = load(base)
+    new_meta, new_sizes = load(new)
+    print "base %s (%s)\nnew  %s (%s)" % (base_meta.get("commit"), base, new_meta.get("commit"), new)
+    regressions = 0
+    for nodes in sorted(set(base_sizes) & set(new_sizes)):
+        old, cur = base_sizes[nodes], new_sizes[nodes]
+        print "\n%d nodes, peak memory %.1f MB -> %.1f MB" % (nodes, old.get("maxrss_kb", 0) / 1024.0,
+                cur.get("maxrss_kb", 0) / 1024.0)
+        for name in sorted(set(old.get("benchmarks", {})) & set(cur.get("benchmarks", {}))):
+            a, b = old["benchmarks"][name], cur["benchmarks"][name]
+            change = b["p50"] / a["p50"] - 1 if a["p50"] else 0.0
+            flag = ""
+            if change > threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            elif change < -threshold:
+                flag = "  improved"
+            print "  %-32s p50 %8s -> %8s %+7.1f%%  %12.0f -> %12.0f %s/s%s" % (name, format_time(a["p50"]),
+                    format_time(b["p50"]), change * 100, a["throughput"] or 0, b["throughput"] or 0, b["unit"], flag)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Domain operations on synthetic domains")
+    parser.add_argument("--sizes", default="1000,10000", help="comma separated numbers of nodes")
+    parser.add_argument("--fanout", type=int, default=16, help="children per node")
+    parser.add_argument("--depth", type=int, help="levels below the root, the fewest holding the nodes by default")
+    parser.add_argument("--network", help="network split among the nodes, 10.0.0.0/8 or 2001:db8::/32 by default")
+    parser.add_argument("--ipv6", action="store_true", help="generate IPv6 domains")
+    parser.add_argument("--ops", type=int, default=1000, help="calls timed by per node benchmarks")
+    parser.add_argument("--repeat", type=int, default=3, help="calls timed by whole domain benchmarks")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the random nodes and addresses")
+    parser.add_argument("--only", help="comma separated benchmark groups to run")
+    parser.add_argument("--processes", type=int, help="also time validation and free space with worker processes")
+    parser.add_argument("--redis", help="host:port of a redis server to use instead of a throwaway one")
+    parser.add_argument("--no-redis", action="store_true", help="skip the redis benchmarks")
+    parser.add_argument("-o", "--output", help="write results as json to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="compare two json result files")
+    parser.add_argument("--threshold", type=float, default=0.1, help="p50 growth reported as a regression")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return 1 if compare(args.compare[0], args.compare[1], args.threshold) else 0
+
+    groups = [g for g, _, _, _ in BENCHMARKS]
+    if args.only:
+        args.only = args.only.split(",")
+        unknown = set(args.only) - set(groups)
+        if unknown:
+            parser.error("unknown benchmark groups %s, choose from %s" % (", ".join(sorted(unknown)), ", ".join(groups)))
+    uncovered = sorted(public_methods() - covered_methods())
+    if uncovered:
+        print "not benchmarked: %s\n" % ", ".join(uncovered)
+
+    proc, redis_address = None, None
+    if args.redis:
+        host, _, port = args.redis.partition(":")
+        redis_address = (host or "localhost", int(port or 6379))
+    elif not args.no_redis:
+        proc, redis_address = start_redis()
+        if redis_address is None:
+            print "redis-server not found, skipping redis benchmarks\n"
+    args.tmpdir = tempfile.mkdtemp(prefix="bench")
+    sizes = []
+    try:
+        for nodes in [int(s) for s in args.sizes.split(",")]:
+            queue = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=_run_size, args=(queue, nodes, args, redis_address))
+            worker.start()
+            sizes.append(queue.get())
+            worker.join()
+    finally:
+        shutil.rmtree(args.tmpdir, ignore_errors=True)
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": environment(args, redis_address), "sizes": sizes, "uncovered": uncovered}, f,
+                    indent=1, sort_keys=True)
+    return 1 if any(s.get("errors") for s in sizes) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
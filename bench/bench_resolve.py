@@ -0,0 +1,45 @@
+"""
+Compare vectorized Domain.resolve_many against looping over Domain._search_network
+
+    python bench/bench_resolve.py [regions] [cities per region] [addresses]
+"""
+import os
+import random
+import sys
+import time
+
+try:
+    from ipam.domain import *
+except ImportError:
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+    from ipam.domain import *
+
+def build_domain(regions, cities):
+    dom = Domain(domain="Bench", groups=["Region", "City"])
+    for r in range(regions):
+        region = dom.add_node(node_type="Region", name="R%d" % r, network="10.%d.0.0/16" % r, parent=dom.root)
+        for c in range(cities):
+            dom.add_node(node_type="City", name="C%d" % c, network="10.%d.%d.0/24" % (r, c), parent=region)
+    return dom
+
+def main(regions=200, cities=200, count=100000):
+    dom = build_domain(regions, cities)
+    ips = ["10.%d.%d.%d" % (random.randrange(256), random.randrange(256), random.randrange(256)) for _ in range(count)]
+
+    t = time.time()
+    looped = [dom._search_network(ip, dom.root) for ip in ips]
+    loop_time = time.time() - t
+
+    dom._range_table()
+    t = time.time()
+    ids = dom.resolve_many(ips)
+    vector_time = time.time() - t
+
+    nodes = dom.get_node_ids()
+    assert [nodes[i] for i in ids] == looped
+    print "nodes: %d, addresses: %d" % (regions * cities + regions + 1, count)
+    print "_search_network loop: %.3fs (%.0f/s)" % (loop_time, count / loop_time)
+    print "resolve_many:         %.3fs (%.0f/s)" % (vector_time, count / vector_time)
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,105 @@
+"""
+Synthetic domains for the benchmarks
+
+    python bench/generate.py nodes [fanout] [depth] > domain.xml
+"""
+import os
+import sys
+
+from lxml import etree
+
+try:
+    from ipam.domain import Domain
+    from ipam.iputil import network_prefix, network_string, address_string, block_size
+except ImportError:
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+    from ipam.domain import Domain
+    from ipam.iputil import network_prefix, network_string, address_string, block_size
+
+def capacity(fanout, depth):
+    """
+    Return number of nodes below the root of a tree of depth levels with fanout children per node
+    """
+    return sum(fanout ** d for d in xrange(1, depth + 1))
+
+def levels(nodes, fanout):
+    """
+    Return the smallest depth holding nodes nodes with fanout children per node
+    """
+    depth = 1
+    while capacity(fanout, depth) < nodes:
+        depth += 1
+    return depth
+
+def generate_element(nodes, fanout=16, depth=None, network="10.0.0.0/8", name="Bench"):
+    """
+    Return (domain root element, groups) of a domain of nodes nodes below the root, filled breadth first
+    Nodes are named n0, n1, ... in that order and have fanout children until nodes are placed, children
+    splitting the network of their parent in 2 ** ceil(log2(fanout)) equal subnets, so each level adds that
+    many bits to the prefixlen
+    Raises ValueError if depth levels cannot hold nodes or the prefixes do not fit network
+    """
+    address, prefixlen = network_prefix(network)
+    width = 128 if address >> 32 else 32
+    bits = max(1, (fanout - 1).bit_length())
+    if depth is None:
+        depth = levels(nodes, fanout)
+    if capacity(fanout, depth) < nodes:
+        raise ValueError("%d levels of fanout %d hold %d nodes" % (depth, fanout, capacity(fanout, depth)))
+    if prefixlen + bits * depth > width:
+        raise ValueError("%d levels of fanout %d do not fit in %s" % (depth, fanout, network))
+    groups = ["Level%d" % d for d in xrange(1, depth + 1)]
+    root = etree.Element("domain", name=name, timestamp="0", version="1", schema=name)
+    root.set("network", "0.0.0.0/0")
+    level = [(root, address)]
+    count = 0
+    for d in xrange(depth):
+        plen = prefixlen + bits * (d + 1)
+        step = 1 << (width - plen)
+        below = []
+        for parent, net in level:
+            for i in xrange(fanout):
+                if count == nodes:
+                    break
+                child = net + i * step
+                e = etree.SubElement(parent, groups[d], name="n%d" % count, network=network_string(child, plen))
+                below.append((e, child))
+                count += 1
+        level = below
+    return root, groups
+
+def generate_domain(nodes, fanout=16, depth=None, network="10.0.0.0/8", name="Bench"):
+    """
+    Return Domain built from generate_element
+    """
+    root, groups = generate_element(nodes, fanout, depth, network, name)
+    dom = Domain(domain=name, groups=groups, schema_name=name)
+    dom.root = root
+    return dom
+
+def generate_records(nodes, fanout=16, depth=None, network="10.0.0.0/8", name="Bench"):
+    """
+    Return (list of (parent path, node_type, name, network) records for Domain.bulk_add, groups)
+    """
+    root, groups = generate_element(nodes, fanout, depth, network, name)
+    paths = {root: ""}
+    records = []
+    for e in root.iterdescendants():
+        parent = paths[e.getparent()]
+        paths[e] = parent and "%s>%s" % (parent, e.get("name")) or e.get("name")
+        records.append((parent, e.tag, e.get("name"), e.get("network")))
+    return records, groups
+
+def random_addresses(rng, network, count):
+    """
+    Return list of count address strings drawn from network with random.Random rng
+    """
+    address, prefixlen = network_prefix(network)
+    size = block_size(address, prefixlen)
+    return [address_string(address + rng.randrange(size)) for _ in xrange(count)]
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    if not args:
+        sys.exit(__doc__)
+    print etree.tostring(generate_element(*args)[0])
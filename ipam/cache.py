@@ -0,0 +1,92 @@
+import collections
+
+from domain import Domain, DOMAIN_KEY, VERSION_KEY, META_KEY
+
+"""
+Per-process cache of parsed domains
+"""
+
+class DomainCache:
+    """
+    LRU cache of parsed Domain objects keyed by domain name, bounded by the total number of nodes held.
+    An entry is reused only while the version key of the domain in redis still matches the cached version,
+    so a hit costs a single GET of that small key instead of fetching and parsing the whole domain.
+    """
+    def __init__(self, max_nodes=1000000, run=None):
+        """
+        run(func, *args, **kwargs) is called to parse domains instead of calling func directly, so that a server
+        can move parsing to a worker pool
+        """
+        self.max_nodes = max_nodes
+        self.run = run or (lambda func, *args, **kwargs: func(*args, **kwargs))
+        self.nodes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._domains = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._domains)
+
+    def __contains__(self, name):
+        return name in self._domains
+
+    def get(self, db, name, load_schema=None, version=None):
+        """
+        Return Domain name from cache or redis db, None if the domain does not exist
+        load_schema is called for the Schema of the domain only when it has to be parsed
+        version is the value of the version key of the domain when the caller already read it
+        """
+        if version is None:
+            version = db.get(VERSION_KEY % name)
+        entry = self._domains.pop(name, None)
+        if entry is not None:
+            if version is not None and entry[0] == version:
+                self.hits += 1
+                self._domains[name] = entry
+                return entry[1]
+            self.nodes -= entry[2]
+        self.misses += 1
+
+        xml = db.get(DOMAIN_KEY % name)
+        if xml is not None:
+            dom = self.run(Domain, raw_xml=xml, schema=load_schema and load_schema() or None)
+            dom.load_hosts(db)
+        elif db.exists(META_KEY % name):
+            # domain kept as a node hash by Domain.save_delta
+            dom = Domain(domain=name, redisdb=db, schema=load_schema and load_schema() or None)
+            version = dom.version
+        else:
+            return None
+        if version is None:
+            # domain saved before version keys were kept
+            version = str(dom.version)
+            db.setnx(VERSION_KEY % name, version)
+        self.put(name, dom, version)
+        return dom
+
+    def put(self, name, dom, version=None):
+        """
+        Cache dom under name, evicting least recently used domains to stay within max_nodes
+        """
+        self.invalidate(name)
+        size = sum(1 for n in dom.root.iter())
+        if size > self.max_nodes:
+            return
+        while self._domains and self.nodes + size > self.max_nodes:
+            self.nodes -= self._domains.popitem(last=False)[1][2]
+            self.evictions += 1
+        self._domains[name] = (str(version or dom.version), dom, size)
+        self.nodes += size
+
+    def invalidate(self, name):
+        """
+        Drop name from cache, for domains changed or deleted by this process
+        """
+        entry = self._domains.pop(name, None)
+        if entry is not None:
+            self.nodes -= entry[2]
+
+    def info(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "domains": len(self._domains), "nodes": self.nodes, "max_nodes": self.max_nodes}
@@ -1,10 +1,25 @@
+import collections
+import copy
+import csv
+import itertools
+import json
+import os
+import random
 import time
 
 from lxml import etree
+from xml.sax.saxutils import escape
 from schema import *
-from ipaddr import IPv4Address, IPv4Network
+from ipaddr import IPv4Address, IPv4Network, IPv6Network
 import redis
 
+from index import SiblingIndex, NetworkTrie, RangeTable, FreePool, NodeIndex, address_array, numpy
+from iputil import (address_prefix, network_prefix, network_range, is_subnet, network_string,
+        range_cidrs, free_ranges, overlapping_ranges, free_summary, block_size, root_spans, spans_summary, subnets,
+        address_string, ADDRESS_SPACE, V6)
+from hosts import HostBitmap, AddressInUseError
+from snapshot import Snapshot, write_snapshot
+
 """
 snippet for pathnames
 PATH = os.path.dirname(os.path.realpath(__file__))
@@ -32,17 +47,119 @@ class ConfirmDeleteNodeError(Exception):
 class DuplicateSiblingError(Exception):
     pass
 
+class InvalidNodeNameError(Exception):
+    pass
+
+DOMAIN_KEY = "ipam:domain:%s"
+VERSION_KEY = "ipam:domain:%s:version"
+NODES_KEY = "ipam:domain:%s:nodes"
+META_KEY = "ipam:domain:%s:meta"
+SUBTREES_KEY = "ipam:domain:%s:subtrees"
+# sorted set of path_member(path) for every node, for reading subtrees with ZRANGEBYLEX
+PATHS_KEY = "ipam:domain:%s:paths"
+# hash of path to the HostBitmap bytes of a leaf node
+HOSTS_KEY = "ipam:domain:%s:hosts"
+
+# compare-and-set of a node hash delta, see Domain.save_delta
+SAVE_DELTA_SCRIPT = """
+local args = cjson.decode(ARGV[1])
+for subtree, expected in pairs(args.expect) do
+    local current = redis.call("HGET", KEYS[2], subtree) or "0"
+    if current ~= expected then
+        return {0, subtree}
+    end
+end
+if args.full then
+    local current = redis.call("GET", KEYS[3])
+    if current and current ~= args.version then
+        return {0, ""}
+    end
+    redis.call("DEL", KEYS[1], KEYS[5], KEYS[6])
+    for _, subtree in ipairs(redis.call("HKEYS", KEYS[2])) do
+        redis.call("HINCRBY", KEYS[2], subtree, 1)
+    end
+end
+local function member(path)
+    local _, depth = string.gsub(path, ">", "")
+    return string.format("%03d|%s", depth + 1, path)
+end
+for _, path in ipairs(args.delete) do
+    redis.call("HDEL", KEYS[1], path)
+    redis.call("ZREM", KEYS[5], member(path))
+    redis.call("HDEL", KEYS[6], path)
+end
+for path, value in pairs(args.set) do
+    redis.call("HSET", KEYS[1], path, value)
+    redis.call("ZADD", KEYS[5], 0, member(path))
+end
+for path, i in pairs(args.hosts) do
+    redis.call("HSET", KEYS[6], path, ARGV[i])
+end
+for field, value in pairs(args.meta) do
+    redis.call("HSET", KEYS[4], field, value)
+end
+local ret = {1, redis.call("INCR", KEYS[3])}
+for _, subtree in ipairs(args.touched) do
+    table.insert(ret, subtree)
+    table.insert(ret, redis.call("HINCRBY", KEYS[2], subtree, 1))
+end
+if args.full then
+    for _, v in ipairs(redis.call("HGETALL", KEYS[2])) do
+        table.insert(ret, v)
+    end
+end
+return ret
+"""
+
+def path_member(path):
+    """
+    Return the member of path in PATHS_KEY, the path prefixed with its depth so that the nodes at one depth
+    below a path are a single lexicographical range
+    """
+    return "%03d|%s" % (path.count(">") + 1, path)
+
+def path_range(parent, depth):
+    """
+    Return (min, max) ZRANGEBYLEX bounds of the members of the nodes at depth below path parent
+    """
+    if not parent:
+        return "[%03d|" % depth, "(%03d}" % depth
+    return "[%03d|%s>" % (depth, parent), "(%03d|%s?" % (depth, parent)
+
+def _text(text):
+    """
+    Return element text or tail escaped as etree.tostring writes it
+    """
+    return escape(text or "").encode("ascii", "xmlcharrefreplace")
+
+Violation = collections.namedtuple("Violation", ["node", "kind", "detail"])
+"""
+Rule broken by node, kind is one of node_type, name, network, subnet, duplicate_name or overlap
+"""
+
+Utilization = collections.namedtuple("Utilization",
+        ["size", "used", "free", "percent", "largest_free", "fragmentation", "nodes"])
+"""
+Address usage of a node: size, used (covered by children) and free addresses, percent used, prefixlen of the
+largest free block (None if full), fragmentation (0 when the free space is one block, towards 1 as it is split
+into smaller blocks) and the number of nodes in its subtree
+"""
+
 class Domain:
     """
     Container class for domain object with an etree representation of xml structure of nodes and networks
     """
 
-    def __init__(self, domain=None, groups=None, xml_file=None, raw_xml="", schema=None, schema_name=""):
+    def __init__(self, domain=None, groups=None, xml_file=None, raw_xml="", schema=None, schema_name="", redisdb=None,
+            subtree=None, depth=None):
 #    def __init__(self, domain=None, schema=None, xml_file=None, raw_xml=""):
         """
         Initialize object with domain name. Class will open xml file with name 'domain.xml'. 
         If no file is present, set file object none
         and initialize tree structure
+        With redisdb, domain is loaded from the node hash written by save_delta
+        With redisdb and subtree set to a path, only the nodes needed to change the node at that path are loaded:
+        its ancestors, its siblings and its descendants down to depth levels below it (all of them if depth is None)
         """
         self.xml_file = xml_file
         self.raw_xml = raw_xml
@@ -54,6 +171,25 @@ class Domain:
         self.version = 1
         self.schema_name = schema_name
         self.schema = schema
+        self._siblings = {}
+        self._trie = None
+        self._ranges = None
+        self._pools = {}
+        self._nodes = None
+        self._dirty = set()
+        self._deleted = set()
+        self._subtree_versions = {}
+        # position of nodes among their siblings as saved by save_delta
+        self._positions = {}
+        # utilization of every node as of the last report, and nodes whose entry changed since
+        self._utilization = None
+        self._utilization_dirty = set()
+        # HostBitmap of leaf nodes with host records, nodes changed and paths dropped since the last save
+        self._hosts = {}
+        self._hosts_dirty = set()
+        self._hosts_deleted = set()
+        self.load_violations = None
+        self.subtree = subtree
 
         if self.raw_xml:
             # if input is xml in string format
@@ -66,11 +202,10 @@ class Domain:
         elif self.xml_file:
             # if input is file containing xml
             # will throw IOError for invalid xml_file, to be caught by Domain caller
-            self.root = etree.parse(self.xml_file).getroot()
-            self.domain = self.root.get("name")
-            self.version = self.root.get("version")
-            self.timestamp = self.root.get("timestamp")
-            self.schema_name = self.root.get("schema")
+            self._load_stream(self.xml_file)
+        elif redisdb is not None and self.domain:
+            self._load_delta(redisdb, subtree, depth)
+            self.groups = self.schema and self.groups.extend(self.schema.get_groups(self.schema_name)) or self.groups
         elif self.domain:
             self.root = etree.Element("domain", name=self.domain, timestamp=self.timestamp, version=str(self.version), schema=schema_name)
         else:
@@ -80,45 +215,205 @@ class Domain:
 
         # run domain validation function
 
-    def validate(self, node=None):
+    def validate(self, node=None, processes=None):
         """
         Validate entire domain tree according to add_node validation checks
-        Does a depth-first tree traversal
-        """
-        node = node or self.root
-        for n in node.getchildren(): 
-            index = node.index(n)
-            node.remove(n)
-            ret = self.add_node(parent=node, name=n.get("name"),
-                    network=n.get("network"), node_type=n.tag, validate_only=True)
-            if ret is not None: 
-                # if n is valid node for node, run validate function on n  
-                if len(n) != 0:
-                    if not self.validate(node=n):
-                        node.insert(index, n)
-                        return False
-            else:
-                # n is not valid for node, insert n back on node and return False
-                node.insert(index, n)
-                return False
+        Returns True if the tree under node has no violations
+        """
+        return not self.violations(node, processes)
 
-            # complete validation by return current n to node and iterate on next n
-            node.insert(index, n)
+    def violations(self, node=None, processes=None):
+        """
+        Return list of Violation for every node under node (default root) breaking add_node validation checks
+        Does a single depth-first pass without modifying the tree, sorting each level's siblings by network
+        start so that overlapping siblings are found in O(n log n)
+        With processes (a number of worker processes or a multiprocessing Pool) the subtrees of the top level
+        nodes of the domain are checked in parallel, see parallel.map_subtrees
+        """
+        node = self.root if node is None else node
+        if processes is not None and node is self.root:
+            return self._parallel_violations(processes)
+        ret = []
+        for parent in node.iter():
+            ret.extend(self._children_violations(parent))
+        return ret
 
-        return True
+    def _children_violations(self, parent):
+        """
+        Return list of Violation of the children of parent
+        """
+        level, span = self._level_span(parent)
+        ranges = []
+        names = {}
+        ret = []
+        for n in parent:
+            ret.extend(self._child_violations(n, parent, level, span, names, ranges))
+        for n, other in overlapping_ranges(ranges):
+            ret.append(Violation(n, "overlap", "network:%s" % other.get("network")))
+        return ret
+
+    def _parallel_violations(self, processes):
+        import parallel
+        ret = self._children_violations(self.root)
+        tops = [n for n in self.root if isinstance(n.tag, basestring)]
+        for top, found in zip(tops, parallel.map_subtrees(parallel.subtree_violations, self.groups[1:], tops, processes)):
+            if found:
+                elements = parallel.subtree_elements(top)
+                ret.extend(Violation(elements[i], kind, detail) for i, kind, detail in found)
+        return ret
+
+    def _level_span(self, parent):
+        """
+        Return (index of parent's node type in groups, (first, last) of its network) for checking its children
+        Both are None when parent itself is invalid, which is reported when visiting parent's own parent
+        The root spans both address families
+        """
+        try:
+            if parent is self.root:
+                return self.groups.index(parent.tag), ADDRESS_SPACE
+            return self.groups.index(parent.tag), network_range(parent.get("network") or "0.0.0.0/0")
+        except ValueError:
+            return None, None
+
+    def _child_violations(self, n, parent, level, span, names, ranges):
+        """
+        Return list of Violation of child n against parent and the siblings recorded in names and ranges
+        Records n in names (case-folded name to node) and ranges ((first, last, node) tuples) for the next sibling
+        """
+        ret = []
+        if n.tag not in self.groups or (level is not None and self.groups.index(n.tag) != level + 1):
+            ret.append(Violation(n, "node_type", n.tag))
+        name = n.get("name")
+        if not name:
+            ret.append(Violation(n, "name", name))
+        elif name.lower() in names:
+            ret.append(Violation(n, "duplicate_name", "name:%s" % names[name.lower()].get("name")))
+        else:
+            names[name.lower()] = n
+        network = n.get("network")
+        try:
+            first, last = network_range(network == "" and "0.0.0.0/0" or network)
+        except ValueError:
+            ret.append(Violation(n, "network", network))
+            return ret
+        if span is not None and not (span[0] <= first and last <= span[1]):
+            ret.append(Violation(n, "subnet", "%s in %s" % (network, parent.get("network"))))
+        ranges.append((first, last, n))
+        return ret
+
+    def _load_stream(self, source):
+        """
+        Build the tree from xml file name or file object source with iterparse instead of parsing it in one go
+        Each node is checked against its parent and siblings and indexed once it has been read, so the
+        violations of the loaded tree end up in load_violations without a second pass over it
+        """
+        self.load_violations = []
+        self._nodes = NodeIndex()
+        self._trie = NetworkTrie()
+        # per open element: (level, span, names, ranges) of the children read so far
+        checks = {}
+        for event, e in etree.iterparse(source, events=("start", "end")):
+            if event == "start":
+                if self.root is None:
+                    # inserted first, as in _network_trie, so that children at 0.0.0.0/0 or ::/0 win
+                    self.root = e
+                    e.set("network", "0.0.0.0/0")
+                    self._trie.insert_prefix(e, V6, 0)
+                    self._trie.insert(e)
+                elif e.get("network"):
+                    try:
+                        self._trie.insert(e)
+                    except ValueError:
+                        pass
+                level, span = self._level_span(e)
+                checks[e] = (level, span, {}, [])
+                continue
+            level, span, names, ranges = checks.pop(e)
+            for n, other in overlapping_ranges(ranges):
+                self.load_violations.append(Violation(n, "overlap", "network:%s" % other.get("network")))
+            self._nodes.add(e, recursive=False)
+            parent = e.getparent()
+            if parent is not None:
+                self.load_violations.extend(self._child_violations(e, parent, *checks[parent]))
+        self.domain = self.root.get("name")
+        self.version = self.root.get("version")
+        self.timestamp = self.root.get("timestamp")
+        self.schema_name = self.root.get("schema")
 
     def __repr__(self):
         return "%s:%s" % (self.domain, self.version)
 
+    def copy(self):
+        """
+        Return a Domain holding a copy of the tree, host records and changes not saved yet, that can be changed
+        and saved without the changes showing in this domain
+        Lookup structures are rebuilt by the copy on first use, the last utilization report is carried over
+        """
+        dom = Domain(domain=self.domain, groups=self.groups[1:], schema=self.schema, schema_name=self.schema_name,
+                subtree=self.subtree)
+        dom.root = copy.deepcopy(self.root)
+        dom.version = self.version
+        dom.timestamp = self.timestamp
+        dom._subtree_versions = dict(self._subtree_versions)
+        dom._deleted = set(self._deleted)
+        dom._hosts_deleted = set(self._hosts_deleted)
+        if self._hosts or self._dirty or self._positions or self._utilization is not None:
+            nodes = dict(itertools.izip(self.root.iter(), dom.root.iter()))
+            dom._hosts = dict((nodes[n], h.copy()) for n, h in self._hosts.items())
+            dom._hosts_dirty = set(nodes[n] for n in self._hosts_dirty)
+            dom._dirty = set(nodes[n] for n in self._dirty)
+            dom._positions = dict((nodes[n], p) for n, p in self._positions.items())
+            if self._utilization is not None:
+                dom._utilization = dict((nodes[n], u) for n, u in self._utilization.items())
+                dom._utilization_dirty = set(nodes.get(n) for n in self._utilization_dirty)
+        return dom
+
+    def to_store(self):
+        """
+        Return NodeStore holding the nodes of the domain in arrays
+        """
+        from store import NodeStore
+        return NodeStore(root=self.root, groups=self.groups[1:])
+
+    def save_snapshot(self, path):
+        """
+        Save the domain as a binary snapshot file, see snapshot.write_snapshot
+        Written to a temporary file renamed over path, so workers holding the previous snapshot mapped keep
+        reading a complete file
+        """
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        store = self.to_store()
+        store.version = self.version
+        with open(tmp, "wb") as f:
+            write_snapshot(f, store)
+        os.rename(tmp, path)
+
+    @classmethod
+    def load_snapshot(cls, path, schema=None):
+        """
+        Return Domain with the tree stored in snapshot file path
+        For read-only use without building the tree, open the file with snapshot.Snapshot instead
+        """
+        snap = Snapshot(path)
+        try:
+            dom = cls(domain=snap.domain, groups=snap.tags[1:snap.ngroups], schema_name=snap.schema_name,
+                    schema=schema)
+            dom.root = snap.to_element()
+            dom.version = snap.version
+            dom.timestamp = snap.timestamp
+        finally:
+            snap.close()
+        return dom
+
     def _validated_ip(self, ip):
         """
         Validates IP address argument
         Accepts ip address in string format, raises InvalidIPError exception if IP is invalid
-        otherwise return IPv4Network object representing ip
+        otherwise return (network int, prefixlen) tuple representing ip
         """
         ip = (ip == "") and "0.0.0.0/0" or ip
         try:
-            net = IPv4Network(ip)
+            net = network_prefix(ip)
         except:
             raise InvalidIPError(ip) 
             #return None
@@ -135,55 +430,304 @@ class Domain:
         #        return etree.tostring(self.root, pretty_print=True)
         return etree.tostring(self.root)
 
+    def iter_xml(self, chunk_size=65536):
+        """
+        Yield the same xml as xml() in chunks of about chunk_size bytes
+        Elements with children are written tag by tag and only leaves are serialized whole, so no more than
+        one chunk of the document is held in memory at a time
+        """
+        buf = []
+        size = 0
+        stack = [(self.root, False)]
+        while stack:
+            node, closing = stack.pop()
+            if closing:
+                piece = "</%s>%s" % (node.tag, _text(node.tail) if node is not self.root else "")
+            elif len(node) == 0 or not isinstance(node.tag, basestring):
+                piece = etree.tostring(node, with_tail=node is not self.root)
+            else:
+                shell = etree.Element(node.tag, node.attrib)
+                piece = etree.tostring(shell)[:-2] + ">" + _text(node.text)
+                stack.append((node, True))
+                stack.extend((c, False) for c in reversed(node))
+            buf.append(piece)
+            size += len(piece)
+            if size >= chunk_size:
+                yield "".join(buf)
+                buf = []
+                size = 0
+        if buf:
+            yield "".join(buf)
+
     def save(self, xml_file=None):
         """
         Save etree xml to designated file
+        The document is written in chunks by iter_xml instead of being serialized as one string
         """
         # add logic in performing write only if data was changed
-        self.version += 1
+        self.version = int(self.version) + 1
         self.timestamp = str(int(time.time()))
         self.root.set("version", str(self.version))
         self.root.set("timestamp", self.timestamp)
-        xml = etree.tostring(self.root, pretty_print=True, xml_declaration=True, encoding="UTF-8")
         with open(xml_file, "w") as f:
-            f.write(xml)
+            f.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+            for chunk in self.iter_xml():
+                f.write(chunk)
 
-    def save_to_db(self, db=None):
+    def save_to_db(self, db=None, retries=5, backoff=0.01, full=False):
         """
         Save to redis db
-        Validate first if saved copy exists in redis and if saved version is more recent
-        """
-        if isinstance(db, redis.client.StrictRedis) and db.ping():
-            name = "ipam:domain:%s" % self.domain
-            tmp = db.get(name)
-            if tmp is not None:
-                tmp = Domain(raw_xml=tmp)
-                if tmp.version() != self.version:
-                    # raise exception about saved version not equal to new version
-                    return False
-                else:
-                    self.version = str(int(self.version) + 1)
-            self.timestamp = str(int(time.time()))
-            self.root.set("version", str(self.version))
-            self.root.set("timestamp", self.timestamp)
-        #    xml = etree.tostring(self.root, pretty_print=True, xml_declaration=True, encoding="UTF-8")
-            xml = etree.tostring(self.root)
-            db.set(name, xml)
+        Compare-and-set against the version key of the domain: fails if a saved copy exists with a version other
+        than the one this domain was loaded with. WATCH/MULTI transactions interrupted by a concurrent write are
+        retried up to retries times with randomized exponential backoff
+        With full set the saved host bitmaps are replaced by those of this domain instead of updated, for domains
+        replacing the saved one as a whole
+        """
+        if not (isinstance(db, redis.client.StrictRedis) and db.ping()) or self.subtree is not None:
+            return False
+        name = DOMAIN_KEY % self.domain
+        version_key = VERSION_KEY % self.domain
+        for attempt in xrange(retries):
+            with db.pipeline() as pipe:
+                try:
+                    pipe.watch(version_key, name)
+                    saved = pipe.get(version_key)
+                    if saved is None:
+                        tmp = pipe.get(name)
+                        saved = tmp is not None and Domain(raw_xml=tmp).version or None
+                    if saved is not None and str(saved) != str(self.version):
+                        # saved version is more recent
+                        return False
+                    try:
+                        version = saved is not None and str(int(saved) + 1) or str(self.version)
+                    except ValueError:
+                        version = "1"
+                    timestamp = str(int(time.time()))
+                    self.root.set("version", version)
+                    self.root.set("timestamp", timestamp)
+                #    xml = etree.tostring(self.root, pretty_print=True, xml_declaration=True, encoding="UTF-8")
+                    xml = etree.tostring(self.root)
+                    pipe.multi()
+                    pipe.set(name, xml)
+                    pipe.set(version_key, version)
+                    self._write_hosts(pipe, full)
+                    pipe.execute()
+                except redis.WatchError:
+                    self.root.set("version", str(self.version))
+                    self.root.set("timestamp", self.timestamp)
+                    time.sleep(backoff * (2 ** attempt) * random.random())
+                    continue
+            self.version = version
+            self.timestamp = timestamp
+            self._hosts_dirty.clear()
+            self._hosts_deleted.clear()
             return True
 
         return False
 
+    def _write_hosts(self, pipe, full=False):
+        """
+        Queue the host bitmaps changed since the last save on pipe, and the removal of those dropped
+        With full set, queue the replacement of all saved bitmaps by the ones of this domain
+        """
+        key = HOSTS_KEY % self.domain
+        if full:
+            pipe.delete(key)
+        elif self._hosts_deleted:
+            pipe.hdel(key, *self._hosts_deleted)
+        for n in (self._hosts if full else self._hosts_dirty):
+            pipe.hset(key, self.get_path(n), self._hosts[n].to_bytes())
+
+    def load_hosts(self, db):
+        """
+        Read the host bitmaps of the domain from redis db, for domains loaded from a saved xml string
+        Bitmaps that do not fit the network of their node, saved before it changed, are dropped
+        """
+        for path, data in db.hgetall(HOSTS_KEY % self.domain).items():
+            node = self.find_path(path)
+            if node is not None:
+                try:
+                    self._hosts[node] = HostBitmap(*network_prefix(node.get("network")), data=data)
+                except ValueError:
+                    continue
+
+    def _subtree_paths(self, node):
+        """
+        Return dict of the paths of node and all its descendants
+        """
+        paths = {node: self.get_path(node)}
+        for n in node.iterdescendants():
+            parent = paths[n.getparent()]
+            paths[n] = parent and "%s>%s" % (parent, n.get("name")) or n.get("name")
+        return paths
+
+    def save_delta(self, db=None, full=False):
+        """
+        Save to redis db as a hash of nodes keyed by path, writing only nodes added, changed or removed since the
+        domain was loaded or last saved, or every node if full is set
+        Runs as a server side compare-and-set: every top level subtree touched by the changes (and the domain
+        level, for changes to top level nodes) must still have the version this domain was loaded with, so writers
+        working on disjoint subtrees do not block each other. A full save replaces the whole domain and checks
+        the version key instead, as save_to_db does. Returns False without writing on a conflict
+        """
+        if not (isinstance(db, redis.client.StrictRedis) and db.ping()):
+            return False
+        if full and self.subtree is not None:
+            # a partially loaded domain would replace the saved one with its part
+            return False
+        if full:
+            paths = self._subtree_paths(self.root)
+            self._positions.clear()
+        else:
+            paths = dict((n, self.get_path(n)) for n in self._dirty)
+        paths.pop(self.root, None)
+
+        touched = set()
+        for path in itertools.chain(paths.values(), self._deleted):
+            top, sep, _ = path.partition(">")
+            touched.add(top)
+            if not sep:
+                touched.add("")
+        if full:
+            touched.add("")
+        expect = {}
+        if not full:
+            expect = dict((t, str(self._subtree_versions.get(t, 0))) for t in touched)
+
+        blobs = []
+        hosts = {}
+        for n, path in paths.items():
+            if n in self._hosts:
+                blobs.append(self._hosts[n].to_bytes())
+                # ARGV[1] holds the json arguments
+                hosts[path] = len(blobs) + 1
+        timestamp = str(int(time.time()))
+        args = {
+            "full": full,
+            "version": str(self.version),
+            "expect": expect,
+            "delete": sorted(self._deleted),
+            "set": dict((path, "%s %s %d" % (n.tag, n.get("network"), self._position(n))) for n, path in paths.items()
+                if isinstance(n.tag, basestring)),
+            "meta": {"name": self.domain, "schema": self.schema_name or "", "timestamp": timestamp},
+            "touched": sorted(touched),
+            "hosts": hosts,
+            }
+        keys = [k % self.domain for k in (NODES_KEY, SUBTREES_KEY, VERSION_KEY, META_KEY, PATHS_KEY, HOSTS_KEY)]
+        ret = db.register_script(SAVE_DELTA_SCRIPT)(keys=keys, args=[json.dumps(args)] + blobs)
+        if not ret[0]:
+            return False
+        self.version = str(ret[1])
+        self.timestamp = timestamp
+        for i in xrange(2, len(ret), 2):
+            self._subtree_versions[ret[i]] = int(ret[i + 1])
+        self.root.set("version", self.version)
+        self.root.set("timestamp", self.timestamp)
+        self._dirty.clear()
+        self._deleted.clear()
+        self._hosts_dirty.clear()
+        self._hosts_deleted.clear()
+        return True
+
+    def _load_delta(self, db, subtree=None, depth=None):
+        """
+        Build tree from the node hash of the domain in redis db, or from the part of it around path subtree
+        """
+        pipe = db.pipeline(transaction=True)
+        pipe.hgetall(META_KEY % self.domain)
+        pipe.get(VERSION_KEY % self.domain)
+        pipe.hgetall(SUBTREES_KEY % self.domain)
+        if subtree is None:
+            pipe.hgetall(NODES_KEY % self.domain)
+            pipe.hgetall(HOSTS_KEY % self.domain)
+            meta, version, subtrees, nodes, hosts = pipe.execute()
+        else:
+            pipe.exists(PATHS_KEY % self.domain)
+            meta, version, subtrees, indexed = pipe.execute()
+            if not indexed:
+                self._index_paths(db)
+            nodes = self._subtree_nodes(db, subtree, depth)
+            hosts = dict(zip(nodes, db.hmget(HOSTS_KEY % self.domain, list(nodes)))) if nodes else {}
+        self._subtree_versions = dict((k, int(v)) for k, v in subtrees.items())
+        self.schema_name = meta.get("schema", self.schema_name)
+        self.timestamp = meta.get("timestamp", self.timestamp)
+        self.version = version or self.version
+        self.root = etree.Element("domain", name=self.domain, timestamp=self.timestamp, version=str(self.version),
+                schema=self.schema_name)
+        elements = {"": self.root}
+        records = {}
+        for path, value in nodes.items():
+            if value is not None:
+                # nodes saved before positions were kept sort by name ahead of the others
+                tag, network, position = (value.split(" ") + ["-1"])[:3]
+                records[path] = tag, network, int(position)
+        for path in sorted(records, key=lambda p: (p.count(">"), records[p][2], p)):
+            parent, _, name = path.rpartition(">")
+            if parent not in elements:
+                continue
+            tag, network, position = records[path]
+            elements[path] = etree.SubElement(elements[parent], tag, name=name, network=network)
+            if position >= 0:
+                self._positions[elements[path]] = position
+            if hosts.get(path) is not None:
+                self._hosts[elements[path]] = HostBitmap(*network_prefix(network), data=hosts[path])
+
+    def _position(self, node):
+        """
+        Return the position of node among its siblings, the one it was saved with or one past its previous
+        sibling's for nodes not saved yet, so that siblings keep document order across delta saves
+        """
+        pending = []
+        while node is not None and node not in self._positions:
+            pending.append(node)
+            node = node.getprevious()
+        position = self._positions[node] if node is not None else -1
+        for n in reversed(pending):
+            position += 1
+            self._positions[n] = position
+        return position
+
+    def _index_paths(self, db):
+        """
+        Fill the path index of a domain saved before save_delta kept one
+        """
+        paths = db.hkeys(NODES_KEY % self.domain)
+        for i in xrange(0, len(paths), 1000):
+            members = [path_member(p) for p in paths[i:i + 1000]]
+            db.execute_command("ZADD", PATHS_KEY % self.domain, *itertools.chain(*((0, m) for m in members)))
+
+    def _subtree_nodes(self, db, subtree, depth=None):
+        """
+        Return dict of path to node hash value for the ancestors, siblings and descendants (down to depth levels)
+        of the node at path subtree, read in two round trips whatever the size of the domain
+        """
+        names = subtree and subtree.split(">") or []
+        level = len(names)
+        parent = ">".join(names[:-1])
+        paths = [">".join(names[:i]) for i in xrange(1, level + 1)]
+        ranges = []
+        if names:
+            ranges.append(path_range(parent, level))
+        last = level + (depth if depth is not None else len(self.groups) - 1 or 32)
+        ranges.extend(path_range(subtree, d) for d in xrange(level + 1, last + 1))
+        key = PATHS_KEY % self.domain
+        pipe = db.pipeline(transaction=False)
+        for start, end in ranges:
+            pipe.zrangebylex(key, start, end)
+        for members in pipe.execute():
+            paths.extend(m.partition("|")[2] for m in members)
+        if not paths:
+            return {}
+        return dict(zip(paths, db.hmget(NODES_KEY % self.domain, paths)))
+
     def _is_subnet(self, supernet, net, raise_exception=True):
         """
         Tests if net is subnet of supernet.
-        Does the native test in IPv4Address as well as ensure net prefix is longer than supernet
+        Compares the integer address ranges of both networks, parsed through the shared parse cache
         Will raise exception if net is not a subnet of supernet by default, can be set to return False
         """
         #need to change default network, 0.0.0.0/0 introduces subtle issues
-        _super = IPv4Network(supernet)
-        _net = IPv4Network(net)
-        #return (_net in _super) and (_net.prefixlen > _super.prefixlen)
-        if (_net in _super) and (_net.prefixlen >= _super.prefixlen):
+        if is_subnet(supernet, net):
             return True
         else:
             if raise_exception:
@@ -191,32 +735,136 @@ class Domain:
             else:
                 return False
 
-    def _is_unique_amongst_siblings(self, parent=None, **kwargs):
+    def _sibling_index(self, parent):
+        """
+        Return the SiblingIndex of parent's children, building it on first use
+        """
+        index = self._siblings.get(parent)
+        if index is None:
+            index = self._siblings[parent] = SiblingIndex(parent)
+        return index
+
+    def _is_unique_amongst_siblings(self, parent=None, node=None, **kwargs):
         """
         Determines whether provided name and network (non-overlapping) are unique among given parent's children nodes
         network parameter should already be validated by calling function add_node
         name comparision is case-insensitive
+        node is left out of the comparison, for checking changes to an existing child of parent
         """
         if not isinstance(parent, etree._Element):
             return False
 
+        index = self._sibling_index(parent)
         for k, v in kwargs.items():
-            condition = "test_%s" % k
-            test_name = lambda x: v.lower() == x.get(k).lower()
-            test_network = lambda x: any([self._is_subnet(v, x.get(k), raise_exception=False),
-                                        self._is_subnet(x.get(k), v, raise_exception=False),
-                                        IPv4Network(v) == IPv4Network(x.get(k))])
-            if condition in locals().keys():
-                test = locals().get(condition)
-                for s in parent:
-                    if test(s):
-                        raise DuplicateSiblingError("%s:%s" % (k, s.get(k)))
+            if k == "name":
+                s = index.named(v, exclude=node)
+            elif k == "network":
+                s = index.overlapping(v, exclude=node)
+            else:
+                continue
+            if s is not None:
+                raise DuplicateSiblingError("%s:%s" % (k, s.get(k)))
                 
         return True
 
+    def _attach(self, parent, *children):
+        """
+        Append children to parent, keeping lookup structures in sync
+        """
+        parent.extend(children)
+        if len(children) > 1:
+            # rebuilding parent's index and pool on next use is cheaper than updating them child by child
+            self._siblings.pop(parent, None)
+            self._pools.pop(parent, None)
+        for child in children:
+            if self._utilization is not None:
+                self._utilization_dirty.add(parent)
+                self._utilization_dirty.update(child.iter())
+            if parent in self._siblings:
+                self._siblings[parent].add(child)
+            if parent in self._pools:
+                self._pools[parent].reserve(child.get("network"))
+            if self._nodes is not None:
+                self._nodes.add(child)
+            if self._trie is not None:
+                for n in child.iter():
+                    if n.get("network"):
+                        self._trie.insert(n)
+            self._dirty.update(child.iter())
+        self._ranges = None
+
+    def _detach(self, node):
+        """
+        Remove node from its parent, keeping lookup structures in sync
+        """
+        parent = node.getparent()
+        if self._utilization is not None:
+            self._utilization_dirty.add(parent)
+            for n in node.iter():
+                self._utilization.pop(n, None)
+                self._utilization_dirty.discard(n)
+        if parent in self._siblings:
+            self._siblings[parent].remove(node)
+        if parent in self._pools:
+            self._pools[parent].release(node.get("network"))
+        paths = self._subtree_paths(node)
+        self._deleted.update(paths.values())
+        self._dirty.difference_update(node.iter())
+        for n in node.iter():
+            if self._hosts.pop(n, None) is not None:
+                self._hosts_deleted.add(paths[n])
+                self._hosts_dirty.discard(n)
+        parent.remove(node)
+        if self._nodes is not None:
+            self._nodes.remove(node)
+        for n in node.iter():
+            self._siblings.pop(n, None)
+            self._pools.pop(n, None)
+            self._positions.pop(n, None)
+        self._trie = None
+        self._ranges = None
+
+    def _update(self, node, **kwargs):
+        """
+        Set attributes of node, keeping lookup structures in sync
+        """
+        index = self._siblings.get(node.getparent())
+        pool = "network" in kwargs and self._pools.get(node.getparent())
+        if index is not None:
+            index.remove(node)
+        if pool:
+            pool.release(node.get("network"))
+        if self._nodes is not None:
+            self._nodes.remove(node, recursive=False)
+        if "name" in kwargs:
+            # every path under node changes with its name
+            paths = self._subtree_paths(node)
+            self._deleted.update(paths.values())
+            self._dirty.update(node.iter())
+            for n in node.iter():
+                if n in self._hosts:
+                    self._hosts_deleted.add(paths[n])
+                    self._hosts_dirty.add(n)
+        self._dirty.add(node)
+        for k, v in kwargs.items():
+            node.set(k, v)
+        if self._nodes is not None:
+            self._nodes.add(node, recursive=False)
+        if index is not None:
+            index.add(node)
+        if pool:
+            pool.reserve(node.get("network"))
+        if "network" in kwargs:
+            if self._utilization is not None:
+                self._utilization_dirty.update((node, node.getparent()))
+            self._pools.pop(node, None)
+            self._trie = None
+            self._ranges = None
+
     def add_node(self, node_type=None, parent=None, name="", network="", validate_only=False):
         """
         Add node into the tree. Node type must conform to the schema.
+        Names cannot contain ">", the separator of paths, raises InvalidNodeNameError
         Return element represeting the node
         """
         child = None
@@ -224,6 +872,9 @@ class Domain:
 
         if node_type not in self.groups:
             raise InvalidNodeTypeError(node_type)
+        if name and ">" in name:
+            # ">" separates the names of a path
+            raise InvalidNodeNameError(name)
 
         if name:
             """
@@ -238,55 +889,229 @@ class Domain:
             """
             if (isinstance(parent, etree._Element) 
                     and (self.groups.index(node_type) == self.groups.index(parent.tag) + 1) 
-                    and self._is_subnet(parent.get("network"), network) 
+                    and (parent is self.root or self._is_subnet(parent.get("network"), network))
                     and self._is_unique_amongst_siblings(name=name, network=network, parent=parent)):
                 child = etree.Element(node_type, name=name, network=network)
                 if not validate_only:
-                    parent.append(child)
+                    self._attach(parent, child)
             elif parent is None:
                 if self.groups.index(node_type) != 0:
                     raise CantAddParentlessNodeError(node_type)
                 child = etree.Element(node_type, name=name, network=network)
                 if not validate_only:
-                    self.root.append(child)
+                    self._attach(self.root, child)
 
         return child
 
-#    def get_node(self, node_type=None, name=None, network=None):
+    def bulk_add(self, records):
+        """
+        Add many nodes in one call
+        records is an iterable of (parent, node_type, name, network) tuples or a csv stream with the same columns,
+        parent being an element or the path of a node that exists or is added by an earlier record
+        Records are grouped by parent and each group is checked in one pass sorted by network, elements are
+        attached only after every record passed the add_node checks
+        Return list of elements representing the nodes, in the order of records
+        """
+        if hasattr(records, "read"):
+            records = (r for r in csv.reader(records) if r and r[1] != "node_type")
+        records = list(records)
+
+        def depth(record):
+            parent = record[1][0]
+            if isinstance(parent, etree._Element):
+                return sum(1 for a in parent.iterancestors())
+            return parent and parent.count(">") + 1 or 0
+
+        ret = [None] * len(records)
+        pending = {}
+        children = collections.OrderedDict()
+        ranges = {}
+        for i, (parent, node_type, name, network) in sorted(enumerate(records), key=depth):
+            network = network or "0.0.0.0/0"
+            address, prefixlen = self._validated_ip(network)
+            if node_type not in self.groups:
+                raise InvalidNodeTypeError(node_type)
+            if isinstance(parent, etree._Element):
+                path = self.get_path(parent)
+            else:
+                path = parent or ""
+                parent = pending.get(path)
+                if parent is None:
+                    parent = self.find_path(path)
+                if parent is None:
+                    raise CantAddParentlessNodeError(path)
+            if not name:
+                continue
+            if ">" in name:
+                raise InvalidNodeNameError(name)
+            if self.groups.index(node_type) != self.groups.index(parent.tag) + 1:
+                raise InvalidNodeTypeError(node_type)
+            if parent not in ranges:
+                ranges[parent] = ADDRESS_SPACE if parent is self.root else network_range(parent.get("network"))
+            start, end = ranges[parent]
+            first, last = address, address + block_size(address, prefixlen) - 1
+            if not (start <= first and last <= end):
+                raise AssignedIPnotinSubnet("%s in %s" % (network, parent.get("network")))
+            child = etree.Element(node_type, name=name, network=network)
+            ranges[child] = first, last
+            pending[path and "%s>%s" % (path, name) or name] = child
+            children.setdefault(parent, []).append((child, name, first, last))
+            ret[i] = child
+
+        new = set(pending.values())
+        for parent, nodes in children.items():
+            index = self._sibling_index(parent) if parent not in new else SiblingIndex()
+            names = {}
+            for n, name, first, last in nodes:
+                other = names.get(name.lower())
+                if other is None:
+                    other = index.named(name)
+                if other is not None:
+                    raise DuplicateSiblingError("name:%s" % other.get("name"))
+                names[name.lower()] = n
+                other = index.overlapping_range(first, last)
+                if other is not None:
+                    raise DuplicateSiblingError("network:%s" % other.get("network"))
+            for n, other in overlapping_ranges((first, last, n) for n, name, first, last in nodes):
+                raise DuplicateSiblingError("network:%s" % other.get("network"))
+            children[parent] = [n[0] for n in nodes]
+
+        for parent, nodes in children.items():
+            if parent in new:
+                parent.extend(nodes)
+        for parent, nodes in children.items():
+            if parent not in new:
+                self._attach(parent, *nodes)
+        return ret
+
     def get_node(self, node_type="*", name=None, network=None):
         """
         Return node/s with given properties 
+        Answered from the node type, name and network indexes of the domain
         """
-        node = []
-#        print "Inside dom.get_node"
-#        print "node_type: %s" % node_type
-#        print "name: %s" % name
-#        print self.groups
-#        if node_type and (node_type in self.groups):
-        if name:
-            q = "//%s[@name='%s']" % (node_type, name)
-        else:
-            q = "//%s" % node_type
-        node = self.root.xpath(q)
-
-        if network: # may need to improve the logic behind selection of name/nodetype vs network search
-            pass
+        if network:
+            try:
+                network = network_prefix(network)
+            except ValueError:
+                return []
+        return self._node_index().find(node_type=node_type, name=name, network=network)
 
-        return node
+    def _node_index(self):
+        """
+        Return the NodeIndex of the domain, building it on first use
+        """
+        if self._nodes is None:
+            self._nodes = NodeIndex(self.root)
+        return self._nodes
 
     def _search_network(self, network, node):
         """
         Return node for a given network
+        Returns the most specific descendant of node containing network, node itself if there is none
         """
-        for c in node.getchildren():
-            try:
-                if self._is_subnet(c.get("network"), network):
-                    node = self._search_network(network, c)
-            except AssignedIPnotinSubnet:
-                continue
-
+        match = self.lookup(network)
+        if match is not None and (match is node or node in match.iterancestors()):
+            return match
         return node
+
+    def _network_trie(self):
+        """
+        Return the longest-prefix-match trie of the domain, compiling it on first use
+        """
+        if self._trie is None:
+            # the root also holds the IPv6 space, inserted first so that a child at ::/0 wins
+            self._trie = NetworkTrie()
+            self._trie.insert_prefix(self.root, V6, 0)
+            for n in self.root.iter():
+                if n.get("network"):
+                    try:
+                        self._trie.insert(n)
+                    except ValueError:
+                        # invalid network, reported by violations
+                        continue
+        return self._trie
+
+    def lookup(self, ip):
+        """
+        Return the most specific node whose network contains ip
+        ip can be an address or network string or an int, returns None for an invalid ip
+        """
+        ret = address_prefix(ip)
+        if ret is None:
+            return None
+        return self._network_trie().longest_match(*ret)
+
+    def lookup_many(self, ips):
+        """
+        Return list of lookup results, one for every ip in ips
+        """
+        longest_match = self._network_trie().longest_match
+        ret = []
+        for ip in ips:
+            ip = address_prefix(ip)
+            ret.append(longest_match(*ip) if ip is not None else None)
+        return ret
         
+    def get_path(self, node):
+        """
+        Return hierarchical path of node, names of its ancestors below the domain root and its own name joined by ">"
+        """
+        names = [a.get("name") for a in node.iterancestors()][-2::-1]
+        if node is not self.root:
+            names.append(node.get("name"))
+        return ">".join(names)
+
+    def find_path(self, path):
+        """
+        Return node at hierarchical path as returned by get_path, None if there is no such node
+        """
+        node = self.root
+        for name in path and path.split(">") or []:
+            node = self._sibling_index(node).named(name)
+            if node is None or node.get("name") != name:
+                return None
+        return node
+
+    def _range_table(self):
+        """
+        Return the flattened range table of the domain, building it on first use
+        """
+        if self._ranges is None:
+            self._ranges = RangeTable(self.root)
+        return self._ranges
+
+    def resolve_many(self, ips, paths=False):
+        """
+        Vectorized lookup of the most specific node for every address in ips
+        ips is a numpy uint32 array or a sequence of address strings, IPv6 addresses among them are looked up one
+        by one in the trie of lookup_many
+        Returns numpy array of node ids, indexes into nodes list returned by get_node_ids, or a list of node paths
+        Invalid addresses get id -1 (path None)
+        """
+        table = self._range_table()
+        if not isinstance(ips, numpy.ndarray):
+            ips = list(ips)
+        addresses, valid = address_array(ips)
+        ids = table.resolve(addresses)
+        ids[~valid] = -1
+        if not valid.all():
+            longest_match = self._network_trie().longest_match
+            for i in numpy.flatnonzero(~valid):
+                ip = address_prefix(ips[i])
+                if ip is not None and ip[0] >> 32:
+                    ids[i] = table.ids.get(longest_match(*ip), -1)
+        if paths:
+            unique, inverse = numpy.unique(ids, return_inverse=True)
+            names = numpy.array([self.get_path(table.nodes[i]) if i >= 0 else None for i in unique], dtype=object)
+            return list(names[inverse])
+        return ids
+
+    def get_node_ids(self):
+        """
+        Return list of nodes indexed by the node ids returned by resolve_many
+        """
+        return self._range_table().nodes
+
     def set_node(self, node=None, validate_only=False, **kwargs):
         """
         Change given node according to new properties set in kwargs
@@ -295,6 +1120,8 @@ class Domain:
         Network change  will involve validation for ip address rules
         """
         ret = None
+        if ">" in (kwargs.get("name") or ""):
+            raise InvalidNodeNameError(kwargs["name"])
         if isinstance(node, etree._Element):
             # add a case for changing root element attribute(s)
             if "network" in kwargs and self._validated_ip(kwargs["network"]):
@@ -303,18 +1130,28 @@ class Domain:
                     for c in node.getchildren():
                         if not self._is_subnet(kwargs["network"], c.get("network")):
                             return ret
-                if self.groups.index(node.tag) and not self._is_subnet(node.getparent().get("network"), kwargs["network"]):
+                if (self.groups.index(node.tag) and node.getparent() is not self.root
+                        and not self._is_subnet(node.getparent().get("network"), kwargs["network"])):
                     # if node_type is not first in group and node is not subnet of parent node network
                     return ret
-                if not self._is_unique_amongst_siblings(network=kwargs["network"], parent=node.getparent()):
+                if not self._is_unique_amongst_siblings(network=kwargs["network"], parent=node.getparent(), node=node):
                     # figure out a way to run this once for network and name fields
                     return ret
+                hosts = None
+                if node in self._hosts:
+                    try:
+                        hosts = self._hosts[node].rebase(*network_prefix(kwargs["network"]))
+                    except ValueError:
+                        raise AssignedIPnotinSubnet("hosts of %s in %s" % (node.get("name"), kwargs["network"]))
                 if not validate_only:
-                    node.set("network", kwargs["network"])
+                    self._update(node, network=kwargs["network"])
+                    if hosts is not None:
+                        self._hosts[node] = hosts
+                        self._hosts_changed(node)
                 ret = node
-            if "name" in kwargs and self._is_unique_amongst_siblings(name=kwargs["name"], parent=node.getparent()):
+            if "name" in kwargs and self._is_unique_amongst_siblings(name=kwargs["name"], parent=node.getparent(), node=node):
                 if not validate_only:
-                    node.set("name", kwargs["name"])
+                    self._update(node, name=kwargs["name"])
                 ret = node
 
         return ret
@@ -327,50 +1164,278 @@ class Domain:
         if isinstance(node, etree._Element):
             if not force:
                 raise ConfirmDeleteNodeError(node)
-            node.getparent().remove(node)
+            self._detach(node)
             ret = node
 
         return ret
 
+    def _host_bitmap(self, node):
+        """
+        Return the HostBitmap of leaf node, empty until a host of node is assigned
+        Host records are kept on nodes of the last node type of the schema only
+        """
+        if not isinstance(node, etree._Element):
+            raise TypeError("Invalid node %s for host records" % str(node))
+        if node.tag not in self.groups or self.groups.index(node.tag) != len(self.groups) - 1:
+            raise InvalidNodeTypeError(node.tag)
+        bitmap = self._hosts.get(node)
+        if bitmap is None:
+            bitmap = HostBitmap(*network_prefix(node.get("network")))
+        return bitmap
+
+    def _hosts_changed(self, node, bitmap=None):
+        """
+        Keep bitmap as the host records of node and mark them for the next save
+        Marks node dirty as well, so that save_delta checks the version of its subtree
+        """
+        if bitmap is not None:
+            self._hosts[node] = bitmap
+        self._hosts_dirty.add(node)
+        self._dirty.add(node)
+
+    def _host_address(self, address):
+        """
+        Return address int of a single address string, raises InvalidIPError for anything else
+        """
+        ret = address_prefix(address)
+        if ret is None:
+            raise InvalidIPError(address)
+        if ret[1] != (128 if ret[0] >> 32 else 32):
+            raise InvalidIPError(address)
+        return ret[0]
+
+    def allocate_hosts(self, node, count=1):
+        """
+        Assign the first count contiguous free host addresses of leaf node
+        Return the first address as a string, None if node has no such room
+        """
+        bitmap = self._host_bitmap(node)
+        address = bitmap.allocate(count)
+        if address is None:
+            return None
+        self._hosts_changed(node, bitmap)
+        return address_string(address)
+
+    def assign_hosts(self, node, address, count=1):
+        """
+        Assign count host addresses of leaf node starting at address string
+        Raises AddressInUseError if one of them is already assigned, AssignedIPnotinSubnet if one of them is
+        not a usable address of node's network
+        """
+        bitmap = self._host_bitmap(node)
+        try:
+            bitmap.assign(self._host_address(address), count)
+        except ValueError:
+            raise AssignedIPnotinSubnet("%s+%d in %s" % (address, count, node.get("network")))
+        self._hosts_changed(node, bitmap)
+        return address
+
+    def release_hosts(self, node, address, count=1):
+        """
+        Free count host addresses of leaf node starting at address string
+        Return the number of them that were assigned
+        """
+        bitmap = self._host_bitmap(node)
+        try:
+            released = bitmap.release(self._host_address(address), count)
+        except ValueError:
+            raise AssignedIPnotinSubnet("%s+%d in %s" % (address, count, node.get("network")))
+        if released:
+            self._hosts_changed(node, bitmap)
+        return released
+
+    def host_counts(self, node):
+        """
+        Return dict of size, reserved, used and free host address counts of leaf node
+        """
+        return self._host_bitmap(node).counts()
+
+    def host_ranges(self, node):
+        """
+        Return list of (first, last) address strings of the runs of assigned host addresses of leaf node
+        """
+        return [(address_string(first), address_string(last)) for first, last in self._host_bitmap(node).ranges()]
+
+    def _free_pool(self, node):
+        """
+        Return the FreePool of node's unused space, building it on first use
+        """
+        pool = self._pools.get(node)
+        if pool is None:
+            pool = self._pools[node] = FreePool(node.get("network"), self._free_blocks(node))
+        return pool
+
+    def allocate(self, parent=None, prefixlen=None, name="", strategy="first_fit", version=None):
+        """
+        Add a child named name to parent on the next free network with subnet mask equal to prefixlen
+        strategy is first_fit (lowest free address) or best_fit (smallest free block that fits)
+        version (4 or 6) picks the address family under the domain root, which allocates IPv4 networks by default
+        and IPv6 ones once it has an IPv6 child, other parents allocate from the family of their own network
+        Return element representing the node, None if parent has no room left
+        """
+        if not isinstance(parent, etree._Element):
+            raise TypeError("Invalid node %s to allocate" % str(parent))
+        try:
+            node_type = self.groups[self.groups.index(parent.tag) + 1]
+        except IndexError:
+            raise InvalidNodeTypeError(parent.tag)
+        self._is_unique_amongst_siblings(name=name, parent=parent)
+
+        net = self._free_pool(parent).find(prefixlen, strategy, version if parent is self.root else None)
+        if net is None:
+            return None
+        return self.add_node(node_type=node_type, parent=parent, name=name, network=network_string(net, prefixlen))
+
     def get_available_networks(self, node=None, prefixlen=None, number=10):
         """
         Return list of available networks from a given node with subnet mask equal to prefixlen
+        Returns at most number networks when prefixlen is set, all free blocks otherwise
         """
+        free_nws = self.iter_available_networks(node=node, prefixlen=prefixlen)
+        if prefixlen:
+            return list(itertools.islice(free_nws, number))
+        else:
+            return list(free_nws)
 
+    def iter_available_networks(self, node=None, prefixlen=None):
+        """
+        Yield available networks from a given node in address order
+        Yields subnets with subnet mask equal to prefixlen if set, minimal CIDR blocks covering free space otherwise
+        Subnets are generated lazily from the free blocks, so an IPv6 /48 does not enumerate its 65536 /64s
+        unless they are all consumed
+        """
         if not isinstance(node, etree._Element):
             raise TypeError("Invalid node %s to get_available_networks" % str(node))
 
-        child_nws = []
+        for net, plen in self._free_blocks(node):
+            network = IPv6Network if net >> 32 else IPv4Network
+            if not prefixlen:
+                yield network(network_string(net, plen))
+            elif plen <= prefixlen <= (128 if net >> 32 else 32):
+                for n in subnets(net, plen, prefixlen):
+                    yield network(network_string(n, prefixlen))
 
-        for n in node:
-            child_nws.append(IPv4Network(n.get("network")))
+    def free_space(self, node=None, processes=None):
+        """
+        Return dict of node (default root) and every node below it to (number of free addresses, prefixlen of
+        the largest free block or None), the space of each node not used by its children
+        Children with an invalid network, reported by violations, are left out and a node with an invalid
+        network has no free space
+        With processes (a number of worker processes or a multiprocessing Pool) the subtrees of the top level
+        nodes of the domain are analysed in parallel, see parallel.map_subtrees
+        """
+        import parallel
+        node = self.root if node is None else node
+        if processes is None or node is not self.root:
+            return dict((n, self._free_summary(n)) for n in parallel.subtree_elements(node))
+        ret = {self.root: self._free_summary(self.root)}
+        tops = [n for n in self.root if isinstance(n.tag, basestring)]
+        for top, found in zip(tops, parallel.map_subtrees(parallel.subtree_free_space, self.groups[1:], tops, processes)):
+            ret.update(itertools.izip(parallel.subtree_elements(top), found))
+        return ret
 
-        all_free_nws = self.__get_free_networks(IPv4Network(node.get("network")), child_nws)
+    def _free_summary(self, node):
+        """
+        Return (free addresses, prefixlen of the largest free block or None) of node from its sorted child ranges
+        Networks that are missing or do not parse are left out, as in violations
+        """
+        ranges = []
+        for c in node:
+            if isinstance(c.tag, basestring):
+                network = c.get("network")
+                try:
+                    ranges.append(network_range(network == "" and "0.0.0.0/0" or network))
+                except ValueError:
+                    continue
+        ranges.sort()
+        if node is self.root:
+            return spans_summary(root_spans(ranges), ranges)[:2]
+        network = node.get("network")
+        try:
+            start, end = network_range(network == "" and "0.0.0.0/0" or network)
+        except ValueError:
+            return 0, None
+        return free_summary(start, end, ranges)
 
-        if prefixlen:
-            free_nws = []
-            for nw in all_free_nws:
-                if nw.prefixlen <= prefixlen:
-                    _nw = nw.iter_subnets(new_prefix=prefixlen)
-                    try:
-                        while len(free_nws) <= number:
-                            free_nws.append(_nw.next())
-                    except StopIteration:
-                        continue
-            return free_nws
+    def utilization_report(self, node=None, incremental=False):
+        """
+        Return dict of node (default root) and every node below it to its Utilization
+        Computed in one post-order pass, each node from the integer ranges of its children and the node counts
+        already computed for them. With incremental set, the report of the whole domain is kept and later calls
+        only recompute the nodes changed since and their ancestors
+        """
+        node = self.root if node is None else node
+        if not incremental:
+            return self._utilization_pass(e for e in node.iter() if isinstance(e.tag, basestring))
+        if self._utilization is None:
+            self._utilization = self._utilization_pass(e for e in self.root.iter() if isinstance(e.tag, basestring))
+        elif self._utilization_dirty:
+            changed = set()
+            for n in self._utilization_dirty:
+                if n is not None and (n is self.root or n.getparent() is not None):
+                    changed.add(n)
+                    changed.update(n.iterancestors())
+            depth = lambda n: sum(1 for a in n.iterancestors())
+            self._utilization.update(self._utilization_pass(sorted(changed, key=depth), self._utilization))
+        self._utilization_dirty.clear()
+        if node is self.root:
+            return dict(self._utilization)
+        return dict((n, self._utilization[n]) for n in node.iter() if isinstance(n.tag, basestring))
+
+    def _utilization_pass(self, nodes, known=None):
+        """
+        Return dict of Utilization of nodes, given in an order where ancestors come before descendants
+        Entries of children not in nodes are taken from known
+        Networks that are missing or do not parse are left out as in free_space, such a node has size 0
+        """
+        ret = {}
+        for n in reversed(list(nodes)):
+            ranges = []
+            count = 1
+            for c in n:
+                if not isinstance(c.tag, basestring):
+                    continue
+                entry = ret.get(c)
+                if entry is None:
+                    entry = known[c]
+                count += entry.nodes
+                network = c.get("network")
+                try:
+                    ranges.append(network_range(network == "" and "0.0.0.0/0" or network))
+                except ValueError:
+                    continue
+            ranges.sort()
+            if n is self.root:
+                spans = root_spans(ranges)
+                size = sum(end - start + 1 for start, end in spans)
+                free, largest, largest_size = spans_summary(spans, ranges)
+            else:
+                network = n.get("network")
+                try:
+                    start, end = network_range(network == "" and "0.0.0.0/0" or network)
+                except ValueError:
+                    ret[n] = Utilization(0, 0, 0, 0.0, None, 0.0, count)
+                    continue
+                size = end - start + 1
+                free, largest = free_summary(start, end, ranges)
+                largest_size = block_size(start, largest) if largest is not None else 0
+            fragmentation = 0.0
+            if free:
+                fragmentation = 1 - float(largest_size) / free
+            ret[n] = Utilization(size, size - free, free, 100.0 * (size - free) / size, largest, fragmentation, count)
+        return ret
+
+    def _free_blocks(self, node):
+        """
+        Yield (network int, prefixlen) of the minimal CIDR blocks covering space in node not used by its children
+        Walks the sorted child ranges of the sibling index once, per address family for the root
+        """
+        index = self._sibling_index(node)
+        if node is self.root:
+            spans = root_spans(zip(index.starts, index.ends))
         else:
-            return all_free_nws
-                            
-    def __get_free_networks(self, parent, children):
-        """
-        Return list of available networks from a parent supernet minus a list of subnets
-        """
-        nws = [parent]
-        for c in children:
-            _nws = nws[:]
-            for _nw in _nws:
-                if c in _nw:
-                    nws.remove(_nw)
-                    nws.extend(_nw.address_exclude(c))
-                    break
-        return nws
+            spans = [network_range(node.get("network"))]
+        for start, end in spans:
+            for first, last in free_ranges(start, end, itertools.izip(index.starts, index.ends)):
+                for block in range_cidrs(first, last):
+                    yield block
@@ -0,0 +1,204 @@
+import copy
+import re
+
+from iputil import block_size, max_prefixlen
+
+"""
+Host address assignment inside leaf subnets, one bit per address
+"""
+
+# largest subnet given a bitmap, 2 MB of bits
+MAX_HOSTS = 1 << 24
+
+_NOT_FULL = re.compile("[^\xff]")
+_NOT_EMPTY = re.compile("[^\x00]")
+# number of set bits of every byte value, for str.translate
+_POPCOUNT = "".join(chr(bin(i).count("1")) for i in xrange(256))
+
+def _popcount(data):
+    return sum(bytearray(str(data).translate(_POPCOUNT)))
+
+class AddressInUseError(Exception):
+    pass
+
+class HostBitmap:
+    """
+    Assigned host addresses of a subnet as a bytearray, bit i (most significant bit first in each byte) set when
+    address network + i is assigned
+    Free addresses are found by scanning for bytes that are not full with a compiled regex and ranges are set
+    and cleared with slice assignments, so operations cost O(number of bytes) in C rather than a python step
+    per address, allocating a range stepping once per free run too short for it. The network and
+    broadcast addresses of IPv4 subnets up to /30 and the subnet-router anycast address of IPv6 subnets up to
+    /126 are reserved and never handed out.
+    """
+
+    def __init__(self, network, prefixlen, data=None):
+        """
+        Bitmap of network int/prefixlen, empty or holding data, the bytes of a bitmap of the same subnet
+        Raises ValueError for a subnet of more than MAX_HOSTS addresses or data of the wrong size
+        """
+        self.network = network
+        self.prefixlen = prefixlen
+        self.size = block_size(network, prefixlen)
+        if self.size > MAX_HOSTS:
+            raise ValueError("Subnet of %d addresses is too large for host assignment" % self.size)
+        # usable offsets are lo to hi - 1
+        bits = max_prefixlen(network)
+        self.lo = 1 if prefixlen <= bits - 2 else 0
+        self.hi = self.size - 1 if bits == 32 and prefixlen <= 30 else self.size
+        length = (self.size + 7) // 8
+        if data is None:
+            self.data = bytearray(length)
+            self.used = 0
+        else:
+            if len(data) != length:
+                raise ValueError("Bitmap of %d bytes for a subnet of %d addresses" % (len(data), self.size))
+            self.data = bytearray(data)
+            self.used = _popcount(self.data)
+        # every usable offset below hint is assigned
+        self._hint = self.lo
+
+    def __len__(self):
+        return self.used
+
+    def counts(self):
+        """
+        Return dict of size, reserved, used and free address counts
+        """
+        reserved = self.size - (self.hi - self.lo)
+        return {"size": self.size, "reserved": reserved, "used": self.used,
+                "free": self.size - reserved - self.used}
+
+    def to_bytes(self):
+        return str(self.data)
+
+    def copy(self):
+        """
+        Return a HostBitmap of the same subnet and assigned addresses that can be changed independently
+        """
+        ret = copy.copy(self)
+        ret.data = bytearray(self.data)
+        return ret
+
+    def _next_clear(self, bit):
+        """
+        Return the first unassigned offset from bit, None if there is none below hi
+        """
+        byte = bit >> 3
+        if byte >= len(self.data):
+            return None
+        b = self.data[byte] | (0xff00 >> (bit & 7)) & 0xff
+        if b == 0xff:
+            m = _NOT_FULL.search(self.data, byte + 1)
+            if m is None:
+                return None
+            byte = m.start()
+            b = self.data[byte]
+        ret = byte * 8 + 8 - (~b & 0xff).bit_length()
+        return ret if ret < self.hi else None
+
+    def _next_set(self, bit):
+        """
+        Return the first assigned offset from bit, hi if there is none below hi
+        """
+        byte = bit >> 3
+        if byte >= len(self.data):
+            return self.hi
+        b = self.data[byte] & (0xff >> (bit & 7))
+        if not b:
+            m = _NOT_EMPTY.search(self.data, byte + 1)
+            if m is None:
+                return self.hi
+            byte = m.start()
+            b = self.data[byte]
+        return min(byte * 8 + 8 - b.bit_length(), self.hi)
+
+    def _fill(self, start, end, value):
+        """
+        Set (value 0xff) or clear (value 0) offsets start to end - 1
+        """
+        first, last = start >> 3, (end - 1) >> 3
+        if first == last:
+            mask = (0xff >> (start & 7)) & (0xff00 >> (((end - 1) & 7) + 1))
+            self.data[first] = (self.data[first] & ~mask) | (value & mask)
+            return
+        head = 0xff >> (start & 7)
+        self.data[first] = (self.data[first] & ~head) | (value & head)
+        self.data[first + 1:last] = chr(value) * (last - first - 1)
+        tail = (0xff00 >> (((end - 1) & 7) + 1)) & 0xff
+        self.data[last] = (self.data[last] & ~tail) | (value & tail)
+
+    def _offset(self, address, count):
+        offset = address - self.network
+        if not (self.lo <= offset and offset + count <= self.hi) or count < 1:
+            raise ValueError("%d addresses from %d are outside the usable addresses of the subnet" % (count, address))
+        return offset
+
+    def allocate(self, count=1):
+        """
+        Assign the first count contiguous free addresses, return the first of them, None if there is no room
+        """
+        if count < 1:
+            raise ValueError("Invalid number of addresses %d" % count)
+        start = self._next_clear(self._hint)
+        first = start
+        while start is not None:
+            end = self._next_set(start)
+            if end - start >= count:
+                self._fill(start, start + count, 0xff)
+                self.used += count
+                if start == first:
+                    self._hint = start + count
+                return self.network + start
+            start = self._next_clear(end)
+        return None
+
+    def assign(self, address, count=1):
+        """
+        Assign count addresses from address, raises AddressInUseError if one of them is already assigned
+        """
+        start = self._offset(address, count)
+        if self._next_set(start) < start + count:
+            raise AddressInUseError(address)
+        self._fill(start, start + count, 0xff)
+        self.used += count
+
+    def release(self, address, count=1):
+        """
+        Free count addresses from address, return the number of them that were assigned
+        """
+        start = self._offset(address, count)
+        first, last = start >> 3, (start + count - 1) >> 3
+        before = _popcount(self.data[first:last + 1])
+        self._fill(start, start + count, 0)
+        released = before - _popcount(self.data[first:last + 1])
+        self.used -= released
+        self._hint = min(self._hint, start)
+        return released
+
+    def is_assigned(self, address):
+        offset = address - self.network
+        if not 0 <= offset < self.size:
+            return False
+        return bool(self.data[offset >> 3] & (0x80 >> (offset & 7)))
+
+    def ranges(self):
+        """
+        Yield (first, last) addresses of the runs of assigned addresses
+        """
+        start = self._next_set(self.lo)
+        while start < self.hi:
+            end = self._next_clear(start)
+            end = self.hi if end is None else end
+            yield self.network + start, self.network + end - 1
+            start = self._next_set(end)
+
+    def rebase(self, network, prefixlen):
+        """
+        Return a HostBitmap of network int/prefixlen with the addresses assigned in this one
+        Raises ValueError if one of them is not a usable address of the new subnet
+        """
+        ret = HostBitmap(network, prefixlen)
+        for first, last in self.ranges():
+            ret.assign(first, last - first + 1)
+        return ret
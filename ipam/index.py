@@ -0,0 +1,465 @@
+import bisect
+import heapq
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from iputil import network_range, network_prefix, address_prefix, network_address, max_prefixlen
+
+"""
+Lookup structures kept alongside the domain etree
+"""
+
+class SiblingIndex:
+    """
+    Sorted interval index of the networks of a parent's children plus a case-folded name table.
+    Valid siblings never overlap, so the only candidate for an overlap with a new range is
+    the last sibling starting at or before the end of that range.
+    Nodes are etree elements or the int indexes of a NodeStore and are compared by equality.
+    """
+    def __init__(self, children=()):
+        self.starts = []
+        self.ends = []
+        self.nodes = []
+        self.names = {}
+        for c in children:
+            self.add(c)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add(self, node, network=None, name=None):
+        """
+        Index node, network and name default to the attributes set on node
+        A node whose network does not parse is indexed by name only
+        """
+        try:
+            start, end = network_range(network or node.get("network"))
+        except ValueError:
+            # invalid network, indexed by name only
+            start, end = None, None
+        self.add_range(node, start, end, name or node.get("name") or "")
+
+    def add_range(self, node, start, end, name):
+        """
+        Index node with integer range start to end and name, by name only if start is None
+        """
+        if start is not None:
+            i = bisect.bisect_right(self.starts, start)
+            self.starts.insert(i, start)
+            self.ends.insert(i, end)
+            self.nodes.insert(i, node)
+        self.names.setdefault(name.lower(), []).append(node)
+
+    def remove(self, node, network=None, name=None):
+        """
+        Drop node from the index, network and name must be the values node was indexed with
+        """
+        try:
+            start, end = network_range(network or node.get("network"))
+        except ValueError:
+            # invalid network, indexed by name only
+            start, end = None, None
+        self.remove_range(node, start, name or node.get("name") or "")
+
+    def remove_range(self, node, start, name):
+        """
+        Drop node indexed by add_range with start and name
+        """
+        if start is not None:
+            i = bisect.bisect_left(self.starts, start)
+            while i < len(self.nodes) and self.starts[i] == start:
+                if self.nodes[i] == node:
+                    del self.starts[i], self.ends[i], self.nodes[i]
+                    break
+                i += 1
+        key = name.lower()
+        nodes = self.names.get(key, [])
+        if node in nodes:
+            nodes.remove(node)
+            if not nodes:
+                del self.names[key]
+
+    def overlapping(self, network, exclude=None):
+        """
+        Return a sibling whose network overlaps network, None if there is no such sibling
+        """
+        return self.overlapping_range(*network_range(network), exclude=exclude)
+
+    def overlapping_range(self, start, end, exclude=None):
+        """
+        Return a sibling whose network overlaps integer range start to end, None if there is no such sibling
+        """
+        i = bisect.bisect_right(self.starts, end) - 1
+        while i >= 0 and self.ends[i] >= start:
+            if self.nodes[i] != exclude:
+                return self.nodes[i]
+            i -= 1
+        return None
+
+    def named(self, name, exclude=None):
+        """
+        Return a sibling with the same name as name ignoring case, None if there is no such sibling
+        """
+        for n in self.names.get(name.lower(), []):
+            if n != exclude:
+                return n
+        return None
+
+class NetworkTrie:
+    """
+    Binary radix trie over network prefixes for longest-prefix-match lookups, one per address family
+    Each trie node is a [zero, one, value] list, value being the domain node stored at that prefix
+    """
+    def __init__(self, nodes=()):
+        self.root = [None, None, None]
+        self.root6 = [None, None, None]
+        for n in nodes:
+            self.insert(n)
+
+    def insert(self, node, network=None):
+        """
+        Store node at the prefix of its network, replacing any node already stored there
+        Insert parents before children so that a child sharing its parent's network wins
+        """
+        self.insert_prefix(node, *network_prefix(network or node.get("network")))
+
+    def insert_prefix(self, node, address, prefixlen):
+        """
+        Store node at address/prefixlen
+        """
+        t, top = (self.root6, 127) if address >> 32 else (self.root, 31)
+        for bit in xrange(top, top - prefixlen, -1):
+            b = (address >> bit) & 1
+            if t[b] is None:
+                t[b] = [None, None, None]
+            t = t[b]
+        t[2] = node
+
+    def longest_match(self, address, prefixlen=32):
+        """
+        Return the node with the most specific network containing address/prefixlen, None if there is none
+        """
+        t, top = (self.root6, 127) if address >> 32 else (self.root, 31)
+        best = t[2]
+        for bit in xrange(top, top - prefixlen, -1):
+            t = t[(address >> bit) & 1]
+            if t is None:
+                break
+            if t[2] is not None:
+                best = t[2]
+        return best
+
+class RangeTable:
+    """
+    Flattened, sorted table of the (start, end, depth, node_id) ranges of a domain tree for
+    vectorized address resolution with numpy.
+    Nested ranges are cut into non-overlapping segments, each owned by the deepest node covering it,
+    so resolving an address is a single searchsorted over the segment boundaries.
+    Every node gets an id, ids maps nodes back to them, but only IPv4 networks get ranges: IPv6 addresses are
+    resolved with the NetworkTrie.
+    """
+    def __init__(self, root):
+        if numpy is None:
+            raise ImportError("numpy is required for RangeTable")
+        self.nodes = []
+        self.ids = {}
+        rows = []
+        stack = [(root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if not node.get("network"):
+                continue
+            try:
+                start, end = network_range(node.get("network"))
+            except ValueError:
+                # invalid network left out as by the NetworkTrie, its descendants still get ranges
+                stack.extend((c, depth + 1) for c in node)
+                continue
+            if not start >> 32:
+                rows.append((start, end, depth, len(self.nodes)))
+            self.ids[node] = len(self.nodes)
+            self.nodes.append(node)
+            stack.extend((c, depth + 1) for c in node)
+        rows.sort(key=lambda r: (r[0], -r[1], r[2]))
+        self.starts = numpy.array([r[0] for r in rows], dtype=numpy.uint32)
+        self.ends = numpy.array([r[1] for r in rows], dtype=numpy.uint32)
+        self.depths = numpy.array([r[2] for r in rows], dtype=numpy.uint16)
+        self.node_ids = numpy.array([r[3] for r in rows], dtype=numpy.int32)
+
+        bounds, owners, open_ranges = [], [], []
+        def cut(position, owner):
+            if bounds and bounds[-1] == position:
+                owners[-1] = owner
+            elif position <= 0xffffffff:
+                bounds.append(position)
+                owners.append(owner)
+        for start, end, depth, node_id in rows:
+            while open_ranges and open_ranges[-1][0] < start:
+                closed = open_ranges.pop()[0]
+                cut(closed + 1, open_ranges[-1][1] if open_ranges else -1)
+            cut(start, node_id)
+            open_ranges.append((end, node_id))
+        while open_ranges:
+            closed = open_ranges.pop()[0]
+            cut(closed + 1, open_ranges[-1][1] if open_ranges else -1)
+        self.bounds = numpy.array(bounds, dtype=numpy.uint32)
+        self.owners = numpy.array(owners, dtype=numpy.int32)
+
+    def resolve(self, addresses):
+        """
+        Return int32 array of node ids (indexes into self.nodes) owning each address of the uint32 array
+        addresses, -1 where no node covers an address
+        """
+        addresses = numpy.asarray(addresses, dtype=numpy.uint32)
+        i = numpy.searchsorted(self.bounds, addresses, side="right") - 1
+        ret = numpy.where(i >= 0, self.owners[i], -1)
+        return ret.astype(numpy.int32)
+
+def _dotted_lines(text, count):
+    """
+    Return True if text is count lines of four dot separated numbers
+    Checked with string operations running in C, the digits stripped out must leave exactly "..." per line
+    """
+    if isinstance(text, unicode):
+        text = text.encode("ascii", "replace")
+    if text.translate(None, "0123456789") != "\n".join(["..."] * count):
+        return False
+    return not (text.startswith(".") or text.endswith(".") or ".." in text or ".\n" in text or "\n." in text)
+
+def address_array(ips):
+    """
+    Return (uint32 numpy array, bool numpy array) of the addresses in ips and of which of them are valid
+    ips is a numpy array or a sequence of address strings, an address of a network string like 10.1.2.3/24 counts
+    Batches of dotted quads are parsed in bulk, anything else one string at a time; invalid strings and IPv6
+    addresses map to 0 and False
+    """
+    if numpy is None:
+        raise ImportError("numpy is required for address_array")
+    if isinstance(ips, numpy.ndarray):
+        return ips.astype(numpy.uint32, copy=False), numpy.ones(len(ips), dtype=bool)
+    ips = list(ips)
+    text = "\n".join(ips)
+    if ips and _dotted_lines(text, len(ips)):
+        octets = numpy.fromstring(text.replace(".", " ").replace("\n", " "), dtype=numpy.int64, sep=" ")
+        if len(octets) == 4 * len(ips):
+            octets = octets.reshape(-1, 4)
+            valid = (octets <= 255).all(axis=1)
+            ret = (octets[:, 0] << 24) | (octets[:, 1] << 16) | (octets[:, 2] << 8) | octets[:, 3]
+            return numpy.where(valid, ret, 0).astype(numpy.uint32), valid
+    ret = numpy.zeros(len(ips), dtype=numpy.uint32)
+    valid = numpy.zeros(len(ips), dtype=bool)
+    for i, ip in enumerate(ips):
+        ip = address_prefix(ip)
+        if ip is not None and not ip[0] >> 32:
+            ret[i] = ip[0]
+            valid[i] = True
+    return ret, valid
+
+class FreePool:
+    """
+    Buddy allocator style pool of the unused space of a node.
+    free[prefixlen] is the set of network ints of free blocks of that size, blocks are kept maximal (free buddies
+    are merged), so any free aligned block lies inside exactly one free block, found by clearing the host bits of
+    its address for each shorter prefixlen. heaps[version][prefixlen] holds the same blocks per address family as
+    a heap for the lowest free block, entries of blocks no longer free are dropped when they reach the top.
+    Reserving or releasing a block costs O(prefixlen) set operations and heap pushes, O(log n) each.
+    Blocks of both families can share the pool of the domain root.
+    """
+    def __init__(self, network, blocks=()):
+        self.start, self.end = network_range(network)
+        self.prefixlen = (129 if self.start >> 32 else 33) - (self.end - self.start + 1).bit_length()
+        self.free = [set() for _ in xrange(129)]
+        self.heaps = {4: [[] for _ in xrange(33)], 6: [[] for _ in xrange(129)]}
+        for net, plen in blocks:
+            self._add(net, plen)
+
+    def _add(self, net, prefixlen):
+        self.free[prefixlen].add(net)
+        heap = self.heaps[6 if net >> 32 else 4][prefixlen]
+        heapq.heappush(heap, net)
+        if len(heap) > 2 * len(self.free[prefixlen]) + 16:
+            # drop the entries of blocks reserved since they were pushed
+            heap[:] = set(n for n in heap if n in self.free[prefixlen])
+            heapq.heapify(heap)
+
+    def _lowest(self, version, prefixlen):
+        """
+        Return the lowest free block of version and prefixlen, None if there is none
+        """
+        heap = self.heaps[version][prefixlen]
+        free = self.free[prefixlen]
+        while heap and heap[0] not in free:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def find(self, prefixlen, strategy="first_fit", version=None):
+        """
+        Return network int of a free block of size prefixlen, None if there is no room
+        first_fit picks the lowest free address, best_fit carves from the smallest free block that fits
+        version is the address family (4 or 6) to allocate from, the family of the pool's network by default
+        Raises ValueError for a prefixlen that is not a valid prefix length of the family or an unknown strategy
+        """
+        if version is None:
+            version = 6 if self.start >> 32 else 4
+        bits = 128 if version == 6 else 32
+        if not isinstance(prefixlen, (int, long)) or isinstance(prefixlen, bool) or not 0 <= prefixlen <= bits:
+            raise ValueError("Invalid prefixlen %s for IPv%d" % (prefixlen, version))
+        if strategy not in ("first_fit", "best_fit"):
+            raise ValueError("Invalid allocation strategy %s" % strategy)
+        heads = []
+        for p in xrange(prefixlen, -1, -1):
+            net = self._lowest(version, p)
+            if net is not None:
+                if strategy == "best_fit":
+                    return net
+                heads.append(net)
+        return min(heads) if heads else None
+
+    def _containing(self, address, prefixlen):
+        """
+        Return (network int, prefixlen) of the free block containing address, None if address is not free
+        """
+        for p in xrange(min(prefixlen, max_prefixlen(address)), -1, -1):
+            net = network_address(address, p)
+            if net in self.free[p]:
+                return net, p
+        return None
+
+    def reserve(self, network):
+        """
+        Remove network from free space, splitting the free block holding it into buddies
+        """
+        address, prefixlen = network_prefix(network)
+        found = self._containing(address, prefixlen)
+        if found is None:
+            return False
+        net, p = found
+        self.free[p].discard(net)
+        bits = max_prefixlen(address)
+        while p < prefixlen:
+            p += 1
+            half = 1 << (bits - p)
+            if address >= net + half:
+                self._add(net, p)
+                net += half
+            else:
+                self._add(net + half, p)
+        return True
+
+    def release(self, network):
+        """
+        Return network to free space, merging it with its free buddies
+        """
+        net, p = network_prefix(network)
+        net = network_address(net, p)
+        bits = max_prefixlen(net)
+        while p > self.prefixlen:
+            buddy = net ^ (1 << (bits - p))
+            if buddy not in self.free[p]:
+                break
+            self.free[p].discard(buddy)
+            net = min(net, buddy)
+            p -= 1
+        self._add(net, p)
+
+class NodeBucket:
+    """
+    Insertion ordered set of the nodes sharing a NodeIndex key
+    Removal blanks the node's slot, slots are compacted once half of them are blank, so adding and removing
+    a node are O(1) amortized
+    """
+    def __init__(self):
+        self.nodes = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __iter__(self):
+        return (n for n in self.nodes if n is not None)
+
+    def add(self, node):
+        if node not in self.positions:
+            self.positions[node] = len(self.nodes)
+            self.nodes.append(node)
+
+    def discard(self, node):
+        i = self.positions.pop(node, None)
+        if i is None:
+            return
+        self.nodes[i] = None
+        if 2 * len(self.positions) < len(self.nodes):
+            self.nodes = [n for n in self.nodes if n is not None]
+            self.positions = dict((n, i) for i, n in enumerate(self.nodes))
+
+class NodeIndex:
+    """
+    Secondary indexes of the nodes of a domain tree by node type, case-folded name and exact network
+    Each key holds a NodeBucket, nodes are found in the order they were indexed. The keys every node was indexed
+    with are kept, so removing a node costs neither a search of its buckets nor parsing its network again
+    """
+    def __init__(self, root=None):
+        self.types = {}
+        self.names = {}
+        self.networks = {}
+        self.keys = {}
+        if root is not None:
+            self.add(root)
+
+    def _keys(self, node):
+        network = node.get("network")
+        try:
+            network = network_prefix(network) if network else None
+        except ValueError:
+            # invalid networks are reported by Domain.violations, the node is still found by type and name
+            network = None
+        return node.tag, (node.get("name") or "").lower(), network
+
+    def add(self, node, recursive=True):
+        """
+        Index node and all its descendants, only node if recursive is False
+        """
+        indexes = (self.types, self.names, self.networks)
+        for n in (node.iter() if recursive else [node]):
+            if isinstance(n.tag, basestring) and n not in self.keys:
+                keys = self.keys[n] = self._keys(n)
+                for index, key in zip(indexes, keys):
+                    bucket = index.get(key)
+                    if bucket is None:
+                        bucket = index[key] = NodeBucket()
+                    bucket.add(n)
+
+    def remove(self, node, recursive=True):
+        """
+        Drop node and all its descendants (only node if recursive is False)
+        """
+        indexes = (self.types, self.names, self.networks)
+        for n in (node.iter() if recursive else [node]):
+            keys = self.keys.pop(n, None)
+            if keys is not None:
+                for index, key in zip(indexes, keys):
+                    bucket = index.get(key)
+                    if bucket is not None:
+                        bucket.discard(n)
+                        if not bucket:
+                            del index[key]
+
+    def find(self, node_type="*", name=None, network=None):
+        """
+        Return nodes matching node_type (any if "*"), exact name and network (int, prefixlen) key
+        """
+        if name:
+            nodes = self.names.get(name.lower(), ())
+        elif network:
+            nodes = self.networks.get(network, ())
+        elif node_type != "*":
+            nodes = self.types.get(node_type, ())
+        else:
+            return [n for nodes in self.types.values() for n in nodes]
+        return [n for n in nodes
+                if (node_type == "*" or n.tag == node_type)
+                and (not name or n.get("name") == name)
+                and (not network or (n.get("network") and network_prefix(n.get("network")) == network))]
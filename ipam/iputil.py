@@ -0,0 +1,307 @@
+import collections
+import threading
+
+from ipaddr import IPNetwork
+
+"""
+Integer helpers for networks stored as strings on domain nodes
+IPv4 addresses are plain 32 bit ints and IPv6 addresses are keyed as V6 | address, so both families share one
+integer space without overlapping and IPv4 arithmetic stays on small ints
+"""
+
+V6 = 1 << 128
+IPV4_SPAN = (0, 0xffffffff)
+IPV6_SPAN = (V6, (V6 << 1) - 1)
+# span containing every network of both families, the span of the domain root in containment checks
+ADDRESS_SPACE = (IPV4_SPAN[0], IPV6_SPAN[1])
+
+class ParseCache:
+    """
+    Bounded LRU cache of network string to (network int, prefixlen) with hit and miss counters
+    Safe to share between threads, updates of the LRU order are done under a lock
+    """
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def parse(self, network):
+        """
+        Return (network int, prefixlen) for a network string accepted by IPNetwork
+        Raises ValueError for an invalid network, invalid networks are not cached
+        """
+        with self._lock:
+            ret = self._cache.pop(network, None)
+            if ret is not None:
+                self.hits += 1
+                self._cache[network] = ret
+                return ret
+            self.misses += 1
+        ret = address_prefix(network)
+        if ret is None:
+            net = IPNetwork(network)
+            ret = int(net.network) | (V6 if net.version == 6 else 0), net.prefixlen
+        else:
+            ret = network_address(*ret), ret[1]
+        with self._lock:
+            if network not in self._cache and len(self._cache) >= self.maxsize:
+                self._cache.popitem(last=False)
+            self._cache[network] = ret
+        return ret
+
+    def info(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._cache), "maxsize": self.maxsize}
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = 0
+
+parse_cache = ParseCache()
+
+def network_prefix(network):
+    """
+    Return (network int, prefixlen) for a network string accepted by IPNetwork
+    """
+    return parse_cache.parse(network)
+
+def network_range(network):
+    """
+    Return (first, last) integer addresses covered by network string
+    """
+    address, prefixlen = parse_cache.parse(network)
+    return address, address + block_size(address, prefixlen) - 1
+
+def max_prefixlen(address):
+    """
+    Return the prefixlen of a single address of the family of address int, 32 or 128
+    """
+    return 128 if address >> 32 else 32
+
+def block_size(address, prefixlen):
+    """
+    Return number of addresses in a network of prefixlen of the family of address int
+    """
+    return 1 << ((128 if address >> 32 else 32) - prefixlen)
+
+def network_address(address, prefixlen):
+    """
+    Return address int with the host bits of prefixlen cleared
+    """
+    return address & ~(block_size(address, prefixlen) - 1)
+
+def is_subnet(supernet, net):
+    """
+    Integer test of network string net lying inside network string supernet
+    """
+    s_first, s_last = network_range(supernet)
+    first, last = network_range(net)
+    return s_first <= first and last <= s_last
+
+def address_prefix(value):
+    """
+    Parse an address or network ("10.1.2.3", "10.1.2.0/24", "2001:db8::/32" or an int key) into
+    (address int, prefixlen)
+    Returns None instead of raising for anything that is not a valid IPv4 or IPv6 address or network
+    """
+    if isinstance(value, (int, long)):
+        if 0 <= value <= 0xffffffff:
+            return value, 32
+        return (value, 128) if V6 <= value <= IPV6_SPAN[1] else None
+    if not isinstance(value, basestring):
+        return None
+    address, _, prefixlen = value.partition("/")
+    if ":" in address:
+        n, bits = _v6_address(address), 128
+        if n is None:
+            return None
+        n |= V6
+    else:
+        n, bits = _v4_address(address), 32
+        if n is None:
+            return None
+    if prefixlen:
+        if not prefixlen.isdigit() or int(prefixlen) > bits:
+            return None
+        return n, int(prefixlen)
+    return n, bits
+
+def _v4_address(address):
+    """
+    Return int of dotted IPv4 address string, None if it is not one
+    """
+    octets = address.split(".")
+    if len(octets) != 4:
+        return None
+    n = 0
+    for o in octets:
+        if not o.isdigit() or len(o) > 3 or int(o) > 255:
+            return None
+        n = (n << 8) | int(o)
+    return n
+
+def _v6_words(text, last):
+    """
+    Return list of the 16 bit words of colon separated hex groups, None if they are invalid
+    With last set the final group can be a dotted IPv4 address, which makes two words
+    """
+    words = []
+    groups = text.split(":") if text else []
+    for i, g in enumerate(groups):
+        if last and i == len(groups) - 1 and "." in g:
+            n = _v4_address(g)
+            if n is None:
+                return None
+            words.extend((n >> 16, n & 0xffff))
+        elif 0 < len(g) <= 4 and not g.strip("0123456789abcdefABCDEF"):
+            words.append(int(g, 16))
+        else:
+            return None
+    return words
+
+def _v6_address(address):
+    """
+    Return int of IPv6 address string, None if it is not one
+    """
+    head, sep, tail = address.partition("::")
+    if sep:
+        left, right = _v6_words(head, False), _v6_words(tail, True)
+        if left is None or right is None or len(left) + len(right) > 7:
+            return None
+        words = left + [0] * (8 - len(left) - len(right)) + right
+    else:
+        words = _v6_words(address, True)
+        if words is None or len(words) != 8:
+            return None
+    n = 0
+    for w in words:
+        n = (n << 16) | w
+    return n
+
+def _v6_string(address):
+    """
+    Return IPv6 address int in the compressed form of RFC 5952, the first longest run of two or more
+    zero words written as "::"
+    """
+    words = [(address >> shift) & 0xffff for shift in xrange(112, -1, -16)]
+    start, length = -1, 1
+    i = 0
+    while i < 8:
+        if words[i]:
+            i += 1
+            continue
+        j = i
+        while j < 8 and not words[j]:
+            j += 1
+        if j - i > length:
+            start, length = i, j - i
+        i = j
+    groups = ["%x" % w for w in words]
+    if start < 0:
+        return ":".join(groups)
+    return ":".join(groups[:start]) + "::" + ":".join(groups[start + length:])
+
+def network_string(address, prefixlen):
+    """
+    Return "a.b.c.d/prefixlen" string for address int, the compressed IPv6 form for an IPv6 key
+    """
+    if address >> 32:
+        return "%s/%d" % (_v6_string(address & (V6 - 1)), prefixlen)
+    return "%d.%d.%d.%d/%d" % ((address >> 24) & 0xff, (address >> 16) & 0xff, (address >> 8) & 0xff, address & 0xff, prefixlen)
+
+def address_string(address):
+    """
+    Return address int as a dotted or compressed IPv6 string without prefixlen
+    """
+    return network_string(address, 0).partition("/")[0]
+
+def subnets(address, prefixlen, new_prefixlen):
+    """
+    Yield network ints of the new_prefixlen subnets of address/prefixlen in address order
+    """
+    step = block_size(address, new_prefixlen)
+    end = address + block_size(address, prefixlen)
+    if not address >> 32:
+        for n in xrange(address, end, step):
+            yield n
+        return
+    # IPv6 keys do not fit the C long of xrange
+    while address < end:
+        yield address
+        address += step
+
+def range_cidrs(start, end):
+    """
+    Yield (network int, prefixlen) of the minimal list of CIDR blocks covering start to end inclusive
+    """
+    while start <= end:
+        # largest block aligned on start that does not go past end
+        size = min((start & -start) or (1 << 32), 1 << ((end - start + 1).bit_length() - 1))
+        yield start, (129 if start >> 32 else 33) - size.bit_length()
+        start += size
+
+def free_ranges(start, end, ranges):
+    """
+    Yield (first, last) integer gaps left in start to end by sorted (first, last) ranges
+    """
+    cursor = start
+    for first, last in ranges:
+        if first > cursor:
+            yield cursor, min(first - 1, end)
+        cursor = max(cursor, last + 1)
+        if cursor > end:
+            return
+    if cursor <= end:
+        yield cursor, end
+
+def overlapping_ranges(ranges):
+    """
+    Yield (item, other) for every item of (first, last, item) ranges overlapping a range before it
+    in (first, -last) order, other being the range reaching furthest among those
+    """
+    reach, widest = -1, None
+    for first, last, item in sorted(ranges, key=lambda r: (r[0], -r[1])):
+        if first <= reach:
+            yield item, widest
+        if last > reach:
+            reach, widest = last, item
+
+def free_summary(start, end, ranges):
+    """
+    Return (number of free addresses, prefixlen of the largest free CIDR block or None) left in start to end
+    by sorted (first, last) ranges
+    """
+    free, largest = 0, None
+    for first, last in free_ranges(start, end, ranges):
+        free += last - first + 1
+        for net, plen in range_cidrs(first, last):
+            if largest is None or plen < largest:
+                largest = plen
+    return free, largest
+
+def root_spans(ranges):
+    """
+    Return list of the (first, last) spans of the domain root given the sorted ranges of its children:
+    the IPv4 space, and the IPv6 space as well once a child has an IPv6 network
+    """
+    if ranges and ranges[-1][0] >= V6:
+        return [IPV4_SPAN, IPV6_SPAN]
+    return [IPV4_SPAN]
+
+def spans_summary(spans, ranges):
+    """
+    Return (free addresses, prefixlen of the largest free block or None, number of addresses of that block)
+    left in spans by sorted ranges, the largest block of spans of both families being compared by size
+    """
+    free, largest, size = 0, None, 0
+    for start, end in spans:
+        f, plen = free_summary(start, end, ranges)
+        free += f
+        if plen is not None and block_size(start, plen) > size:
+            largest, size = plen, block_size(start, plen)
+    return free, largest, size
@@ -0,0 +1,60 @@
+import multiprocessing
+import multiprocessing.pool
+
+from lxml import etree
+
+from store import NodeStore
+
+"""
+Process pool execution of domain analyses over the independent subtrees of top level nodes
+Subtrees are shipped to workers as xml serialized by libxml2 and loaded into a NodeStore there, so the parent
+does no per node work in python, and results come back as lists in the document order of each subtree
+"""
+
+def _load(work):
+    groups, xml = work
+    store = NodeStore(groups=groups)
+    store.import_elements(0, [etree.fromstring(xml)])
+    return store
+
+def subtree_violations(work):
+    """
+    Return (position, kind, detail) of the violations found under a subtree, position counting the nodes of
+    the subtree in document order
+    """
+    store = _load(work)
+    return [(v.node - 1, v.kind, v.detail) for v in store.violations(1)]
+
+def subtree_free_space(work):
+    """
+    Return list of (free addresses, prefixlen of the largest free block or None) of the nodes of a subtree
+    in document order
+    """
+    store = _load(work)
+    return [store.free_summary(i) for i in store.nodes(1)]
+
+def map_subtrees(func, groups, nodes, processes=None):
+    """
+    Return list of func applied to each of nodes and its subtree in worker processes, in the order of nodes
+    processes is the number of workers (one per cpu by default) or a multiprocessing Pool to reuse
+    """
+    work = [(groups, etree.tostring(n, with_tail=False)) for n in nodes]
+    # largest subtrees first so that one late large subtree does not leave the other workers idle
+    order = sorted(xrange(len(work)), key=lambda i: -len(work[i][1]))
+    pool = processes if isinstance(processes, multiprocessing.pool.Pool) else multiprocessing.Pool(processes)
+    try:
+        results = pool.map(func, [work[i] for i in order], chunksize=1)
+    finally:
+        if pool is not processes:
+            pool.close()
+            pool.join()
+    ret = [None] * len(work)
+    for i, result in zip(order, results):
+        ret[i] = result
+    return ret
+
+def subtree_elements(node):
+    """
+    Return list of node and its descendant elements in document order, as numbered by the workers
+    """
+    return [e for e in node.iter() if isinstance(e.tag, basestring)]
@@ -1,5 +1,7 @@
 import json
 
+import redis
+
 class DomainAlreadyExistsError(Exception):
     pass
 
@@ -12,13 +14,20 @@ class InvalidGroupError(Exception):
 class InvalidDomainError(Exception):
     pass
 
+# groups read by this process per schema hash: schema_name -> (version, {domain: groups}), valid while the
+# version counter of the schema is unchanged
+_cache = {}
+
 class Schema:
     """
     Container class for schema file for domains
+    In redis the schema is a hash with a json list of groups per domain and a version counter bumped by every
+    write, domains are read field by field and kept in a per-process cache until the counter changes
     """
-    def __init__(self, file=None, json_str="", redisdb=None, schema_name=None):
+    def __init__(self, file=None, json_str="", redisdb=None, schema_name=None, version=None):
         """
         Open schema file containing domain definitions
+        version is the value of the version counter when the caller already read it
         """
         self.file = file
         self.json_str = json_str
@@ -26,16 +35,16 @@ class Schema:
         self.redisdb = redisdb
         self.schema_name = schema_name
         if self.redisdb is not None and self.schema_name is not None:
-            schema = redisdb.get(self.schema_name)
-            try:
-                if schema is None or not isinstance(json.loads(schema), dict):
-                    self.redisdb.set(self.schema_name, "{}")
-                    schema = "{}"
-            except ValueError, e:
-                print "ValueError"
-                self.redisdb.set(self.schema_name, "{}")
-                schema = "{}"
-            self.domains = json.loads(schema)
+            self.version_key = "%s:version" % self.schema_name
+            if version is None:
+                version = self.redisdb.get(self.version_key)
+            if version is None:
+                version = self._migrate()
+            entry = _cache.get(self.schema_name)
+            if entry is None or entry[0] != version:
+                entry = _cache[self.schema_name] = (version, {})
+            self.version = version
+            self.domains = entry[1]
         elif json_str:
             try:
                 self.domains = json.loads(self.json_str)
@@ -47,30 +56,85 @@ class Schema:
             except IOError as e:
                 pass
 
+    def _migrate(self):
+        """
+        Convert a schema kept as one json string to a hash and start its version counter
+        Return the version counter
+        """
+        with self.redisdb.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(self.schema_name, self.version_key)
+                    domains = {}
+                    if pipe.type(self.schema_name) in ("string", b"string"):
+                        try:
+                            domains = json.loads(pipe.get(self.schema_name))
+                        except ValueError:
+                            print "ValueError"
+                        if not isinstance(domains, dict):
+                            domains = {}
+                    pipe.multi()
+                    if domains:
+                        pipe.delete(self.schema_name)
+                        pipe.hmset(self.schema_name, dict((k, json.dumps(v)) for k, v in domains.items()))
+                    elif pipe.type(self.schema_name) not in ("hash", b"hash"):
+                        pipe.delete(self.schema_name)
+                    pipe.setnx(self.version_key, 1)
+                    pipe.get(self.version_key)
+                    return pipe.execute()[-1]
+                except redis.WatchError:
+                    continue
+
+    def _changed(self, version):
+        """
+        Record version returned by the INCR of a write of this process
+        """
+        _cache.pop(self.schema_name, None)
+        self.version = str(version)
+
     def update_redisdb(self):
-        self.redisdb.set(self.schema_name, json.dumps(self.domains))
+        with self.redisdb.pipeline() as pipe:
+            if self.domains:
+                pipe.hmset(self.schema_name, dict((k, json.dumps(v)) for k, v in self.domains.items()))
+            pipe.incr(self.version_key)
+            self._changed(pipe.execute()[-1])
 
     def new_domain(self, domain):
         """
         Create new domain
         """
+        if self.redisdb:
+            # HSETNX lets exactly one of concurrent creators of domain succeed
+            with self.redisdb.pipeline() as pipe:
+                pipe.hsetnx(self.schema_name, domain, "[]")
+                pipe.incr(self.version_key)
+                created, version = pipe.execute()
+            self._changed(version)
+            if not created:
+                raise DomainAlreadyExistsError
+            self.domains[domain] = []
+            return
         if domain in self.domains:
             raise DomainAlreadyExistsError
         self.domains[domain] = []
-        if self.redisdb:
-            self.update_redisdb() 
 
     def get_domains(self):
+        if self.redisdb:
+            return self.redisdb.hkeys(self.schema_name)
         return self.domains.keys()
 
     def get_groups(self, domain):
+        if self.redisdb and domain not in self.domains:
+            groups = self.redisdb.hget(self.schema_name, domain)
+            if groups is not None:
+                self.domains[domain] = json.loads(groups)
         try:
             return self.domains[domain]
         except KeyError as e:
             #raise DomainDoesNotExistError
             return {}
         #return self.domains.keys()
-                                                                                                                          
+
     def update_domain(self, domain, groups):
         try:
             if not isinstance(groups, list):
@@ -78,16 +142,27 @@ class Schema:
             # must also test list to only have unique elements
             self.domains[domain] = groups
             if self.redisdb:
-                self.update_redisdb()
+                # only the field of domain is written, concurrent writers of other domains are not overwritten
+                with self.redisdb.pipeline() as pipe:
+                    pipe.hset(self.schema_name, domain, json.dumps(groups))
+                    pipe.incr(self.version_key)
+                    self._changed(pipe.execute()[-1])
         except KeyError:
             raise DomainDoesNotExistError
 
     def delete_domain(self, domain):
+        if self.redisdb:
+            with self.redisdb.pipeline() as pipe:
+                pipe.hget(self.schema_name, domain)
+                pipe.hdel(self.schema_name, domain)
+                pipe.incr(self.version_key)
+                tmp, deleted, version = pipe.execute()
+            self._changed(version)
+            self.domains.pop(domain, None)
+            return json.loads(tmp) if deleted else None
         if domain in self.domains:
             tmp = self.domains[domain]
             del self.domains[domain]
-            if self.redisdb:
-                self.update_redisdb()
             return tmp
         else:
             return None
@@ -0,0 +1,387 @@
+import itertools
+import json
+import mmap
+import os
+import struct
+
+from lxml import etree
+
+from iputil import address_prefix, network_string, network_address, block_size, V6
+
+"""
+Versioned binary snapshot of a domain, read through mmap without parsing
+"""
+
+MAGIC = "IPAMSNAP"
+FORMAT_VERSION = 3
+# format versions read, version 1 has no IPv6 networks and a zero byte in place of the wide flag, versions 1
+# and 2 have no lookup tables and are read by scanning the records
+FORMAT_VERSIONS = (1, 2, 3)
+# magic, format version, node count, metadata length, records offset, strings offset
+HEADER = struct.Struct("<8sHxxIIQQ")
+# parent, end of subtree (index past the last descendant), network, name offset, group, prefixlen, wide flag,
+# flags (OVERLAPPING, zero before version 3)
+# network of a record with the wide flag set is the index of its IPv6 address in the address table
+RECORD = struct.Struct("<iiIIBBBB")
+# flag of a node whose children have overlapping networks
+OVERLAPPING = 1
+# flag of a node with an invalid network attribute, stored as 0.0.0.0/0 and left out of network lookups
+INVALID = 2
+NAME_LEN = struct.Struct("<H")
+# IPv6 address as two big endian halves
+ADDRESS = struct.Struct(">QQ")
+# entry of a lookup table, the index of a node
+ENTRY = struct.Struct("<I")
+# lookup tables at the end of the file, in this order, each holding every node index sorted by the key named,
+# ties in document order
+TABLES = ("group", "name", "network", "child_name", "child_start")
+
+class SnapshotError(Exception):
+    pass
+
+def _utf8(name):
+    return name.encode("utf-8") if isinstance(name, unicode) else name
+
+def write_snapshot(f, store):
+    """
+    Write NodeStore store to file object f
+    Nodes are written in document order, so the children of node i are i + 1, end(i + 1), end(end(i + 1))...
+    up to end(i), the IPv6 networks in the address table after the records, every unique name once in
+    the string table after that and the TABLES last
+    Network attributes that are invalid or not written the way get_network writes them are kept in the metadata
+    """
+    order = list(store.nodes())
+    position = dict((n, i) for i, n in enumerate(order))
+    ends = [0] * len(order)
+    for i in xrange(len(order) - 1, -1, -1):
+        children = store._children[order[i]]
+        ends[i] = ends[position[children[-1]]] if children else i + 1
+
+    strings = []
+    offsets = {}
+    encoded = {}
+    size = 0
+    for n in order:
+        name = store.get_name(n)
+        if name not in offsets:
+            data = encoded[name] = name.encode("utf-8")
+            offsets[name] = size
+            strings.append(NAME_LEN.pack(len(data)) + data)
+            size += NAME_LEN.size + len(data)
+
+    names = [encoded[store.get_name(n)] for n in order]
+    invalid = set(position[n] for n in store._invalid if n in position)
+    # invalid networks sort before any valid one and never match a network key
+    starts = [-1 if i in invalid else store.get_range(n)[0] for i, n in enumerate(order)]
+    prefixlens = [-1 if i in invalid else store.prefixlen[n] for i, n in enumerate(order)]
+    parents = [position[store.parent[n]] if store.parent[n] >= 0 else -1 for n in order]
+    keys = {
+        "group": lambda i: store.group[order[i]],
+        "name": lambda i: names[i],
+        "network": lambda i: (starts[i], prefixlens[i]),
+        "child_name": lambda i: (parents[i], names[i]),
+        "child_start": lambda i: (parents[i], starts[i]),
+        }
+    tables = [sorted(xrange(len(order)), key=lambda i: (keys[t](i), i)) for t in TABLES]
+    networks = dict((str(position[n]), store.get_network(n))
+            for n in itertools.chain(store._invalid, store._raw) if n in position)
+    overlapping = set()
+    for n in order:
+        last = -1
+        for first, end in sorted(store.get_range(c) for c in store._children[n] if c not in store._invalid):
+            if first <= last:
+                overlapping.add(n)
+                break
+            last = end
+
+    wide = [n for n in order if n in store.wide]
+    wide_ids = dict((n, i) for i, n in enumerate(wide))
+    meta = json.dumps({"domain": store.domain, "version": str(store.version), "timestamp": str(store.timestamp),
+            "schema": store.schema_name, "tags": store.tags, "ngroups": store.ngroups, "tables": TABLES,
+            "networks": networks})
+    records = HEADER.size + len(meta)
+    records += -records % 8
+    strings_offset = records + RECORD.size * len(order) + ADDRESS.size * len(wide)
+    f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(order), len(meta), records, strings_offset))
+    f.write(meta)
+    f.write("\0" * (records - HEADER.size - len(meta)))
+    for i, n in enumerate(order):
+        parent = store.parent[n]
+        is_wide = n in wide_ids
+        f.write(RECORD.pack(position[parent] if parent >= 0 else -1, ends[i],
+                wide_ids[n] if is_wide else store.network[n], offsets[store.get_name(n)], store.group[n],
+                store.prefixlen[n], is_wide, (OVERLAPPING if n in overlapping else 0) | (INVALID if i in invalid else 0)))
+    for n in wide:
+        address = store.wide[n] & (V6 - 1)
+        f.write(ADDRESS.pack(address >> 64, address & 0xffffffffffffffff))
+    for s in strings:
+        f.write(s)
+    for table in tables:
+        f.write(struct.pack("<%dI" % len(table), *table))
+
+class Snapshot:
+    """
+    Read-only view of a snapshot file with the read methods of NodeStore
+    Records are unpacked from the mapped file on access, so opening a snapshot costs one header read however
+    large the domain, and workers mapping the same file share its pages
+    find_path, lookup and get_node binary search the lookup tables, reading O(log n) records per step
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            stat = os.fstat(f.fileno())
+        # identity of the file mapped, changing when a new snapshot is renamed over path
+        self.file_id = (stat.st_dev, stat.st_ino, stat.st_mtime)
+        if len(self._map) < HEADER.size:
+            raise SnapshotError("%s is too short" % path)
+        magic, fmt, self.count, meta_len, self._records, self._strings = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise SnapshotError("%s is not a snapshot" % path)
+        if fmt not in FORMAT_VERSIONS:
+            raise SnapshotError("Unsupported snapshot format %s" % fmt)
+        meta = json.loads(self._map[HEADER.size:HEADER.size + meta_len])
+        self._addresses = self._records + RECORD.size * self.count
+        self.path = path
+        self.domain = meta["domain"]
+        self.version = meta["version"]
+        self.timestamp = meta["timestamp"]
+        self.schema_name = meta["schema"]
+        self.tags = meta["tags"]
+        self.ngroups = meta["ngroups"]
+        # network attribute of invalid nodes and of networks not written the way get_network writes them
+        self._networks = dict((int(i), network) for i, network in meta.get("networks", {}).items())
+        # offset of each lookup table, none for snapshots written before version 3
+        tables = meta.get("tables", [])
+        start = len(self._map) - ENTRY.size * self.count * len(tables)
+        self._tables = dict((t, start + ENTRY.size * self.count * i) for i, t in enumerate(tables))
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return "%s:%s" % (self.domain, self.version)
+
+    def close(self):
+        self._map.close()
+
+    def _record(self, node):
+        if not 0 <= node < self.count:
+            raise IndexError(node)
+        return RECORD.unpack_from(self._map, self._records + RECORD.size * node)
+
+    def _address(self, record):
+        """
+        Return network int of record, reading the address table for an IPv6 network
+        """
+        if not record[6]:
+            return record[2]
+        high, low = ADDRESS.unpack_from(self._map, self._addresses + ADDRESS.size * record[2])
+        return V6 | high << 64 | low
+
+    def _entry(self, table, i):
+        return ENTRY.unpack_from(self._map, table + ENTRY.size * i)[0]
+
+    def _search(self, table, key, target):
+        """
+        Return the first position in table whose node has key(node) >= target
+        """
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key(self._entry(table, mid)) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _matching(self, table, key, target):
+        """
+        Return list of nodes in table with key(node) == target, in document order
+        """
+        ret = []
+        for i in xrange(self._search(table, key, target), self.count):
+            node = self._entry(table, i)
+            if key(node) != target:
+                break
+            ret.append(node)
+        return ret
+
+    def _name_bytes(self, node):
+        """
+        Return name of node as utf-8 bytes
+        """
+        offset = self._strings + self._record(node)[3]
+        size = NAME_LEN.unpack_from(self._map, offset)[0]
+        offset += NAME_LEN.size
+        return self._map[offset:offset + size]
+
+    def _network_key(self, node):
+        record = self._record(node)
+        if record[7] & INVALID:
+            return -1, -1
+        return self._address(record), record[5]
+
+    def _child_name_key(self, node):
+        return self._record(node)[0], self._name_bytes(node)
+
+    def _child_start_key(self, node):
+        record = self._record(node)
+        return record[0], -1 if record[7] & INVALID else self._address(record)
+
+    def nodes(self, node=0):
+        """
+        Yield index of node and all its descendants in document order
+        """
+        return iter(xrange(node, self._record(node)[1]))
+
+    def children(self, node):
+        ret = []
+        end = self._record(node)[1]
+        child = node + 1
+        while child < end:
+            ret.append(child)
+            child = self._record(child)[1]
+        return ret
+
+    def get_parent(self, node):
+        return self._record(node)[0]
+
+    def node_type(self, node):
+        return self.tags[self._record(node)[4]]
+
+    def get_name(self, node):
+        return self._name_bytes(node).decode("utf-8")
+
+    def get_network(self, node):
+        if node in self._networks:
+            return self._networks[node]
+        record = self._record(node)
+        return network_string(self._address(record), record[5])
+
+    def get_range(self, node):
+        """
+        Return (first, last) integer addresses of node's network
+        """
+        record = self._record(node)
+        address = self._address(record)
+        return address, address + block_size(address, record[5]) - 1
+
+    def get_path(self, node):
+        """
+        Return hierarchical path of node, names of its ancestors below the domain root and its own name joined by ">"
+        """
+        names = []
+        while node > 0:
+            names.append(self.get_name(node))
+            node = self.get_parent(node)
+        return ">".join(reversed(names))
+
+    def find_path(self, path):
+        """
+        Return index of the node at hierarchical path, None if there is no such node
+        """
+        node = 0
+        table = self._tables.get("child_name")
+        for name in path and path.split(">") or []:
+            if table is not None:
+                match = self._matching(table, self._child_name_key, (node, _utf8(name)))[:1]
+            else:
+                match = [c for c in self.children(node) if self.get_name(c) == name][:1]
+            if not match:
+                return None
+            node = match[0]
+        return node
+
+    def get_node(self, node_type="*", name=None, network=None):
+        """
+        Return indexes of nodes with given properties
+        """
+        group = None
+        if node_type != "*":
+            if node_type not in self.tags:
+                return []
+            group = self.tags.index(node_type)
+        prefix = None
+        if network:
+            prefix = address_prefix(network)
+            if prefix is None:
+                return []
+            prefix = (network_address(*prefix), prefix[1])
+        if name and "name" in self._tables:
+            candidates = self._matching(self._tables["name"], self._name_bytes, _utf8(name))
+        elif prefix and "network" in self._tables:
+            candidates = self._matching(self._tables["network"], self._network_key, prefix)
+        elif group is not None and "group" in self._tables:
+            candidates = self._matching(self._tables["group"], lambda n: self._record(n)[4], group)
+        else:
+            candidates = xrange(self.count)
+        ret = []
+        for i in candidates:
+            record = self._record(i)
+            if group is not None and record[4] != group:
+                continue
+            if prefix and (self._address(record), record[5]) != prefix:
+                continue
+            if name and self.get_name(i) != name:
+                continue
+            ret.append(i)
+        return ret
+
+    def lookup(self, ip):
+        """
+        Return index of the most specific node whose network contains ip, None for an invalid ip
+        Descends from the root through the child containing ip at each level, the child starting last at or
+        before ip unless the children of the level overlap
+        """
+        ret = address_prefix(ip)
+        if ret is None:
+            return None
+        first, last = ret[0], ret[0] + block_size(*ret) - 1
+        table = self._tables.get("child_start")
+        node = 0
+        while True:
+            if table is not None and not self._record(node)[7] & OVERLAPPING:
+                i = self._search(table, self._child_start_key, (node, first + 1)) - 1
+                children = [self._entry(table, i)] if i >= 0 else []
+            else:
+                children = self.children(node)
+            for c in children:
+                record = self._record(c)
+                if record[0] != node or record[7] & INVALID:
+                    continue
+                c_first, c_last = self.get_range(c)
+                if c_first <= first and last <= c_last:
+                    node = c
+                    break
+            else:
+                return node
+
+    def to_element(self, node=0):
+        """
+        Export node and its descendants as etree element, the domain root element for node 0
+        """
+        if node == 0:
+            e = etree.Element("domain", name=self.domain or "", timestamp=self.timestamp,
+                    version=self.version, schema=self.schema_name or "")
+            e.set("network", "0.0.0.0/0")
+        else:
+            e = etree.Element(self.node_type(node), name=self.get_name(node))
+            self._set_network(e, node)
+        stack = [(e, node)]
+        while stack:
+            parent, i = stack.pop()
+            for c in self.children(i):
+                child = etree.SubElement(parent, self.node_type(c), name=self.get_name(c))
+                self._set_network(child, c)
+                stack.append((child, c))
+        return e
+
+    def _set_network(self, e, node):
+        # a missing network attribute stays missing
+        network = self.get_network(node)
+        if network is not None:
+            e.set("network", network)
+
+    def xml(self):
+        return etree.tostring(self.to_element())
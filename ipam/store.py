@@ -0,0 +1,578 @@
+import time
+from array import array
+
+from lxml import etree
+
+from domain import (Domain, Violation, InvalidIPError, AssignedIPnotinSubnet, InvalidNodeTypeError,
+        ConfirmDeleteNodeError, DuplicateSiblingError, InvalidNodeNameError)
+from index import NetworkTrie, SiblingIndex
+from iputil import (address_prefix, network_prefix, network_string, range_cidrs, free_ranges,
+        overlapping_ranges, block_size, network_address, root_spans, subnets, free_summary, spans_summary,
+        ADDRESS_SPACE)
+
+"""
+Array backed alternative to the etree representation of a domain
+"""
+
+REMOVED = -2
+
+class NodeStore:
+    """
+    Container class for the nodes of a domain kept in parallel arrays instead of etree elements.
+    Node i has parent index parent[i] (-1 for the domain root at index 0), node type tags[group[i]],
+    network network[i]/prefixlen[i] as integers and name names[name[i]] from an interned string table.
+    IPv6 networks do not fit the 32 bit network array, their keys are held in the wide dict instead.
+    Nodes are referred to by index, lxml is only used to import and export the same xml as Domain.
+    """
+
+    def __init__(self, domain=None, groups=None, root=None, raw_xml="", schema_name="", xml_file=None):
+        """
+        Initialize store with domain name, or import it from an etree root element, xml string or xml file
+        """
+        self.domain = domain
+        self.tags = ["domain"] + (groups and list(groups) or [])
+        self.ngroups = len(self.tags)
+        self.version = 1
+        self.timestamp = str(int(time.time()))
+        self.schema_name = schema_name
+        self.parent = array("i")
+        self.group = array("B")
+        self.network = array("I")
+        # node to IPv6 network key, network[node] being 0
+        self.wide = {}
+        self.prefixlen = array("B")
+        self.name = array("i")
+        self.names = []
+        self._name_ids = {}
+        self._children = []
+        self._removed = 0
+        self._trie = None
+        # SiblingIndex of the children of a parent and (groups, names, networks) indexes of all nodes, built on
+        # first use
+        self._siblings = {}
+        self._index = None
+        # network attribute of nodes imported with an invalid network, stored as 0.0.0.0/0
+        self._invalid = {}
+        # network attribute of nodes whose network is not written the way get_network writes it, as in 10.0.0.1/8
+        self._raw = {}
+
+        if raw_xml:
+            root = etree.fromstring(raw_xml)
+        if root is not None:
+            self.domain = root.get("name")
+            self.version = root.get("version") or self.version
+            self.timestamp = root.get("timestamp") or self.timestamp
+            self.schema_name = root.get("schema") or self.schema_name
+            self._append(-1, "domain", 0, 0, self.domain or "", "0.0.0.0/0")
+            self.import_elements(0, root)
+        elif xml_file is not None:
+            self._load_stream(xml_file)
+        else:
+            self._append(-1, "domain", 0, 0, self.domain or "", "0.0.0.0/0")
+
+    def _load_stream(self, xml_file):
+        """
+        Import xml file name or file object with iterparse, clearing every element once it is stored
+        so that memory use is bounded by the arrays and not by the size of the document
+        """
+        stack = []
+        for event, e in etree.iterparse(xml_file, events=("start", "end")):
+            if event == "end":
+                stack.pop()
+                e.clear()
+                while e.getprevious() is not None:
+                    del e.getparent()[0]
+                continue
+            if not stack:
+                self.domain = e.get("name")
+                self.version = e.get("version") or self.version
+                self.timestamp = e.get("timestamp") or self.timestamp
+                self.schema_name = e.get("schema") or self.schema_name
+                stack.append(self._append(-1, "domain", 0, 0, self.domain or "", "0.0.0.0/0"))
+                continue
+            network = e.get("network")
+            try:
+                # an empty network is the whole space, a missing one is invalid as in Domain.violations
+                address, prefixlen = network_prefix(network == "" and "0.0.0.0/0" or network)
+            except ValueError:
+                address, prefixlen = None, 0
+            stack.append(self._append(stack[-1], e.tag, address, prefixlen, e.get("name") or "", network))
+
+    def import_elements(self, parent, elements):
+        """
+        Append etree elements and their descendants under parent index, in document order
+        """
+        stack = [(e, parent) for e in reversed(elements)]
+        while stack:
+            e, parent = stack.pop()
+            if not isinstance(e.tag, basestring):
+                continue
+            network = e.get("network")
+            try:
+                # an empty network is the whole space, a missing one is invalid as in Domain.violations
+                address, prefixlen = network_prefix(network == "" and "0.0.0.0/0" or network)
+            except ValueError:
+                address, prefixlen = None, 0
+            i = self._append(parent, e.tag, address, prefixlen, e.get("name") or "", network)
+            stack.extend((c, i) for c in reversed(e))
+
+    def __len__(self):
+        return len(self.parent) - self._removed
+
+    def __repr__(self):
+        return "%s:%s" % (self.domain, self.version)
+
+    def _intern(self, name):
+        i = self._name_ids.get(name)
+        if i is None:
+            i = self._name_ids[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+    def _tag_id(self, tag):
+        try:
+            return self.tags.index(tag)
+        except ValueError:
+            # kept for export, reported by violations
+            self.tags.append(tag)
+            return len(self.tags) - 1
+
+    def _append(self, parent, tag, address, prefixlen, name, network):
+        """
+        Append node without any validation, return its index
+        network is the network attribute of the node or None if it has none, address None if it is invalid
+        """
+        i = len(self.parent)
+        invalid = address is None
+        if invalid:
+            address, prefixlen = 0, 0
+        self.parent.append(parent)
+        self.group.append(self._tag_id(tag))
+        self.network.append(0)
+        self.prefixlen.append(prefixlen)
+        self._set_address(i, network_address(address, prefixlen))
+        self.name.append(self._intern(name))
+        self._set_written(i, network, invalid)
+        self._children.append([])
+        if parent >= 0:
+            self._children[parent].append(i)
+            if parent in self._siblings:
+                self._sibling_add(self._siblings[parent], i)
+        if self._trie is not None and not invalid:
+            self._trie.insert_prefix(i, self.get_address(i), prefixlen)
+        if self._index is not None:
+            self._index_node(i)
+        return i
+
+    def _set_written(self, node, network, invalid=False):
+        """
+        Keep network attribute of node for export if it is invalid or not written the way get_network writes it
+        """
+        self._invalid.pop(node, None)
+        self._raw.pop(node, None)
+        if invalid:
+            self._invalid[node] = network
+        elif network != network_string(self.get_address(node), self.prefixlen[node]):
+            self._raw[node] = network
+
+    def _set_address(self, node, address):
+        if address >> 32:
+            self.wide[node] = address
+            self.network[node] = 0
+        else:
+            self.wide.pop(node, None)
+            self.network[node] = address
+
+    def get_address(self, node):
+        """
+        Return network int of node, the IPv6 key for an IPv6 network
+        """
+        if self.wide and node in self.wide:
+            return self.wide[node]
+        return self.network[node]
+
+    def nodes(self, node=0):
+        """
+        Yield index of node and all its descendants in document order
+        """
+        stack = [node]
+        while stack:
+            i = stack.pop()
+            yield i
+            stack.extend(reversed(self._children[i]))
+
+    def children(self, node):
+        return self._children[node][:]
+
+    def get_parent(self, node):
+        return self.parent[node]
+
+    def node_type(self, node):
+        return self.tags[self.group[node]]
+
+    def get_name(self, node):
+        return self.names[self.name[node]]
+
+    def get_network(self, node):
+        """
+        Return network attribute of node, as it was imported or given to add_node or set_node
+        """
+        if node in self._raw:
+            return self._raw[node]
+        if node in self._invalid:
+            return self._invalid[node]
+        return network_string(self.get_address(node), self.prefixlen[node])
+
+    def get_range(self, node):
+        """
+        Return (first, last) integer addresses of node's network
+        """
+        address = self.get_address(node)
+        return address, address + block_size(address, self.prefixlen[node]) - 1
+
+    def _span(self, node):
+        """
+        Return (first, last) that the networks of node's children must lie in, both families for the root
+        """
+        return ADDRESS_SPACE if node == 0 else self.get_range(node)
+
+    def get_path(self, node):
+        """
+        Return hierarchical path of node, names of its ancestors below the domain root and its own name joined by ">"
+        """
+        names = []
+        while node > 0:
+            names.append(self.get_name(node))
+            node = self.parent[node]
+        return ">".join(reversed(names))
+
+    def find_path(self, path):
+        """
+        Return index of the node at hierarchical path, None if there is no such node
+        """
+        node = 0
+        for name in path and path.split(">") or []:
+            node = self._sibling_index(node).named(name)
+            if node is None or self.get_name(node) != name:
+                return None
+        return node
+
+    def _sibling_index(self, parent):
+        """
+        Return the SiblingIndex of the children of parent, building it on first use
+        Children with an invalid network are indexed by name only
+        """
+        index = self._siblings.get(parent)
+        if index is None:
+            index = self._siblings[parent] = SiblingIndex()
+            for c in self._children[parent]:
+                self._sibling_add(index, c)
+        return index
+
+    def _sibling_add(self, index, node):
+        start, end = (None, None) if node in self._invalid else self.get_range(node)
+        index.add_range(node, start, end, self.get_name(node))
+
+    def _sibling_remove(self, index, node):
+        start = None if node in self._invalid else self.get_address(node)
+        index.remove_range(node, start, self.get_name(node))
+
+    def _node_index(self):
+        """
+        Return (groups, names, networks) dicts of group id, name id and (network int, prefixlen) to the set of
+        nodes having them, building them on first use
+        """
+        if self._index is None:
+            self._index = ({}, {}, {})
+            for i in self.nodes():
+                self._index_node(i)
+        return self._index
+
+    def _node_keys(self, node):
+        network = None if node in self._invalid else (self.get_address(node), self.prefixlen[node])
+        return self.group[node], self.name[node], network
+
+    def _index_node(self, node):
+        for index, key in zip(self._index, self._node_keys(node)):
+            index.setdefault(key, set()).add(node)
+
+    def _unindex_node(self, node):
+        for index, key in zip(self._index, self._node_keys(node)):
+            nodes = index.get(key)
+            if nodes is not None:
+                nodes.discard(node)
+                if not nodes:
+                    del index[key]
+
+    def get_node(self, node_type="*", name=None, network=None):
+        """
+        Return indexes of nodes with given properties, in index order
+        Answered from the group, name and network indexes of the store
+        """
+        name_id = self._name_ids.get(name) if name else None
+        if name and name_id is None:
+            return []
+        group = None
+        if node_type != "*":
+            if node_type not in self.tags:
+                return []
+            group = self.tags.index(node_type)
+        prefix = None
+        if network:
+            prefix = address_prefix(network)
+            if prefix is None:
+                return []
+            prefix = (network_address(*prefix), prefix[1])
+        groups, names, networks = self._node_index()
+        if name_id is not None:
+            nodes = names.get(name_id, ())
+        elif prefix is not None:
+            nodes = networks.get(prefix, ())
+        elif group is not None:
+            nodes = groups.get(group, ())
+        else:
+            return sorted(self.nodes())
+        return sorted(i for i in nodes
+                if (group is None or self.group[i] == group)
+                and (name_id is None or self.name[i] == name_id)
+                and (prefix is None or self._node_keys(i)[2] == prefix))
+
+    def lookup(self, ip):
+        """
+        Return index of the most specific node whose network contains ip, None for an invalid ip
+        Nodes with an invalid network are left out
+        """
+        ret = address_prefix(ip)
+        if ret is None:
+            return None
+        if self._trie is None:
+            self._trie = NetworkTrie()
+            # the root also holds the IPv6 space
+            self._trie.insert_prefix(0, *network_prefix("::/0"))
+            for i in self.nodes():
+                if i not in self._invalid:
+                    self._trie.insert_prefix(i, self.get_address(i), self.prefixlen[i])
+        return self._trie.longest_match(*ret)
+
+    def _check_network(self, parent, address, prefixlen, node=None):
+        """
+        Raise the add_node exception for a network that is outside parent or overlaps a child of parent
+        node is left out of sibling comparisons
+        """
+        first, last = address, address + block_size(address, prefixlen) - 1
+        start, end = self._span(parent)
+        if not (start <= first and last <= end):
+            raise AssignedIPnotinSubnet("%s in %s" % (network_string(address, prefixlen), self.get_network(parent)))
+        c = self._sibling_index(parent).overlapping_range(first, last, exclude=node)
+        if c is not None:
+            raise DuplicateSiblingError("network:%s" % self.get_network(c))
+
+    def _check_name(self, parent, name, node=None):
+        """
+        Raise DuplicateSiblingError if a child of parent other than node has name, ignoring case
+        """
+        c = self._sibling_index(parent).named(name, exclude=node)
+        if c is not None:
+            raise DuplicateSiblingError("name:%s" % self.get_name(c))
+
+    def _parsed(self, network):
+        """
+        Return (network int, prefixlen) of network string, raises InvalidIPError if network is invalid
+        """
+        prefix = address_prefix(network == "" and "0.0.0.0/0" or network)
+        if prefix is None:
+            raise InvalidIPError(network)
+        address, prefixlen = prefix
+        return network_address(address, prefixlen), prefixlen
+
+    def add_node(self, node_type=None, parent=0, name="", network=""):
+        """
+        Add node under parent index following the same checks as Domain.add_node
+        Return index of the node
+        """
+        address, prefixlen = self._parsed(network)
+        if node_type not in self.tags[:self.ngroups] or self.tags.index(node_type) != self.group[parent] + 1:
+            raise InvalidNodeTypeError(node_type)
+        if not name:
+            return None
+        if ">" in name:
+            raise InvalidNodeNameError(name)
+        self._check_network(parent, address, prefixlen)
+        self._check_name(parent, name)
+        return self._append(parent, node_type, address, prefixlen, name, network or "0.0.0.0/0")
+
+    def set_node(self, node, name=None, network=None):
+        """
+        Change name and/or network of node following the same checks as Domain.set_node
+        Return index of the node
+        """
+        parent = self.parent[node]
+        if name is not None and ">" in name:
+            raise InvalidNodeNameError(name)
+        if network is not None:
+            address, prefixlen = self._parsed(network)
+            first, last = address, address + block_size(address, prefixlen) - 1
+            for c in self._children[node]:
+                if c in self._invalid:
+                    continue
+                c_first, c_last = self.get_range(c)
+                if not (first <= c_first and c_last <= last):
+                    raise AssignedIPnotinSubnet("%s in %s" % (self.get_network(c), network))
+            if parent >= 0:
+                self._check_network(parent, address, prefixlen, node)
+        if name is not None and parent >= 0:
+            self._check_name(parent, name, node)
+        index = self._siblings.get(parent)
+        if index is not None:
+            self._sibling_remove(index, node)
+        if self._index is not None:
+            self._unindex_node(node)
+        if network is not None:
+            self._set_address(node, address)
+            self.prefixlen[node] = prefixlen
+            self._set_written(node, network or "0.0.0.0/0")
+            self._trie = None
+        if name is not None:
+            self.name[node] = self._intern(name)
+        if index is not None:
+            self._sibling_add(index, node)
+        if self._index is not None:
+            self._index_node(node)
+        return node
+
+    def remove_node(self, node, force=False):
+        """
+        Remove node and its descendants, will raise exception if force argument is set to False
+        """
+        if not force:
+            raise ConfirmDeleteNodeError(node)
+        parent = self.parent[node]
+        self._children[parent].remove(node)
+        if parent in self._siblings:
+            self._sibling_remove(self._siblings[parent], node)
+        for i in list(self.nodes(node)):
+            if self._index is not None:
+                self._unindex_node(i)
+            self._siblings.pop(i, None)
+            self._invalid.pop(i, None)
+            self._raw.pop(i, None)
+            self.parent[i] = REMOVED
+            self._children[i] = []
+            self._removed += 1
+        self._trie = None
+        return node
+
+    def violations(self, node=0):
+        """
+        Return list of Violation for every node under node breaking add_node validation checks, Violation.node
+        being the node index. Sorts each level's siblings by network start to find overlaps in O(n log n)
+        """
+        ret = []
+        for parent in self.nodes(node):
+            start, end = self._span(parent)
+            ranges = []
+            names = {}
+            for n in self._children[parent]:
+                if self.group[n] >= self.ngroups or self.group[n] != self.group[parent] + 1:
+                    ret.append(Violation(n, "node_type", self.node_type(n)))
+                name = self.get_name(n)
+                if not name:
+                    ret.append(Violation(n, "name", name))
+                elif name.lower() in names:
+                    ret.append(Violation(n, "duplicate_name", "name:%s" % self.get_name(names[name.lower()])))
+                else:
+                    names[name.lower()] = n
+                if n in self._invalid:
+                    ret.append(Violation(n, "network", self._invalid[n]))
+                    continue
+                first, last = self.get_range(n)
+                if not (start <= first and last <= end):
+                    ret.append(Violation(n, "subnet", "%s in %s" % (self.get_network(n), self.get_network(parent))))
+                ranges.append((first, last, n))
+            for n, other in overlapping_ranges(ranges):
+                ret.append(Violation(n, "overlap", "network:%s" % self.get_network(other)))
+        return ret
+
+    def validate(self, node=0):
+        return not self.violations(node)
+
+    def free_summary(self, node):
+        """
+        Return (free addresses, prefixlen of the largest free block or None) of node as Domain.free_space does
+        Children with an invalid network are left out, a node with an invalid network has no free space
+        """
+        if node in self._invalid:
+            return 0, None
+        ranges = sorted(self.get_range(c) for c in self._children[node] if c not in self._invalid)
+        if node == 0:
+            return spans_summary(root_spans(ranges), ranges)[:2]
+        start, end = self.get_range(node)
+        return free_summary(start, end, ranges)
+
+    def free_blocks(self, node):
+        """
+        Yield (network int, prefixlen) of the minimal CIDR blocks covering space in node not used by its children
+        The root covers the IPv4 space, and the IPv6 space as well once it has an IPv6 child
+        """
+        ranges = sorted(self.get_range(c) for c in self._children[node] if c not in self._invalid)
+        for start, end in (root_spans(ranges) if node == 0 else [self.get_range(node)]):
+            for first, last in free_ranges(start, end, ranges):
+                for block in range_cidrs(first, last):
+                    yield block
+
+    def get_available_networks(self, node=0, prefixlen=None, number=10):
+        """
+        Return list of available network strings from a given node with subnet mask equal to prefixlen
+        Returns at most number networks when prefixlen is set, all free blocks otherwise
+        """
+        ret = []
+        for net, plen in self.free_blocks(node):
+            if not prefixlen:
+                ret.append(network_string(net, plen))
+                continue
+            if not plen <= prefixlen <= (128 if net >> 32 else 32):
+                continue
+            for n in subnets(net, plen, prefixlen):
+                if len(ret) >= number:
+                    return ret
+                ret.append(network_string(n, prefixlen))
+        return ret
+
+    def to_element(self, node=0):
+        """
+        Export node and its descendants as etree element, the domain root element for node 0
+        """
+        if node == 0:
+            e = etree.Element("domain", name=self.domain or "", timestamp=str(self.timestamp),
+                    version=str(self.version), schema=self.schema_name or "")
+            e.set("network", "0.0.0.0/0")
+        else:
+            e = etree.Element(self.node_type(node), name=self.get_name(node))
+            self._set_network(e, node)
+        stack = [(e, node)]
+        while stack:
+            parent, i = stack.pop()
+            for c in self._children[i]:
+                child = etree.SubElement(parent, self.node_type(c), name=self.get_name(c))
+                self._set_network(child, c)
+                stack.append((child, c))
+        return e
+
+    def _set_network(self, e, node):
+        # a missing network attribute stays missing
+        network = self.get_network(node)
+        if network is not None:
+            e.set("network", network)
+
+    def xml(self):
+        return etree.tostring(self.to_element())
+
+    def to_domain(self):
+        """
+        Return Domain with an etree representation of the stored nodes
+        """
+        dom = Domain(domain=self.domain, groups=self.tags[1:self.ngroups], schema_name=self.schema_name)
+        dom.root = self.to_element()
+        dom.version = self.version
+        dom.timestamp = self.timestamp
+        return dom
@@ -1,27 +1,173 @@
-from flask import Flask, request, abort, jsonify, make_response, g
+from flask import Flask, Response, request, abort, jsonify, make_response, g
 import redis
-import json
+import os
+import time
 import lxml
 from ipam.schema import *
+from ipam.cache import DomainCache
 import ipam.domain as ipamdomain
+import ipam.snapshot as ipamsnapshot
 
 app = Flask(__name__)
+app.config.setdefault("DOMAIN_CACHE_NODES", 1000000)
+# "blob" keeps each domain as one xml string, "delta" as a hash of nodes written incrementally
+app.config.setdefault("DOMAIN_STORAGE", "blob")
+app.config.setdefault("REDIS_HOST", "localhost")
+app.config.setdefault("REDIS_PORT", 6379)
+app.config.setdefault("REDIS_DB", 0)
+app.config.setdefault("REDIS_MAX_CONNECTIONS", 50)
+# seconds a request waits for a free connection when all REDIS_MAX_CONNECTIONS are in use
+app.config.setdefault("REDIS_POOL_TIMEOUT", 20)
+# log the time spent in redis by every request
+app.config.setdefault("REDIS_TIMING_LOG", False)
+# directory of binary domain snapshots written on save and used for node reads, None to disable
+app.config.setdefault("SNAPSHOT_DIR", None)
 SCHEMA_NAME = "ipam:schema"
+SCHEMA_VERSION_KEY = "%s:version" % SCHEMA_NAME
 
+# pool with an apply(func, args, kwargs) method running cpu heavy work on objects no other request holds yet
+# (parsing domains), set by servers that must not block on it, see ipamserver.py. Work is run inline when None
+# Cached domains fill their lookup structures on use, so work on them stays out of the pool
+cpu_pool = None
+
+def run_cpu(func, *args, **kwargs):
+    if cpu_pool is None:
+        return func(*args, **kwargs)
+    return cpu_pool.apply(func, args, kwargs)
+
+# parsed domains reused across requests handled by this process
+domain_cache = DomainCache(max_nodes=app.config["DOMAIN_CACHE_NODES"], run=run_cpu)
+
+# snapshots mapped by this process, by domain name
+snapshots = {}
+
+# connections shared by all requests handled by this process, created on first use
+redis_pool = None
+
+
+class TimedRedis(redis.StrictRedis):
+    """
+    StrictRedis recording (command, seconds) for every command and pipeline it runs in timings
+    """
+    def __init__(self, *args, **kwargs):
+        super(TimedRedis, self).__init__(*args, **kwargs)
+        self.timings = []
+
+    def execute_command(self, *args, **options):
+        start = time.time()
+        try:
+            return super(TimedRedis, self).execute_command(*args, **options)
+        finally:
+            self.timings.append((args[0], time.time() - start))
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = super(TimedRedis, self).pipeline(transaction, shard_hint)
+        execute = pipe.execute
+        def timed_execute(raise_on_error=True):
+            name = "PIPELINE(%s)" % ",".join(c[0][0] for c in pipe.command_stack)
+            start = time.time()
+            try:
+                return execute(raise_on_error)
+            finally:
+                self.timings.append((name, time.time() - start))
+        pipe.execute = timed_execute
+        return pipe
+
+    def timing_summary(self):
+        """
+        Return dict with the number of round trips, total milliseconds and milliseconds per command
+        """
+        commands = {}
+        for name, seconds in self.timings:
+            commands[name] = commands.get(name, 0) + seconds * 1000
+        return {"calls": len(self.timings), "ms": sum(commands.values()), "commands": commands}
+
+
+def get_pool():
+    global redis_pool
+    if redis_pool is None:
+        redis_pool = redis.BlockingConnectionPool(host=app.config["REDIS_HOST"], port=app.config["REDIS_PORT"],
+                db=app.config["REDIS_DB"], max_connections=app.config["REDIS_MAX_CONNECTIONS"],
+                timeout=app.config["REDIS_POOL_TIMEOUT"])
+    return redis_pool
 
 def init_db():
     if not hasattr(g, 'db'):
-        g.db = redis.StrictRedis(host="localhost", port=6379, db=0)
+        g.db = TimedRedis(connection_pool=get_pool())
     return g.db
 
-def init_schema():
-    #    if not hasattr(g, 'db'):
-    #    g.db = redis.StrictRedis(host="localhost", port=6379, db=0)
-
-    #schema = Schema(redisdb=g.db, schema_name=SCHEMA_NAME)
-    schema = Schema(redisdb=init_db(), schema_name=SCHEMA_NAME)
+def init_schema(schema_version=None):
+    """
+    Return Schema, schema_version being the version counter of SCHEMA_NAME when the caller already read it
+    """
+    schema = Schema(redisdb=init_db(), schema_name=SCHEMA_NAME, version=schema_version)
     return schema
 
+def prefetch_domain(domain_name):
+    """
+    Read the schema version counter and the version key of domain_name in one round trip
+    Return (schema version, version)
+    """
+    pipe = init_db().pipeline(transaction=False)
+    pipe.get(SCHEMA_VERSION_KEY)
+    pipe.get(ipamdomain.VERSION_KEY % domain_name)
+    return tuple(pipe.execute())
+
+def prefetch_storage(domain_name):
+    """
+    Read the schema version counter, the version key and how domain_name is stored in one round trip
+    Return (schema version, version, storage), storage being "blob", "delta" or None if there is no such domain
+    """
+    pipe = init_db().pipeline(transaction=False)
+    pipe.get(SCHEMA_VERSION_KEY)
+    pipe.get(ipamdomain.VERSION_KEY % domain_name)
+    pipe.exists(ipamdomain.DOMAIN_KEY % domain_name)
+    pipe.exists(ipamdomain.META_KEY % domain_name)
+    schema_version, version, blob, delta = pipe.execute()
+    return schema_version, version, blob and "blob" or delta and "delta" or None
+
+def snapshot_path(domain_name):
+    return os.path.join(app.config["SNAPSHOT_DIR"], "%s.snap" % domain_name)
+
+def get_snapshot(domain_name, version):
+    """
+    Return the Snapshot of domain_name if snapshots are enabled and one exists for version, None otherwise
+    Snapshots are written by new_domain, so reads of a domain changed since fall back to the domain: the file is
+    only mapped again once it was replaced. Mappings replaced are not closed, requests still reading them hold
+    them until they are done
+    """
+    if not app.config["SNAPSHOT_DIR"] or version is None:
+        return None
+    snap = snapshots.get(domain_name)
+    if snap is not None and snap.version == version:
+        return snap
+    try:
+        stat = os.stat(snapshot_path(domain_name))
+    except OSError:
+        return None
+    if snap is not None and snap.file_id == (stat.st_dev, stat.st_ino, stat.st_mtime):
+        # snapshot of an older version of the domain
+        return None
+    try:
+        new = ipamsnapshot.Snapshot(snapshot_path(domain_name))
+    except (IOError, OSError, ipamsnapshot.SnapshotError):
+        return None
+    snapshots[domain_name] = new
+    return new if new.version == version else None
+
+def save_snapshot(dom):
+    if app.config["SNAPSHOT_DIR"]:
+        dom.save_snapshot(snapshot_path(dom.domain))
+
+@app.after_request
+def log_redis_timing(response):
+    db = getattr(g, "db", None)
+    if db is not None and app.config["REDIS_TIMING_LOG"]:
+        summary = db.timing_summary()
+        app.logger.info("%s %s redis calls=%d ms=%.3f %s", request.method, request.path, summary["calls"],
+                summary["ms"], " ".join("%s=%.3f" % c for c in sorted(summary["commands"].items())))
+    return response
+
 #need to add authentication/authorization to the method
 @app.route("/ipam/api/v1.0/schema/<schema_name>", methods=["GET"])
 def get_schema(schema_name):
@@ -64,13 +210,25 @@ def new_schema(schema_name):
 def del_schema(schema_name):
     pass
 
+def save_domain(db, dom, full=False):
+    """
+    Persist dom using the configured DOMAIN_STORAGE mode
+    """
+    if app.config["DOMAIN_STORAGE"] == "delta":
+        return dom.save_delta(db, full=full)
+    return dom.save_to_db(db, full=full)
+
 #need to add authentication/authorization to the method
 @app.route("/ipam/api/v1.0/domain/<domain_name>", methods=["GET"])
 def get_domain(domain_name):
     db = init_db()
     dom = db.get("ipam:domain:%s" % domain_name)
     if dom is None:
-        abort(404)
+        # full xml export of a domain kept as a node hash
+        dom = domain_cache.get(db, domain_name, load_schema=init_schema)
+        if dom is None:
+            abort(404)
+        return Response(dom.iter_xml(), mimetype="application/xml")
     return dom 
 
 #need to add authentication/authorization to the method
@@ -82,79 +240,354 @@ def new_domain(domain_name):
     xml : xml representation of domain structure
     """
     db = init_db()
-    schema = init_schema()
     if request.content_type != "application/xml":
         abort(400)
-    schema = Schema(json_str=db.get(SCHEMA_NAME))
-    dom = ipamdomain.Domain(raw_xml=request.data, schema=schema)
-    dom.save_to_db(db)
+    schema = init_schema()
+    dom = run_cpu(ipamdomain.Domain, raw_xml=request.data, schema=schema)
+    if save_domain(db, dom, full=True):
+        domain_cache.put(dom.domain, dom)
+        save_snapshot(dom)
     return jsonify({"domain" : str(dom)})
 
 
 @app.route("/ipam/api/v1.0/domain/<domain_name>/node", methods=["GET", "POST", "DELETE"])
 def node_domain(domain_name):
+    """
+    GET takes node_type, name and network arguments
+    POST takes json with parent (path), name, network and optionally node_type, DELETE json with path
+    """
+    if request.method == "POST":
+        body = request.get_json(force=True) or {}
+        return lxml.etree.tostring(add_node(domain_name, body.get("parent", ""), body.get("network", ""),
+                body.get("name", ""), body.get("node_type"))) + "\n"
+    elif request.method == "DELETE":
+        body = request.get_json(force=True) or {}
+        return lxml.etree.tostring(del_node(domain_name, body.get("path", ""))) + "\n"
     db = init_db()
-    dom_xml = db.get("ipam:domain:%s" % domain_name)
-    schema = init_schema()
-#    schema = Schema(json_str=db.get(SCHEMA_NAME))
-#    dom = ipamdomain.Domain(raw_xml=request.data, schema=schema)
-    dom = ipamdomain.Domain(raw_xml=dom_xml, schema=schema)
+    schema_version, version = prefetch_domain(domain_name)
     node_args = ["node_type", "name", "network"]
-    if request.method == "GET":
-        # arg are type, name and network
-        kwargs = {k:v for (k,v) in request.args.iteritems() if k in node_args}
-        ret = dom.get_node(**kwargs)
-        #print lxml.etree.tostring(ret[0])
-    elif request.method == "POST":
-        ret = json.loads(request.data)
-        pass
-    elif request.method == "DELETE":
-        ret = json.loads(request.data)
-        pass
-    #print ret
+    # arg are type, name and network
+    kwargs = {k:v for (k,v) in request.args.iteritems() if k in node_args}
+    snap = get_snapshot(domain_name, version)
+    if snap is not None:
+        return "".join(lxml.etree.tostring(snap.to_element(n)) + "\n" for n in snap.get_node(**kwargs))
+    dom = domain_cache.get(db, domain_name, load_schema=lambda: init_schema(schema_version), version=version)
+    if dom is None:
+        abort(404)
+    ret = dom.get_node(**kwargs)
     ret_str = ""
     for r in ret:
         ret_str += lxml.etree.tostring(r)
         ret_str += "\n"
-#    return lxml.etree.tostring(ret[0])
     return ret_str
-#    return str(ret)
 
+@app.route("/ipam/api/v1.0/domain/<domain_name>/path/", defaults={"node_path": ""}, methods=["GET", "POST"])
+@app.route("/ipam/api/v1.0/domain/<domain_name>/path/<path:node_path>", methods=["GET", "POST", "PUT", "DELETE"])
+def path_domain(domain_name, node_path):
+    """
+    Node at hierarchical path node_path (names joined by ">", empty for the domain root) and its subtree
+    GET returns the subtree, down to the depth argument if given
+    POST adds a child from json with name, network and optionally node_type
+    PUT changes the node from json with name and/or network
+    DELETE removes the node and its subtree
+    Only the part of a domain kept as a node hash needed for the operation is read and written
+    """
+    if request.method == "GET":
+        depth = request.args.get("depth", type=int)
+        dom = load_subtree(domain_name, node_path, depth)[0]
+        node = dom.find_path(node_path)
+        if node is None:
+            abort(404)
+        return lxml.etree.tostring(node)
+    elif request.method == "DELETE":
+        return lxml.etree.tostring(del_node(domain_name, node_path))
+    body = request.get_json(force=True) or {}
+    if request.method == "POST":
+        node = add_node(domain_name, node_path, body.get("network", ""), body.get("name", ""), body.get("node_type"))
+    else:
+        node = set_node(domain_name, node_path, network=body.get("network"), name=body.get("name"))
+    return lxml.etree.tostring(node)
 
 @app.route("/ipam/api/v1.0/domain/<domain_name>/network", methods=["GET"])
 def network_domain(domain_name):
-    pass
+    """
+    Return the most specific node whose network contains the network argument (an address or network)
+    """
+    network = request.args.get("network", "")
+    db = init_db()
+    schema_version, version = prefetch_domain(domain_name)
+    snap = get_snapshot(domain_name, version)
+    if snap is not None:
+        node = snap.lookup(network)
+        if node is None:
+            abort(400)
+        return jsonify({"path": snap.get_path(node), "node_type": snap.node_type(node),
+                "name": snap.get_name(node), "network": snap.get_network(node)})
+    dom = domain_cache.get(db, domain_name, load_schema=lambda: init_schema(schema_version), version=version)
+    if dom is None:
+        abort(404)
+    node = dom.lookup(network)
+    if node is None:
+        abort(400)
+    return jsonify({"path": dom.get_path(node), "node_type": node.tag, "name": node.get("name"),
+            "network": node.get("network")})
+
+@app.route("/ipam/api/v1.0/domain/<domain_name>/utilization", methods=["GET"])
+def utilization_domain(domain_name):
+    """
+    Return utilization (see Domain.utilization_report) of the node at the path argument and every node below it,
+    keyed by path. Kept up to date incrementally on the cached domain
+    """
+    db = init_db()
+    schema_version, version = prefetch_domain(domain_name)
+    dom = domain_cache.get(db, domain_name, load_schema=lambda: init_schema(schema_version), version=version)
+    if dom is None:
+        abort(404)
+    node = dom.find_path(request.args.get("path", ""))
+    if node is None:
+        abort(404)
+    report = dom.utilization_report(node, incremental=True)
+    return jsonify(dict((dom.get_path(n), u._asdict()) for n, u in report.items()))
+
+@app.route("/ipam/api/v1.0/domain/<domain_name>/hosts", methods=["GET", "POST", "DELETE"])
+def hosts_domain(domain_name):
+    """
+    Host addresses of a leaf node, at the path argument for GET and the path field of the json body otherwise
+    GET returns the counts of Domain.host_counts and the ranges of assigned addresses
+    POST assigns count (default 1) contiguous addresses, the next free ones or from address if given
+    DELETE releases count addresses from address
+    """
+    if request.method == "GET":
+        path = request.args.get("path", "")
+        db = init_db()
+        schema_version, version = prefetch_domain(domain_name)
+        dom = domain_cache.get(db, domain_name, load_schema=lambda: init_schema(schema_version), version=version)
+        if dom is None:
+            abort(404)
+        node = dom.find_path(path)
+        if node is None:
+            abort(404)
+        try:
+            ret = dom.host_counts(node)
+            ret["ranges"] = dom.host_ranges(node)
+        except NODE_ERRORS:
+            abort(400)
+        ret["path"] = path
+        return jsonify(ret)
+    body = request.get_json(force=True) or {}
+    path = body.get("path", "")
+    address = body.get("address")
+    try:
+        count = int(body.get("count", 1))
+    except (TypeError, ValueError):
+        abort(400)
+    if request.method == "DELETE":
+        if not address:
+            abort(400)
+        released = change_node(domain_name, path, lambda dom, n: dom.release_hosts(n, address, count), depth=0)
+        return jsonify({"path": path, "released": released})
+    if address:
+        first = change_node(domain_name, path, lambda dom, n: dom.assign_hosts(n, address, count), depth=0)
+    else:
+        first = change_node(domain_name, path, lambda dom, n: dom.allocate_hosts(n, count), depth=0)
+    return jsonify({"path": path, "first": first, "count": count})
+
+@app.route("/ipam/api/v1.0/domain/<domain_name>/available", methods=["GET"])
+def available_domain(domain_name):
+    """
+    Return free networks of the node at the path argument, prefixlen and number arguments as in
+    Domain.get_available_networks
+    """
+    networks = get_available_network(domain_name, request.args.get("path", ""),
+            request.args.get("prefixlen", type=int), request.args.get("number", 10, type=int))
+    return jsonify({"networks": networks})
 
 @app.route("/ipam/api/v1.0/domain/<domain_name>", methods=["DELETE"])
 def del_domain(domain_name):
     db = init_db()
     dom_key = "ipam:domain:%s" % domain_name
     dom_xml = db.get(dom_key)
-    db.delete(dom_key)
+    if dom_xml is None:
+        dom = domain_cache.get(db, domain_name)
+        dom_xml = dom is not None and dom.xml() or ""
+    db.delete(dom_key, ipamdomain.VERSION_KEY % domain_name, ipamdomain.NODES_KEY % domain_name,
+            ipamdomain.META_KEY % domain_name, ipamdomain.SUBTREES_KEY % domain_name,
+            ipamdomain.PATHS_KEY % domain_name, ipamdomain.HOSTS_KEY % domain_name)
+    domain_cache.invalidate(domain_name)
+    if app.config["SNAPSHOT_DIR"] and os.path.exists(snapshot_path(domain_name)):
+        os.remove(snapshot_path(domain_name))
     return dom_xml
 
+# raised by Domain node operations for changes failing validation
+NODE_ERRORS = (ipamdomain.InvalidIPError, ipamdomain.AssignedIPnotinSubnet, ipamdomain.InvalidNodeTypeError,
+        ipamdomain.CantAddParentlessNodeError, ipamdomain.DuplicateSiblingError, ipamdomain.AddressInUseError,
+        ipamdomain.InvalidNodeNameError, ValueError)
+
+def load_subtree(domain_name, path, depth=None):
+    """
+    Return (Domain, storage) holding the node at path of domain_name with its ancestors, siblings and its
+    descendants down to depth levels below it, aborts with 404 if there is no such domain
+    Domains kept as one xml string are read whole from the domain cache
+    """
+    db = init_db()
+    schema_version, version, storage = prefetch_storage(domain_name)
+    if storage is None:
+        abort(404)
+    schema = init_schema(schema_version)
+    if storage == "blob":
+        return domain_cache.get(db, domain_name, load_schema=lambda: schema, version=version), storage
+    return ipamdomain.Domain(domain=domain_name, redisdb=db, schema=schema, subtree=path, depth=depth), storage
+
+def change_node(domain_name, path, change, depth=None):
+    """
+    Apply change(dom, node) to the node at path of domain_name and save the nodes it changed
+    Aborts with 404 for a missing node, 400 for a change failing validation and 409 if the subtree was
+    changed by another writer in the meantime. Returns the value of change
+    """
+    dom, storage = load_subtree(domain_name, path, depth)
+    if storage == "blob":
+        # the cached domain is read by other requests, it is replaced by the changed copy once saved
+        dom = dom.copy()
+    node = dom.find_path(path)
+    if node is None:
+        abort(404)
+    try:
+        ret = change(dom, node)
+    except NODE_ERRORS:
+        abort(400)
+    if ret is None:
+        abort(400)
+    saved = dom.save_delta(init_db()) if storage == "delta" else dom.save_to_db(init_db())
+    if not saved:
+        domain_cache.invalidate(domain_name)
+        abort(409)
+    if storage == "blob":
+        domain_cache.put(domain_name, dom)
+    return ret
+
 # node naming convention will be root>parent1>parent2>node or such format
 # to facilitate easy searching using lxml
-def add_node(domain, parent_node, network, name):
-    pass
+def add_node(domain, parent_node, network, name, node_type=None):
+    """
+    Add node under the node at path parent_node, node_type defaults to the group following the parent's
+    """
+    def change(dom, parent):
+        child_type = node_type
+        if child_type is None:
+            level = dom.groups.index(parent.tag) + 1
+            child_type = level < len(dom.groups) and dom.groups[level] or None
+        return dom.add_node(node_type=child_type, parent=parent, name=name, network=network)
+    return change_node(domain, parent_node, change, depth=1)
 
 def set_node(domain, node, network=None, name=None):
-    pass
+    """
+    Change name and/or network of the node at path node
+    """
+    kwargs = dict((k, v) for k, v in (("network", network), ("name", name)) if v is not None)
+    if not node or not kwargs:
+        abort(400)
+    # renaming changes the path of every descendant
+    return change_node(domain, node, lambda dom, n: dom.set_node(n, **kwargs), depth=None if name else 1)
 
 def del_node(domain, node):
-    pass
+    """
+    Remove the node at path node and its subtree
+    """
+    if not node:
+        abort(400)
+    return change_node(domain, node, lambda dom, n: dom.remove_node(n, force=True))
+
+def apply_operation(dom, op):
+    """
+    Apply one batch operation to dom and return the node it added, changed or removed
+    op is a dict with "op" set to "add" (parent path, name, network, optional node_type), "set" (path, name
+    and/or network) or "remove" (path). Raises KeyError for a missing node and NODE_ERRORS for invalid changes
+    """
+    kind = op.get("op")
+    node = dom.find_path(op.get("parent" if kind == "add" else "path") or "")
+    if node is None or (kind != "add" and node is dom.root):
+        raise KeyError(op.get("parent" if kind == "add" else "path"))
+    if kind == "add":
+        node_type = op.get("node_type")
+        if node_type is None:
+            level = dom.groups.index(node.tag) + 1
+            node_type = level < len(dom.groups) and dom.groups[level] or None
+        ret = dom.add_node(node_type=node_type, parent=node, name=op.get("name", ""), network=op.get("network", ""))
+    elif kind == "set":
+        kwargs = dict((k, op[k]) for k in ("name", "network") if op.get(k) is not None)
+        ret = dom.set_node(node, **kwargs) if kwargs else None
+    elif kind == "remove":
+        ret = dom.remove_node(node, force=True)
+    else:
+        raise ValueError("Invalid operation %s" % kind)
+    if ret is None:
+        raise ValueError("Operation %s had no effect" % kind)
+    return ret
+
+@app.route("/ipam/api/v1.0/domain/<domain_name>/batch", methods=["POST"])
+def batch_domain(domain_name):
+    """
+    Apply a json list of operations (see apply_operation) to the domain and save it once
+    Either every operation is applied or none is: the response lists the result of each operation, with status
+    400 and the failing operation's error when one fails, 409 when the domain was changed by another writer
+    """
+    ops = request.get_json(force=True)
+    if not isinstance(ops, list):
+        abort(400)
+    db = init_db()
+    schema_version, version = prefetch_domain(domain_name)
+    dom = domain_cache.get(db, domain_name, load_schema=lambda: init_schema(schema_version), version=version)
+    if dom is None:
+        abort(404)
+    # the cached domain is read by other requests while the operations are applied
+    dom = dom.copy()
+    results = []
+    for i, op in enumerate(ops):
+        try:
+            node = apply_operation(dom, op if isinstance(op, dict) else {})
+        except NODE_ERRORS + (KeyError,) as e:
+            results.append({"index": i, "status": "error", "error": e.__class__.__name__, "detail": str(e)})
+            results.extend({"index": j, "status": "skipped"} for j in xrange(i + 1, len(ops)))
+            return make_response(jsonify({"domain": domain_name, "results": results}), 400)
+        path = op["path"] if op["op"] == "remove" else dom.get_path(node)
+        results.append({"index": i, "status": "ok", "path": path})
+    if ops:
+        if not save_domain(db, dom):
+            domain_cache.invalidate(domain_name)
+            return make_response(jsonify({"domain": domain_name, "results": results}), 409)
+        if app.config["DOMAIN_STORAGE"] == "delta":
+            # save_delta only checks the subtrees dom changed, others may have been changed by other writers
+            domain_cache.invalidate(domain_name)
+        else:
+            domain_cache.put(domain_name, dom)
+    return jsonify({"domain": domain_name, "version": str(dom.version), "results": results})
 
 # ideally run this function clientside but will also make available in api
-def get_available_network(domain, node):
-    pass
+def get_available_network(domain, node, prefixlen=None, number=10):
+    """
+    Return list of free network strings of the node at path node
+    """
+    db = init_db()
+    schema_version, version = prefetch_domain(domain)
+    dom = domain_cache.get(db, domain, load_schema=lambda: init_schema(schema_version), version=version)
+    if dom is None:
+        abort(404)
+    node = dom.find_path(node)
+    if node is None:
+        abort(404)
+    return [str(n) for n in dom.get_available_networks(node=node, prefixlen=prefixlen, number=number)]
+
+@app.route("/ipam/api/v1.0/cache", methods=["GET"])
+def cache_info():
+    return jsonify(domain_cache.info())
 
 @app.errorhandler(404)
 def not_found(error):
-    return make_response(jsonify({"error" : "Not found"}))
+    return make_response(jsonify({"error" : "Not found"}), 404)
 
 if __name__ == "__main__":
     # check if redis is running
-    db = redis.StrictRedis(host="localhost", port=6379, db=0)
+    db = redis.StrictRedis(connection_pool=get_pool())
     SCHEMA_NAME = "ipam:schema"
     schema = Schema(redisdb=db, schema_name=SCHEMA_NAME)
     app.run(debug=True)
@@ -0,0 +1,43 @@
+"""
+Cooperative server entry point for the IPAM api
+Serves the routes of ipamapi with gevent: every request runs in a greenlet and redis round trips yield to other
+requests instead of blocking the process, while cpu heavy domain work (parsing, free space) runs in a bounded
+thread pool. One process handles thousands of concurrent requests without a thread per request.
+"""
+from gevent import monkey
+# threads stay os threads so that the cpu pool runs beside the event loop
+monkey.patch_all(thread=False)
+
+import argparse
+
+import redis
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+from gevent.queue import LifoQueue
+from gevent.threadpool import ThreadPool
+
+import ipamapi
+
+def serve(host="0.0.0.0", port=5000, connections=10000, cpu_workers=4, redis_connections=None):
+    """
+    Serve ipamapi.app until interrupted
+    connections bounds the requests handled at once, cpu_workers the threads parsing domains, redis_connections
+    the connections to redis (REDIS_MAX_CONNECTIONS by default) that requests wait for when all are in use
+    """
+    app = ipamapi.app
+    ipamapi.cpu_pool = ThreadPool(cpu_workers)
+    ipamapi.redis_pool = redis.BlockingConnectionPool(host=app.config["REDIS_HOST"], port=app.config["REDIS_PORT"],
+            db=app.config["REDIS_DB"], max_connections=redis_connections or app.config["REDIS_MAX_CONNECTIONS"],
+            timeout=app.config["REDIS_POOL_TIMEOUT"], queue_class=LifoQueue)
+    server = WSGIServer((host, port), app, spawn=Pool(connections))
+    server.serve_forever()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cooperative IPAM api server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--connections", type=int, default=10000, help="concurrent requests")
+    parser.add_argument("--cpu-workers", type=int, default=4, help="threads for parsing and free space work")
+    parser.add_argument("--redis-connections", type=int, default=None)
+    args = parser.parse_args()
+    serve(args.host, args.port, args.connections, args.cpu_workers, args.redis_connections)
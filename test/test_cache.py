@@ -0,0 +1,47 @@
+import os
+import sys
+
+import redis
+from nose.tools import ok_, eq_, raises
+
+try:
+    from ipam.cache import *
+except ImportError:
+    sys.path.append(os.path.abspath(".."))
+    from ipam.cache import *
+
+class TestDomainCache:
+    def setUp(self):
+        self.db = redis.StrictRedis(host="localhost", port=6379, db=0)
+        self.names = ["TestCache1", "TestCache2"]
+        for name in self.names:
+            dom = Domain(domain=name, groups=["Region", "City"])
+            parent = dom.add_node(node_type="Region", name="Australia", network="10.0.0.0/12", parent=dom.root)
+            dom.add_node(node_type="City", name="Brisbane", network="10.0.0.0/19", parent=parent)
+            dom.save_to_db(self.db)
+        self.cache = DomainCache(max_nodes=5)
+
+    def test_hit_and_miss(self):
+        dom = self.cache.get(self.db, "TestCache1")
+        eq_(dom.domain, "TestCache1")
+        ok_(self.cache.get(self.db, "TestCache1") is dom)
+        eq_((self.cache.hits, self.cache.misses), (1, 1))
+        eq_(self.cache.get(self.db, "TestCacheMissing"), None)
+
+    def test_version_change(self):
+        dom = self.cache.get(self.db, "TestCache1")
+        self.db.set(VERSION_KEY % "TestCache1", "42")
+        ok_(self.cache.get(self.db, "TestCache1") is not dom)
+        eq_(self.cache.misses, 2)
+
+    def test_eviction_by_nodes(self):
+        self.cache.get(self.db, "TestCache1")
+        self.cache.get(self.db, "TestCache2")
+        ok_("TestCache1" not in self.cache)
+        ok_("TestCache2" in self.cache)
+        eq_(self.cache.info()["nodes"], 3)
+        eq_(self.cache.evictions, 1)
+
+    def tearDown(self):
+        for name in self.names:
+            self.db.delete(DOMAIN_KEY % name, VERSION_KEY % name)
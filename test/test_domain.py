@@ -1,5 +1,6 @@
 import os
 import json
+import random
 import sys
 
 from nose.tools import ok_, eq_, raises, with_setup
@@ -8,9 +9,13 @@ from lxml import etree
 
 try:
     from ipam.domain import *
+    from ipam.index import FreePool
+    from ipam.iputil import ParseCache, parse_cache
 except ImportError:
     sys.path.append(os.path.abspath(".."))
     from ipam.domain import *
+    from ipam.index import FreePool
+    from ipam.iputil import ParseCache, parse_cache
 
 class TestDomain:
     def __init__(self):
@@ -170,3 +175,690 @@ class TestDomain:
         #print self.domain.get_available_networks(node=parent, prefixlen=19)
         print self.domain.get_available_networks(node=parent, prefixlen=22, number=5)
         #print self.domain.get_available_networks(node=parent)
+        nws = self.domain.get_available_networks(node=parent, prefixlen=22, number=5)
+        eq_([str(n) for n in nws], ["10.16.32.0/22", "10.16.36.0/22", "10.16.40.0/22", "10.16.44.0/22", "10.16.48.0/22"])
+        nws = self.domain.get_available_networks(node=parent, prefixlen=16, number=20)
+        eq_(len(nws), 14)
+        ok_(IPv4Network("10.17.0.0/16") not in nws)
+
+    def test_get_available_networks_all(self):
+        self.reset()
+        parent = self.domain.add_node(node_type="Region", name="Asia", network="10.16.0.0/12", parent=self.domain.root)
+        self.domain.add_node(node_type="City", name="Beijing", network="10.17.0.0/19", parent=parent)
+        eq_([str(n) for n in self.domain.get_available_networks(node=parent)],
+                ["10.16.0.0/16", "10.17.32.0/19", "10.17.64.0/18", "10.17.128.0/17", "10.18.0.0/15", "10.20.0.0/14", "10.24.0.0/13"])
+
+    def test_sibling_index_after_remove_node(self):
+        self.reset()
+        parent = self.domain.get_node(node_type="Region", name="Australia")[0]
+        node = self.domain.get_node(node_type="City", name="Brisbane")[0]
+        self.domain.remove_node(node, force=True)
+        n = self.domain.add_node(node_type="City", name="brisbane", network="10.0.0.0/20", parent=parent)
+        ok_(n is not None)
+
+    @raises(DuplicateSiblingError)
+    def test_sibling_index_after_set_node(self):
+        self.reset()
+        parent = self.domain.get_node(node_type="Region", name="Australia")[0]
+        node = self.domain.get_node(node_type="City", name="Brisbane")[0]
+        self.domain.set_node(node, network="10.1.0.0/19")
+        n = self.domain.add_node(node_type="City", name="Perth", network="10.0.0.0/19", parent=parent)
+        ok_(n is not None)
+        self.domain.add_node(node_type="City", name="Darwin", network="10.1.16.0/20", parent=parent)
+
+    def test_set_node_change_name_case(self):
+        self.reset()
+        node = self.domain.get_node(node_type="City", name="Brisbane")[0]
+        node = self.domain.set_node(node, name="BRISBANE")
+        eq_(node.get("name"), "BRISBANE")
+
+    def test_validate(self):
+        self.reset()
+        parent = self.domain.get_node(node_type="Region", name="Australia")[0]
+        self.domain.add_node(node_type="City", name="Perth", network="10.1.0.0/19", parent=parent)
+        ok_(self.domain.validate())
+        eq_(len(parent), 2)
+
+    def test_lookup(self):
+        self.reset()
+        parent = self.domain.add_node(node_type="Region", name="Asia", network="10.16.0.0/12", parent=self.domain.root)
+        child1 = self.domain.add_node(node_type="City", name="Shanghai", network="10.16.0.0/19", parent=parent)
+        eq_(self.domain.lookup("10.16.20.1"), child1)
+        eq_(self.domain.lookup("10.17.0.1"), parent)
+        eq_(self.domain.lookup("192.168.0.1"), self.domain.root)
+        eq_(self.domain.lookup("not an ip"), None)
+        eq_(self.domain.lookup_many(["10.16.20.1", "10.0.0.1", "10.256.0.1"]),
+                [child1, self.domain.get_node(node_type="City", name="Brisbane")[0], None])
+
+    def test_lookup_after_changes(self):
+        self.reset()
+        node = self.domain.get_node(node_type="City", name="Brisbane")[0]
+        parent = node.getparent()
+        eq_(self.domain.lookup("10.0.0.1"), node)
+        self.domain.set_node(node, network="10.1.0.0/19")
+        eq_(self.domain.lookup("10.0.0.1"), parent)
+        eq_(self.domain.lookup("10.1.0.1"), node)
+        self.domain.remove_node(node, force=True)
+        eq_(self.domain.lookup("10.1.0.1"), parent)
+        child = self.domain.add_node(node_type="City", name="Perth", network="10.1.0.0/24", parent=parent)
+        eq_(self.domain.lookup("10.1.0.1"), child)
+
+    def test_get_path(self):
+        self.reset()
+        node = self.domain.get_node(node_type="City", name="Brisbane")[0]
+        eq_(self.domain.get_path(node), "Australia>Brisbane")
+        eq_(self.domain.get_path(self.domain.root), "")
+
+    def test_resolve_many(self):
+        self.reset()
+        parent = self.domain.add_node(node_type="Region", name="Asia", network="10.16.0.0/12", parent=self.domain.root)
+        child1 = self.domain.add_node(node_type="City", name="Shanghai", network="10.16.0.0/19", parent=parent)
+        ips = ["10.16.20.1", "10.17.0.1", "192.168.0.1", "10.0.0.1", "10.15.255.255", "10.16.0.0"]
+        nodes = self.domain.get_node_ids()
+        ids = self.domain.resolve_many(ips)
+        eq_([nodes[i] for i in ids], [self.domain.lookup(ip) for ip in ips])
+        eq_(self.domain.resolve_many(["10.16.20.1", "10.0.0.1"], paths=True), ["Asia>Shanghai", "Australia>Brisbane"])
+        eq_(list(self.domain.resolve_many(["10.16.20.1/24", "bad"])), [self.domain.resolve_many(["10.16.20.1"])[0], -1])
+        # malformed strings do not borrow octets from their neighbours
+        eq_(self.domain.resolve_many(["10.16.20", "1.10.0.0.1", "10.0.0.1"], paths=True), [None, None, "Australia>Brisbane"])
+        eq_(list(self.domain.resolve_many(["garbage", "300.1.1.1", "10.0.0.1"]) == -1), [True, True, False])
+        europe = self.domain.add_node(node_type="Region", name="Europe", network="2001:db8::/32", parent=self.domain.root)
+        self.domain.add_node(node_type="City", name="Paris", network="2001:db8:0:1::/64", parent=europe)
+        eq_(self.domain.resolve_many(["10.0.0.1", "2001:db8:0:1::1", "2001:db8:1::1", "::1", "bad"], paths=True),
+                ["Australia>Brisbane", "Europe>Paris", "Europe", "", None])
+
+    def test_invalid_network_lookup(self):
+        # nodes whose network does not parse are left out of lookups and free space
+        raw = ('<domain name="Bogus" network="0.0.0.0/0"><Region name="A" network="10.0.0.0/8">'
+                '<City name="B" network="10.0.0.0/16"/><City name="C" network="bogus"/></Region></domain>')
+        dom = Domain(raw_xml=raw, groups=["Region", "City"])
+        eq_(dom.lookup("10.0.0.1").get("name"), "B")
+        eq_(dom.lookup("10.1.0.1").get("name"), "A")
+        eq_([n.get("name") for n in dom.lookup_many(["10.0.0.1", "10.1.0.1"])], ["B", "A"])
+        eq_(dom.resolve_many(["10.0.0.1", "10.1.0.1", "192.168.0.1"], paths=True), ["A>B", "A", ""])
+        parent = dom.get_node(name="A")[0]
+        eq_(map(str, dom.get_available_networks(parent, 16, 1)), ["10.1.0.0/16"])
+        eq_(dom.allocate(parent=parent, prefixlen=16, name="D").get("network"), "10.1.0.0/16")
+
+    def test_allocate(self):
+        self.reset()
+        parent = self.domain.get_node(node_type="Region", name="Australia")[0]
+        n1 = self.domain.allocate(parent=parent, prefixlen=19, name="Perth")
+        eq_(n1.get("network"), "10.0.32.0/19")
+        eq_(n1.tag, "City")
+        n2 = self.domain.allocate(parent=parent, prefixlen=24, name="Darwin")
+        eq_(n2.get("network"), "10.0.64.0/24")
+        # release buddies of Perth and reuse the lowest one
+        self.domain.remove_node(n1, force=True)
+        n3 = self.domain.allocate(parent=parent, prefixlen=20, name="Hobart")
+        eq_(n3.get("network"), "10.0.32.0/20")
+        n4 = self.domain.allocate(parent=parent, prefixlen=24, name="Cairns", strategy="best_fit")
+        eq_(n4.get("network"), "10.0.65.0/24")
+        eq_(self.domain.allocate(parent=parent, prefixlen=8, name="Sydney"), None)
+
+    def test_allocate_after_set_node(self):
+        self.reset()
+        parent = self.domain.get_node(node_type="Region", name="Australia")[0]
+        node = self.domain.get_node(node_type="City", name="Brisbane")[0]
+        self.domain.allocate(parent=parent, prefixlen=19, name="Perth")
+        self.domain.set_node(node, network="10.0.64.0/19")
+        eq_(self.domain.allocate(parent=parent, prefixlen=19, name="Darwin").get("network"), "10.0.0.0/19")
+        eq_(self.domain.allocate(parent=parent, prefixlen=19, name="Hobart").get("network"), "10.0.96.0/19")
+
+    @raises(ValueError)
+    def test_allocate_without_prefixlen(self):
+        self.reset()
+        parent = self.domain.get_node(node_type="Region", name="Australia")[0]
+        self.domain.allocate(parent=parent, name="Perth")
+
+    def test_free_pool(self):
+        # random reservations and releases of /28s in a /24 against the set of free addresses
+        rng = random.Random(5)
+        pool = FreePool("10.0.0.0/24", [(0x0a000000, 24)])
+        used = set()
+        for _ in xrange(500):
+            block = 0x0a000000 + 16 * rng.randrange(16)
+            if block in used:
+                pool.release("10.0.0.%d/28" % (block & 0xff))
+                used.discard(block)
+            else:
+                ok_(pool.reserve("10.0.0.%d/28" % (block & 0xff)))
+                used.add(block)
+            free = [b for b in xrange(0x0a000000, 0x0a000100, 16) if b not in used]
+            eq_(pool.find(28), free[0] if free else None)
+            eq_(sum(len(pool.free[p]) << (32 - p) for p in xrange(33)), 16 * len(free))
+
+    @raises(DuplicateSiblingError)
+    def test_allocate_duplicate_name(self):
+        self.reset()
+        parent = self.domain.get_node(node_type="Region", name="Australia")[0]
+        self.domain.allocate(parent=parent, prefixlen=24, name="brisbane")
+
+    def test_violations(self):
+        xml = """<domain name="Sedgman" network="0.0.0.0/0">
+        <Region name="Australia" network="10.0.0.0/12">
+            <City name="Brisbane" network="10.0.0.0/19"/>
+            <City name="brisbane" network="10.0.32.0/19"/>
+            <City name="Perth" network="10.0.16.0/20"/>
+            <City name="Darwin" network="10.128.0.0/19"/>
+            <Region name="Hobart" network="10.1.0.0/19"/>
+        </Region>
+        <Region name="Asia" network="not a network"/>
+        </domain>"""
+        dom = Domain(raw_xml=xml, groups=self.schema.get_groups("Sedgman"))
+        before = etree.tostring(dom.root)
+        found = [(v.node.get("name"), v.kind) for v in dom.violations()]
+        eq_(sorted(found), sorted([("brisbane", "duplicate_name"), ("Perth", "overlap"),
+                ("Darwin", "subnet"), ("Hobart", "node_type"), ("Asia", "network")]))
+        ok_(not dom.validate())
+        eq_(etree.tostring(dom.root), before)
+
+    def test_parse_cache(self):
+        self.reset()
+        parent = self.domain.get_node(node_type="Region", name="Australia")[0]
+        misses = parse_cache.misses
+        hits = parse_cache.hits
+        self.domain.add_node(node_type="City", name="Perth", network="10.1.0.0/19", parent=parent)
+        self.domain.add_node(node_type="City", name="Darwin", network="10.2.0.0/19", parent=parent)
+        ok_(parse_cache.hits > hits)
+        ok_(parse_cache.misses - misses <= 2)
+        info = parse_cache.info()
+        ok_(info["size"] <= info["maxsize"])
+
+    def test_parse_cache_bounded(self):
+        cache = ParseCache(maxsize=2)
+        eq_(cache.parse("10.0.0.1/24"), (167772160, 24))
+        cache.parse("10.1.0.0/16")
+        cache.parse("10.0.0.1/24")
+        cache.parse("10.2.0.0/16")
+        eq_(len(cache), 2)
+        cache.parse("10.0.0.1/24")
+        eq_((cache.hits, cache.misses), (2, 3))
+
+    def test_get_node_network(self):
+        self.reset()
+        node = self.domain.get_node(node_type="City", name="Brisbane")[0]
+        eq_(self.domain.get_node(network="10.0.0.0/19"), [node])
+        eq_(self.domain.get_node(node_type="Region", network="10.0.0.0/19"), [])
+        eq_(self.domain.get_node(name="Brisbane", network="10.0.0.0/12"), [])
+        eq_(self.domain.get_node(network="bad"), [])
+        eq_(self.domain.get_node(name="Brisbane' or @name='Australia"), [])
+
+    def test_get_node_after_changes(self):
+        self.reset()
+        node = self.domain.get_node(node_type="City", name="Brisbane")[0]
+        self.domain.set_node(node, name="Perth", network="10.1.0.0/19")
+        eq_(self.domain.get_node(node_type="City", name="Brisbane"), [])
+        eq_(self.domain.get_node(network="10.0.0.0/19"), [])
+        eq_(self.domain.get_node(node_type="City", name="Perth", network="10.1.0.0/19"), [node])
+        eq_(len(self.domain.get_node()), 3)
+        parent = self.domain.get_node(node_type="Region")[0]
+        child = self.domain.add_node(node_type="City", name="Darwin", network="10.2.0.0/19", parent=parent)
+        eq_(self.domain.get_node(node_type="City", name="Darwin"), [child])
+        self.domain.remove_node(parent, force=True)
+        eq_(self.domain.get_node(node_type="City"), [])
+
+    def test_get_node_after_removals(self):
+        self.reset()
+        parent = self.domain.get_node(node_type="Region")[0]
+        cities = [self.domain.add_node(node_type="City", name="C%d" % i, network="10.%d.0.0/19" % i, parent=parent)
+                for i in xrange(1, 11)]
+        for c in cities[::2]:
+            self.domain.remove_node(c, force=True)
+        # buckets keep the order nodes were indexed in once removed slots are compacted
+        eq_(self.domain.get_node(node_type="City")[1:], cities[1::2])
+        eq_(self.domain.get_node(network="10.1.0.0/19"), [])
+        eq_(self.domain.get_node(network="10.2.0.0/19"), [cities[1]])
+
+    def test_bulk_add(self):
+        self.reset()
+        australia = self.domain.get_node(node_type="Region", name="Australia")[0]
+        nodes = self.domain.bulk_add([
+            ("Asia", "City", "Beijing", "10.17.0.0/19"),
+            ("", "Region", "Asia", "10.16.0.0/12"),
+            (australia, "City", "Perth", "10.1.0.0/19"),
+            ("Asia", "City", "Shanghai", "10.16.0.0/19"),
+            ])
+        eq_([self.domain.get_path(n) for n in nodes], ["Asia>Beijing", "Asia", "Australia>Perth", "Asia>Shanghai"])
+        eq_(self.domain.lookup("10.16.0.1"), nodes[3])
+        eq_(self.domain.get_node(node_type="City", name="Perth"), [nodes[2]])
+        ok_(self.domain.validate())
+
+    def test_bulk_add_csv(self):
+        import StringIO
+        self.reset()
+        stream = StringIO.StringIO("path,node_type,name,network\nAustralia,City,Perth,10.1.0.0/19\n,Region,Asia,10.16.0.0/12\n")
+        nodes = self.domain.bulk_add(stream)
+        eq_([self.domain.get_path(n) for n in nodes], ["Australia>Perth", "Asia"])
+
+    @raises(DuplicateSiblingError)
+    def test_bulk_add_overlap_in_batch(self):
+        self.reset()
+        self.domain.bulk_add([("Australia", "City", "Perth", "10.1.0.0/19"), ("Australia", "City", "Darwin", "10.1.16.0/20")])
+
+    def test_bulk_add_is_atomic(self):
+        self.reset()
+        before = self.domain.xml()
+        try:
+            self.domain.bulk_add([("", "Region", "Asia", "10.16.0.0/12"), ("Asia", "City", "Shanghai", "10.16.0.0/19"),
+                    ("Australia", "City", "perth", "10.1.0.0/19"), ("Australia", "City", "brisbane", "10.2.0.0/19")])
+        except DuplicateSiblingError:
+            pass
+        else:
+            ok_(False, "DuplicateSiblingError not raised")
+        eq_(self.domain.xml(), before)
+
+    @raises(CantAddParentlessNodeError)
+    def test_bulk_add_missing_parent(self):
+        self.reset()
+        self.domain.bulk_add([("Europe", "City", "Paris", "10.1.0.0/19")])
+
+    def test_iter_xml(self):
+        self.reset()
+        self.domain.add_node(node_type="Region", name=u"S\xe3o Paulo & Rio", network="10.32.0.0/12", parent=self.domain.root)
+        eq_(etree.tostring(etree.fromstring("".join(self.domain.iter_xml()))), self.domain.xml())
+        eq_(len(list(self.domain.iter_xml(chunk_size=1))), 6)
+        raw = '<domain name="Raw">\n  <Region name="A" network="10.0.0.0/8"><!-- c -->\n    <City name="B" network="10.0.0.0/16"/>\n  </Region>\n</domain>'
+        dom = Domain(raw_xml=raw, groups=["Region", "City"])
+        eq_("".join(dom.iter_xml(chunk_size=8)), dom.xml())
+
+    def test_load_stream(self):
+        self.reset()
+        parent = self.domain.get_node(node_type="Region", name="Australia")[0]
+        self.domain.add_node(node_type="City", name="Perth", network="10.1.0.0/19", parent=parent)
+        test_file = "/tmp/tmpstream.xml"
+        try:
+            self.domain.save(xml_file=test_file)
+            dom = Domain(xml_file=test_file, groups=["Region", "City"])
+            eq_(dom.xml(), self.domain.xml())
+            eq_(dom.load_violations, [])
+            eq_(dom.get_node(name="Perth")[0].get("network"), "10.1.0.0/19")
+            eq_(dom.lookup("10.1.2.3").get("name"), "Perth")
+            with open(test_file, "w") as f:
+                f.write('<domain name="Bad"><Region name="A" network="10.0.0.0/8"><City name="B" network="10.0.0.0/16"/>'
+                        '<City name="b" network="10.0.128.0/17"/></Region><City name="C" network="bad"/></domain>')
+            dom = Domain(xml_file=test_file, groups=["Region", "City"])
+            eq_(sorted((v.node.get("name"), v.kind) for v in dom.load_violations),
+                    sorted((v.node.get("name"), v.kind) for v in dom.violations()))
+            eq_(len(dom.load_violations), 4)
+            # a child at 0.0.0.0/0 wins over the root, as when the trie is built after loading
+            with open(test_file, "w") as f:
+                f.write('<domain name="Any"><Region name="A" network="0.0.0.0/0"/></domain>')
+            dom = Domain(xml_file=test_file, groups=["Region", "City"])
+            eq_(dom.lookup("10.1.2.3").get("name"), "A")
+        finally:
+            os.remove(test_file)
+
+    def test_save_delta(self):
+        import redis
+        db = redis.StrictRedis(host="localhost", port=6379, db=0)
+        self.domain = Domain(domain="TestDelta", groups=self.schema.get_groups("Sedgman"), schema_name="Sedgman")
+        parent = self.domain.add_node(node_type="Region", name="Australia", network="10.0.0.0/12", parent=self.domain.root)
+        node = self.domain.add_node(node_type="City", name="Brisbane", network="10.0.0.0/19", parent=parent)
+        try:
+            ok_(self.domain.save_delta(db, full=True))
+            version = int(self.domain.version)
+            self.domain.set_node(parent, name="Oceania")
+            self.domain.add_node(node_type="City", name="Perth", network="10.1.0.0/19", parent=parent)
+            self.domain.remove_node(node, force=True)
+            ok_(self.domain.save_delta(db))
+            eq_(int(self.domain.version), version + 1)
+            eq_(sorted(db.hkeys(NODES_KEY % "TestDelta")), ["Oceania", "Oceania>Perth"])
+            dom = Domain(domain="TestDelta", redisdb=db, groups=self.schema.get_groups("Sedgman"))
+            eq_(dom.xml(), self.domain.xml())
+            eq_(dom.get_path(dom.lookup("10.1.0.1")), "Oceania>Perth")
+            # a full save of an older version is refused, as by save_to_db
+            stale = Domain(domain="TestDelta", groups=self.schema.get_groups("Sedgman"), schema_name="Sedgman")
+            stale.version = str(version)
+            ok_(not stale.save_delta(db, full=True))
+            eq_(sorted(db.hkeys(NODES_KEY % "TestDelta")), ["Oceania", "Oceania>Perth"])
+            ok_(dom.save_delta(db, full=True))
+        finally:
+            db.delete(NODES_KEY % "TestDelta", META_KEY % "TestDelta", VERSION_KEY % "TestDelta", SUBTREES_KEY % "TestDelta",
+                    PATHS_KEY % "TestDelta")
+
+    def test_save_to_db_version_check(self):
+        import redis
+        db = redis.StrictRedis(host="localhost", port=6379, db=0)
+        self.domain = Domain(domain="TestBlob", groups=self.schema.get_groups("Sedgman"), schema_name="Sedgman")
+        self.domain.add_node(node_type="Region", name="Australia", network="10.0.0.0/12", parent=self.domain.root)
+        try:
+            ok_(self.domain.save_to_db(db))
+            writer1 = Domain(raw_xml=db.get(DOMAIN_KEY % "TestBlob"), groups=self.schema.get_groups("Sedgman"))
+            writer2 = Domain(raw_xml=db.get(DOMAIN_KEY % "TestBlob"), groups=self.schema.get_groups("Sedgman"))
+            ok_(writer1.save_to_db(db))
+            eq_(db.get(VERSION_KEY % "TestBlob"), "2")
+            ok_(not writer2.save_to_db(db))
+            eq_(Domain(raw_xml=db.get(DOMAIN_KEY % "TestBlob")).version, "2")
+        finally:
+            db.delete(DOMAIN_KEY % "TestBlob", VERSION_KEY % "TestBlob")
+
+    def test_save_delta_disjoint_subtrees(self):
+        import redis
+        db = redis.StrictRedis(host="localhost", port=6379, db=0)
+        groups = self.schema.get_groups("Sedgman")
+        self.domain = Domain(domain="TestCAS", groups=groups, schema_name="Sedgman")
+        self.domain.add_node(node_type="Region", name="Australia", network="10.0.0.0/12", parent=self.domain.root)
+        self.domain.add_node(node_type="Region", name="Asia", network="10.16.0.0/12", parent=self.domain.root)
+        keys = [k % "TestCAS" for k in (NODES_KEY, META_KEY, VERSION_KEY, SUBTREES_KEY, PATHS_KEY)]
+        try:
+            ok_(self.domain.save_delta(db, full=True))
+            writer1 = Domain(domain="TestCAS", redisdb=db, groups=groups)
+            writer2 = Domain(domain="TestCAS", redisdb=db, groups=groups)
+            writer3 = Domain(domain="TestCAS", redisdb=db, groups=groups)
+            writer1.add_node(node_type="City", name="Perth", network="10.1.0.0/19", parent=writer1.find_path("Australia"))
+            writer2.add_node(node_type="City", name="Beijing", network="10.17.0.0/19", parent=writer2.find_path("Asia"))
+            writer3.add_node(node_type="City", name="Darwin", network="10.1.0.0/19", parent=writer3.find_path("Australia"))
+            ok_(writer1.save_delta(db))
+            ok_(writer2.save_delta(db))
+            ok_(not writer3.save_delta(db))
+            eq_(sorted(db.hkeys(keys[0])), ["Asia", "Asia>Beijing", "Australia", "Australia>Perth"])
+            # adding a top level node conflicts with any other top level change
+            writer1.add_node(node_type="Region", name="Africa", network="10.32.0.0/12", parent=writer1.root)
+            writer2.set_node(writer2.find_path("Asia"), name="Orient")
+            ok_(writer1.save_delta(db))
+            ok_(not writer2.save_delta(db))
+        finally:
+            db.delete(*keys)
+
+    def test_load_subtree(self):
+        import redis
+        db = redis.StrictRedis(host="localhost", port=6379, db=0)
+        groups = ["Region", "City", "Site"]
+        self.domain = Domain(domain="TestSub", groups=groups)
+        aus = self.domain.add_node(node_type="Region", name="Australia", network="10.0.0.0/12", parent=self.domain.root)
+        self.domain.add_node(node_type="Region", name="Aus", network="10.32.0.0/12", parent=self.domain.root)
+        asia = self.domain.add_node(node_type="Region", name="Asia", network="10.16.0.0/12", parent=self.domain.root)
+        bne = self.domain.add_node(node_type="City", name="Brisbane", network="10.0.0.0/19", parent=aus)
+        self.domain.add_node(node_type="City", name="Perth", network="10.1.0.0/19", parent=aus)
+        self.domain.add_node(node_type="Site", name="CBD", network="10.0.0.0/24", parent=bne)
+        self.domain.add_node(node_type="City", name="Beijing", network="10.17.0.0/19", parent=asia)
+        keys = [k % "TestSub" for k in (NODES_KEY, META_KEY, VERSION_KEY, SUBTREES_KEY, PATHS_KEY)]
+        try:
+            ok_(self.domain.save_delta(db, full=True))
+            dom = Domain(domain="TestSub", redisdb=db, groups=groups, subtree="Australia>Brisbane")
+            eq_(sorted(dom.get_path(n) for n in dom.root.iterdescendants()),
+                    ["Australia", "Australia>Brisbane", "Australia>Brisbane>CBD", "Australia>Perth"])
+            dom = Domain(domain="TestSub", redisdb=db, groups=groups, subtree="Australia", depth=1)
+            eq_(sorted(dom.get_path(n) for n in dom.root.iterdescendants()),
+                    ["Asia", "Aus", "Australia", "Australia>Brisbane", "Australia>Perth"])
+            dom.add_node(node_type="City", name="Darwin", network="10.2.0.0/19", parent=dom.find_path("Australia"))
+            ok_(dom.save_delta(db))
+            ok_(not dom.save_delta(db, full=True))
+            ok_(not dom.save_to_db(db))
+            full = Domain(domain="TestSub", redisdb=db, groups=groups)
+            eq_(full.get_path(full.lookup("10.2.0.1")), "Australia>Darwin")
+            eq_(len(full.root.xpath("//*")), 9)
+            # path index rebuilt for domains saved without one
+            db.delete(keys[4])
+            dom = Domain(domain="TestSub", redisdb=db, groups=groups, subtree="Asia")
+            eq_(dom.get_path(dom.lookup("10.17.0.1")), "Asia>Beijing")
+        finally:
+            db.delete(*keys)
+
+    def test_copy(self):
+        self.reset()
+        perth = self.domain.add_node(node_type="City", name="Perth", network="10.1.0.0/24",
+                parent=self.domain.find_path("Australia"))
+        self.domain.allocate_hosts(perth, 4)
+        self.domain.utilization_report(incremental=True)
+        dom = self.domain.copy()
+        eq_(dom.xml(), self.domain.xml())
+        eq_(dom.groups, self.domain.groups)
+        eq_(sorted(dom.get_path(n) for n in dom._dirty), sorted(self.domain.get_path(n) for n in self.domain._dirty))
+        dom.allocate_hosts(dom.find_path("Australia>Perth"), 2)
+        dom.set_node(dom.find_path("Australia"), name="Oceania")
+        dom.add_node(node_type="City", name="Darwin", network="10.2.0.0/24", parent=dom.find_path("Oceania"))
+        eq_(self.domain.host_counts(perth)["used"], 4)
+        eq_(dom.host_counts(dom.find_path("Oceania>Perth"))["used"], 6)
+        eq_(self.domain.find_path("Australia>Darwin"), None)
+        eq_(self.domain.lookup("10.2.0.1").get("name"), "Australia")
+        eq_(dom.lookup("10.2.0.1").get("name"), "Darwin")
+        eq_(dom.utilization_report(incremental=True)[dom.find_path("Oceania")].nodes, 4)
+        eq_(self.domain.utilization_report(incremental=True)[self.domain.find_path("Australia")].nodes, 3)
+
+    def test_save_delta_keeps_order(self):
+        import redis
+        db = redis.StrictRedis(host="localhost", port=6379, db=0)
+        groups = self.schema.get_groups("Sedgman")
+        self.domain = Domain(domain="TestOrder", groups=groups, schema_name="Sedgman")
+        parent = self.domain.add_node(node_type="Region", name="Australia", network="10.0.0.0/12", parent=self.domain.root)
+        for i, name in enumerate(["Sydney", "Perth", "Brisbane"]):
+            self.domain.add_node(node_type="City", name=name, network="10.%d.0.0/19" % i, parent=parent)
+        keys = [k % "TestOrder" for k in (NODES_KEY, META_KEY, VERSION_KEY, SUBTREES_KEY, PATHS_KEY)]
+        try:
+            ok_(self.domain.save_delta(db, full=True))
+            dom = Domain(domain="TestOrder", redisdb=db, groups=groups)
+            eq_(dom.xml(), self.domain.xml())
+            parent = dom.find_path("Australia")
+            dom.remove_node(dom.find_path("Australia>Brisbane"), force=True)
+            dom.add_node(node_type="City", name="Adelaide", network="10.3.0.0/19", parent=parent)
+            dom.set_node(dom.find_path("Australia>Sydney"), name="Canberra")
+            ok_(dom.save_delta(db))
+            eq_([n.get("name") for n in Domain(domain="TestOrder", redisdb=db, groups=groups).root.iter("City")],
+                    ["Canberra", "Perth", "Adelaide"])
+            dom = Domain(domain="TestOrder", redisdb=db, groups=groups, subtree="Australia>Perth")
+            dom.add_node(node_type="City", name="Darwin", network="10.4.0.0/19", parent=dom.find_path("Australia"))
+            ok_(dom.save_delta(db))
+            eq_([n.get("name") for n in Domain(domain="TestOrder", redisdb=db, groups=groups).root.iter("City")],
+                    ["Canberra", "Perth", "Adelaide", "Darwin"])
+        finally:
+            db.delete(*keys)
+
+    @raises(InvalidNodeNameError)
+    def test_add_node_path_separator(self):
+        self.domain.add_node(node_type="Region", name="Australia>Perth", network="10.0.0.0/12", parent=self.domain.root)
+
+    @raises(InvalidNodeNameError)
+    def test_set_node_path_separator(self):
+        self.reset()
+        self.domain.set_node(self.domain.find_path("Australia"), name="Oceania>Australia")
+
+    @raises(InvalidNodeNameError)
+    def test_bulk_add_path_separator(self):
+        self.domain.bulk_add([("", "Region", "Australia>Perth", "10.0.0.0/12")])
+
+    def test_parallel_violations(self):
+        raw = ('<domain name="Par"><Region name="A" network="10.0.0.0/12"><City name="B" network="10.0.0.0/16"/>'
+                '<City name="b" network="10.0.128.0/17"/><City name="C" network="bad"/></Region>'
+                '<Region name="D" network="10.16.0.0/12"><City name="E" network="10.32.0.0/16"/></Region>'
+                '<Region name="F" network="10.16.0.0/16"><City name="G"/></Region></domain>')
+        dom = Domain(raw_xml=raw, groups=["Region", "City"])
+        serial = sorted((v.node.get("name"), v.kind, v.detail) for v in dom.violations())
+        eq_(sorted((v.node.get("name"), v.kind, v.detail) for v in dom.violations(processes=2)), serial)
+        eq_(len(serial), 6)
+        ok_(("G", "network", None) in serial)
+        eq_(dom.free_space(processes=2), dom.free_space())
+        ok_(not dom.validate(processes=2))
+        self.reset()
+        ok_(self.domain.validate(processes=2))
+
+    def test_free_space(self):
+        self.reset()
+        parent = self.domain.get_node(node_type="Region", name="Australia")[0]
+        self.domain.add_node(node_type="City", name="Perth", network="10.1.0.0/19", parent=parent)
+        free = self.domain.free_space()
+        eq_(free[parent], ((1 << 20) - 2 * (1 << 13), 13))
+        eq_(free[self.domain.get_node(name="Perth")[0]], (1 << 13, 19))
+        eq_(free[self.domain.root], ((1 << 32) - (1 << 20), 1))
+        eq_(self.domain.free_space(processes=2), free)
+        eq_(self.domain.free_space(parent), dict((n, free[n]) for n in parent.iter()))
+        # invalid networks are left out in both modes
+        self.domain.get_node(name="Perth")[0].set("network", "10.300.0.0/19")
+        free = self.domain.free_space()
+        eq_(free[parent], ((1 << 20) - (1 << 13), 13))
+        eq_(free[self.domain.get_node(name="Perth")[0]], (0, None))
+        eq_(self.domain.free_space(processes=2), free)
+
+    def test_utilization_report(self):
+        self.reset()
+        parent = self.domain.get_node(node_type="Region", name="Australia")[0]
+        brisbane = self.domain.get_node(name="Brisbane")[0]
+        self.domain.add_node(node_type="City", name="Perth", network="10.0.64.0/19", parent=parent)
+        report = self.domain.utilization_report()
+        eq_(report[parent].size, 1 << 20)
+        eq_(report[parent].used, 2 * (1 << 13))
+        eq_(report[parent].largest_free, 13)
+        eq_(report[parent].nodes, 3)
+        eq_(report[self.domain.root].nodes, 4)
+        eq_(report[brisbane], Utilization(1 << 13, 0, 1 << 13, 0.0, 19, 0.0, 1))
+        ok_(0 < report[parent].fragmentation < 1)
+        eq_(report[parent].free, self.domain.free_space()[parent][0])
+
+        eq_(self.domain.utilization_report(incremental=True), report)
+        darwin = self.domain.add_node(node_type="City", name="Darwin", network="10.0.32.0/19", parent=parent)
+        self.domain.set_node(brisbane, network="10.0.0.0/20")
+        self.domain.remove_node(self.domain.get_node(name="Perth")[0], force=True)
+        incremental = self.domain.utilization_report(incremental=True)
+        eq_(incremental, self.domain.utilization_report())
+        eq_(incremental[parent].nodes, 3)
+        eq_(incremental[darwin].used, 0)
+        eq_(self.domain.utilization_report(parent, incremental=True),
+                dict((n, incremental[n]) for n in parent.iter()))
+        # invalid networks are left out as by free_space
+        perth = self.domain.add_node(node_type="City", name="Perth", network="10.0.64.0/19", parent=parent)
+        perth.set("network", "bogus")
+        report = self.domain.utilization_report()
+        eq_(report[perth], Utilization(0, 0, 0, 0.0, None, 0.0, 1))
+        eq_(report[parent].free, self.domain.free_space()[parent][0])
+        eq_(report[parent].nodes, 4)
+
+    def test_ipv6(self):
+        self.reset()
+        root = self.domain.root
+        europe = self.domain.add_node(node_type="Region", name="Europe", network="2001:db8::/32", parent=root)
+        paris = self.domain.add_node(node_type="City", name="Paris", network="2001:db8:0:1::/64", parent=europe)
+        eq_(self.domain.lookup("2001:db8:0:1::10"), paris)
+        eq_(self.domain.lookup("2001:db8:1::1"), europe)
+        eq_(self.domain.lookup("2001:dead::1"), root)
+        eq_(self.domain.lookup("10.0.1.1"), self.domain.get_node(name="Brisbane")[0])
+        eq_(self.domain.get_node(network="2001:DB8:0:1:0::/64"), [paris])
+        ok_(self.domain.validate())
+        ok_(self.domain.validate(processes=2))
+
+        try:
+            self.domain.add_node(node_type="City", name="Lyon", network="2001:db9::/64", parent=europe)
+            ok_(False)
+        except AssignedIPnotinSubnet:
+            pass
+        try:
+            self.domain.add_node(node_type="City", name="Lyon", network="2001:db8:0:1:8000::/65", parent=europe)
+            ok_(False)
+        except DuplicateSiblingError:
+            pass
+
+        lyon = self.domain.allocate(parent=europe, prefixlen=64, name="Lyon")
+        eq_(lyon.get("network"), "2001:db8::/64")
+        eq_([str(n) for n in self.domain.get_available_networks(europe, prefixlen=64, number=2)],
+                ["2001:db8:0:2::/64", "2001:db8:0:3::/64"])
+        free = [str(n) for n in self.domain.get_available_networks(europe)]
+        eq_(free[:2], ["2001:db8:0:2::/63", "2001:db8:0:4::/62"])
+        eq_(len(free), 31)
+        eq_(free[-1], "2001:db8:8000::/33")
+        asia = self.domain.allocate(parent=root, prefixlen=32, name="Asia", version=6)
+        eq_(asia.get("network"), "::/32")
+
+        free = self.domain.free_space()
+        eq_(free[europe], ((1 << 96) - 2 * (1 << 64), 33))
+        eq_(free[root][1], 1)
+        report = self.domain.utilization_report()
+        eq_(report[root].size, (1 << 32) + (1 << 128))
+        eq_(report[root].nodes, 7)
+        eq_(report[paris], Utilization(1 << 64, 0, 1 << 64, 0.0, 64, 0.0, 1))
+        eq_(self.domain.free_space(processes=2), free)
+
+        self.domain.set_node(paris, network="2001:db8:0:100::/56")
+        eq_(self.domain.lookup("2001:db8:0:1ff::1"), paris)
+        eq_(self.domain.violations(), [])
+        dom = Domain(raw_xml=self.domain.xml())
+        eq_(dom.lookup("2001:db8:0:100::1").get("name"), "Paris")
+
+    def test_ipv6_parsing(self):
+        cache = ParseCache()
+        eq_(network_string(*cache.parse("2001:DB8:0:0:1::1/64")), "2001:db8::/64")
+        eq_(network_string(*cache.parse("::ffff:10.1.2.3")), "::ffff:a01:203/128")
+        eq_(network_string(*cache.parse("2001:0:0:1:0:0:0:1")), "2001:0:0:1::1/128")
+        for bad in ["1::2::3", "2001:db8::/129", "12345::", "1:2:3:4:5:6:7:8:9"]:
+            try:
+                cache.parse(bad)
+                ok_(False)
+            except ValueError:
+                pass
+
+    def test_hosts(self):
+        import redis
+        db = redis.StrictRedis(host="localhost", port=6379, db=0)
+        keys = [k % "TestHosts" for k in (NODES_KEY, META_KEY, VERSION_KEY, SUBTREES_KEY, PATHS_KEY, HOSTS_KEY)]
+        self.domain = Domain(domain="TestHosts", groups=self.schema.get_groups("Sedgman"), schema_name="Sedgman")
+        parent = self.domain.add_node(node_type="Region", name="Australia", network="10.0.0.0/12", parent=self.domain.root)
+        node = self.domain.add_node(node_type="City", name="Brisbane", network="10.0.0.0/22", parent=parent)
+        try:
+            self.domain.allocate_hosts(parent)
+            ok_(False)
+        except InvalidNodeTypeError:
+            pass
+        eq_(self.domain.allocate_hosts(node), "10.0.0.1")
+        eq_(self.domain.allocate_hosts(node, 100), "10.0.0.2")
+        eq_(self.domain.assign_hosts(node, "10.0.1.0", 4), "10.0.1.0")
+        try:
+            self.domain.assign_hosts(node, "10.0.1.3")
+            ok_(False)
+        except AddressInUseError:
+            pass
+        try:
+            self.domain.assign_hosts(node, "10.0.4.1")
+            ok_(False)
+        except AssignedIPnotinSubnet:
+            pass
+        eq_(self.domain.release_hosts(node, "10.0.0.51", 10), 10)
+        eq_(self.domain.host_counts(node), {"size": 1024, "reserved": 2, "used": 95, "free": 927})
+        eq_(self.domain.host_ranges(node), [("10.0.0.1", "10.0.0.50"), ("10.0.0.61", "10.0.0.101"),
+                ("10.0.1.0", "10.0.1.3")])
+        try:
+            self.domain.set_node(node, network="10.0.0.0/24")
+            ok_(False)
+        except AssignedIPnotinSubnet:
+            pass
+        self.domain.set_node(node, network="10.0.0.0/21")
+        eq_(self.domain.host_counts(node)["used"], 95)
+        try:
+            ok_(self.domain.save_delta(db, full=True))
+            eq_(len(db.hget(HOSTS_KEY % "TestHosts", "Australia>Brisbane")), 256)
+            self.domain.set_node(parent, name="Oceania")
+            ok_(self.domain.save_delta(db))
+            eq_(db.hkeys(HOSTS_KEY % "TestHosts"), ["Oceania>Brisbane"])
+            dom = Domain(domain="TestHosts", redisdb=db, groups=self.schema.get_groups("Sedgman"))
+            brisbane = dom.find_path("Oceania>Brisbane")
+            eq_(dom.host_ranges(brisbane), self.domain.host_ranges(node))
+            eq_(dom.allocate_hosts(brisbane, 5), "10.0.0.51")
+            ok_(dom.save_delta(db))
+            # a concurrent writer of the same subnet has to reload
+            eq_(self.domain.allocate_hosts(node), "10.0.0.51")
+            ok_(not self.domain.save_delta(db))
+            dom = Domain(domain="TestHosts", redisdb=db, groups=self.schema.get_groups("Sedgman"),
+                    subtree="Oceania>Brisbane", depth=0)
+            eq_(dom.host_counts(dom.find_path("Oceania>Brisbane"))["used"], 100)
+            dom.remove_node(dom.find_path("Oceania>Brisbane"), force=True)
+            ok_(dom.save_delta(db))
+            eq_(db.hkeys(HOSTS_KEY % "TestHosts"), [])
+        finally:
+            db.delete(*keys)
+
+        self.domain = Domain(domain="TestHosts", groups=self.schema.get_groups("Sedgman"), schema_name="Sedgman")
+        parent = self.domain.add_node(node_type="Region", name="Australia", network="10.0.0.0/12", parent=self.domain.root)
+        node = self.domain.add_node(node_type="City", name="Brisbane", network="10.0.0.0/30", parent=parent)
+        try:
+            self.domain.allocate_hosts(node, 2)
+            ok_(self.domain.save_to_db(db))
+            dom = Domain(raw_xml=db.get(DOMAIN_KEY % "TestHosts"), groups=self.schema.get_groups("Sedgman"))
+            dom.load_hosts(db)
+            eq_(dom.allocate_hosts(dom.find_path("Australia>Brisbane")), None)
+            # bitmaps left by a node of another size are dropped
+            db.hset(HOSTS_KEY % "TestHosts", "Australia>Brisbane", "\0" * 32)
+            dom.load_hosts(db)
+            eq_(dom.host_counts(dom.find_path("Australia>Brisbane"))["used"], 2)
+            dom = Domain(raw_xml=db.get(DOMAIN_KEY % "TestHosts"), groups=self.schema.get_groups("Sedgman"))
+            dom.load_hosts(db)
+            eq_(dom.host_counts(dom.find_path("Australia>Brisbane"))["used"], 0)
+        finally:
+            db.delete(DOMAIN_KEY % "TestHosts", *keys)
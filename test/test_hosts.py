@@ -0,0 +1,81 @@
+import os
+import sys
+
+from nose.tools import ok_, eq_, raises
+
+try:
+    from ipam.hosts import *
+    from ipam.iputil import network_prefix, address_prefix
+except ImportError:
+    sys.path.append(os.path.abspath(".."))
+    from ipam.hosts import *
+    from ipam.iputil import network_prefix, address_prefix
+
+def ip(address):
+    return address_prefix(address)[0]
+
+class TestHostBitmap:
+    def setUp(self):
+        self.hosts = HostBitmap(*network_prefix("10.0.0.0/22"))
+
+    def test_counts(self):
+        eq_(self.hosts.counts(), {"size": 1024, "reserved": 2, "used": 0, "free": 1022})
+        eq_(HostBitmap(*network_prefix("10.0.0.0/31")).counts()["reserved"], 0)
+        eq_(HostBitmap(*network_prefix("2001:db8::/120")).counts()["reserved"], 1)
+
+    def test_allocate(self):
+        eq_(self.hosts.allocate(), ip("10.0.0.1"))
+        eq_(self.hosts.allocate(10), ip("10.0.0.2"))
+        self.hosts.assign(ip("10.0.0.20"), 4)
+        # the gap before 10.0.0.20 is too short
+        eq_(self.hosts.allocate(16), ip("10.0.0.24"))
+        eq_(self.hosts.allocate(8), ip("10.0.0.12"))
+        eq_(self.hosts.counts()["used"], 39)
+        eq_(list(self.hosts.ranges()), [(ip("10.0.0.1"), ip("10.0.0.39"))])
+        eq_(self.hosts.allocate(1022), None)
+
+    def test_full(self):
+        eq_(self.hosts.allocate(1022), ip("10.0.0.1"))
+        eq_(self.hosts.allocate(), None)
+        eq_(self.hosts.release(ip("10.0.2.0"), 3), 3)
+        eq_(self.hosts.allocate(3), ip("10.0.2.0"))
+        ok_(self.hosts.is_assigned(ip("10.0.3.254")))
+        ok_(not self.hosts.is_assigned(ip("10.0.3.255")))
+
+    def test_release(self):
+        self.hosts.allocate(100)
+        eq_(self.hosts.release(ip("10.0.0.50"), 200), 51)
+        eq_(self.hosts.release(ip("10.0.0.50")), 0)
+        eq_(self.hosts.counts()["used"], 49)
+        eq_(self.hosts.allocate(), ip("10.0.0.50"))
+
+    @raises(AddressInUseError)
+    def test_assign_in_use(self):
+        self.hosts.allocate(5)
+        self.hosts.assign(ip("10.0.0.4"), 3)
+
+    @raises(ValueError)
+    def test_assign_reserved(self):
+        self.hosts.assign(ip("10.0.3.255"))
+
+    def test_bytes(self):
+        self.hosts.allocate(70)
+        self.hosts.release(ip("10.0.0.9"))
+        copy = HostBitmap(*network_prefix("10.0.0.0/22"), data=self.hosts.to_bytes())
+        eq_(len(self.hosts.to_bytes()), 128)
+        eq_(copy.counts(), self.hosts.counts())
+        eq_(list(copy.ranges()), list(self.hosts.ranges()))
+        eq_(copy.allocate(), ip("10.0.0.9"))
+
+    def test_rebase(self):
+        self.hosts.allocate(10)
+        eq_(list(self.hosts.rebase(*network_prefix("10.0.0.0/24")).ranges()), list(self.hosts.ranges()))
+        try:
+            self.hosts.rebase(*network_prefix("10.0.0.8/29"))
+            ok_(False)
+        except ValueError:
+            pass
+
+    @raises(ValueError)
+    def test_too_large(self):
+        HostBitmap(*network_prefix("2001:db8::/64"))
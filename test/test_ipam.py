@@ -1,6 +1,7 @@
 #need to run the ipam api and programmatically call rest functions for testing
 from nose.tools import ok_, eq_, raises, with_setup
 import json
+import os
 
 try:
     import ipamapi
@@ -74,7 +75,247 @@ class TestIpam:
         print ret.data
         ok_(ret.status_code == 200)
 
+    def test_06a_get_node_cached(self):
+        url = "/ipam/api/v1.0/domain/Test8237492834/node?node_type=Galaxy&name=Andromeda"
+        hits = json.loads(self.test_app.get("/ipam/api/v1.0/cache").data)["hits"]
+        ret = self.test_app.get(url)
+        ok_(ret.status_code == 200)
+        ok_("Andromeda" in ret.data)
+        ret = self.test_app.get(url)
+        ok_("Andromeda" in ret.data)
+        ok_(json.loads(self.test_app.get("/ipam/api/v1.0/cache").data)["hits"] >= hits + 1)
+
     def test_07_delete_domain(self):
         ret = self.test_app.delete("/ipam/api/v1.0/domain/Test8237492834")
         print ret.data
         ok_(ret.status_code == 200)
+
+    def test_08_redis_timing(self):
+        with ipamapi.app.test_request_context("/ipam/api/v1.0/schema/Test"):
+            db = ipamapi.init_db()
+            ok_(db.connection_pool is ipamapi.get_pool())
+            # requests wait for a connection instead of failing when all are in use
+            ok_(isinstance(db.connection_pool, ipamapi.redis.BlockingConnectionPool))
+            ret = ipamapi.prefetch_domain("Test8237492834")
+            eq_(len(ret), 2)
+            summary = db.timing_summary()
+            eq_(summary["calls"], 1)
+            ok_("PIPELINE(GET,GET)" in summary["commands"])
+
+    def test_09_snapshot_reads(self):
+        ipamapi.app.config["SNAPSHOT_DIR"] = "/tmp"
+        try:
+            domain = """<domain name="TestSnap9182" network="0.0.0.0/0" schema="Test">
+            <Galaxy name="Milky Way" network="10.0.0.0/12"><Solar_System name="Sun" network="10.0.0.0/19"/></Galaxy>
+            </domain>"""
+            self.test_app.post("/ipam/api/v1.0/schema/Test", headers={"Content-Type" : "application/json"},
+                    data=json.dumps({'Test': ['Galaxy', 'Solar_System', 'Planet']}))
+            ret = self.test_app.post("/ipam/api/v1.0/domain/TestSnap9182", headers={"Content-Type" : "application/xml"},
+                    data=domain)
+            ok_(ret.status_code == 200)
+            ret = self.test_app.get("/ipam/api/v1.0/domain/TestSnap9182/node?node_type=Solar_System")
+            ok_('name="Sun"' in ret.data)
+            ok_("TestSnap9182" in ipamapi.snapshots)
+            snap = ipamapi.snapshots["TestSnap9182"]
+            ret = self.test_app.post("/ipam/api/v1.0/domain/TestSnap9182/path/Milky Way",
+                    headers={"Content-Type" : "application/json"},
+                    data=json.dumps({"name": "Sirius", "network": "10.0.32.0/19"}))
+            eq_(ret.status_code, 200)
+            # stale snapshot is neither reopened nor used
+            ret = self.test_app.get("/ipam/api/v1.0/domain/TestSnap9182/node?node_type=Solar_System")
+            ok_('name="Sirius"' in ret.data)
+            ok_(ipamapi.snapshots["TestSnap9182"] is snap)
+            eq_(ipamapi.get_snapshot("TestSnap9182", "2"), None)
+            ok_(ipamapi.snapshots["TestSnap9182"] is snap)
+            self.test_app.delete("/ipam/api/v1.0/domain/TestSnap9182")
+            ok_(not os.path.exists("/tmp/TestSnap9182.snap"))
+        finally:
+            ipamapi.app.config["SNAPSHOT_DIR"] = None
+
+    def test_10_path_operations(self):
+        base = "/ipam/api/v1.0/domain/TestPath7261"
+        domain = """<domain name="TestPath7261" network="0.0.0.0/0" schema="Test">
+        <Galaxy name="Milky Way" network="10.0.0.0/12"><Solar_System name="Sun" network="10.0.0.0/19"/></Galaxy>
+        <Galaxy name="Andromeda" network="10.64.0.0/12"/>
+        </domain>"""
+        json_headers = {"Content-Type" : "application/json"}
+        for storage in ("delta", "blob"):
+            ipamapi.app.config["DOMAIN_STORAGE"] = storage
+            try:
+                self.test_app.post("/ipam/api/v1.0/schema/Test", headers=json_headers,
+                        data=json.dumps({'Test': ['Galaxy', 'Solar_System', 'Planet']}))
+                self.test_app.post(base, headers={"Content-Type" : "application/xml"}, data=domain)
+                ret = self.test_app.get(base + "/path/Milky Way%3ESun")
+                eq_(ret.status_code, 200)
+                ok_(ret.data.startswith('<Solar_System name="Sun"'))
+                cached = ipamapi.domain_cache._domains.get("TestPath7261", (None, None))[1]
+                ret = self.test_app.post(base + "/path/Milky Way%3ESun", headers=json_headers,
+                        data=json.dumps({"name": "Earth", "network": "10.0.1.0/24"}))
+                eq_(ret.status_code, 200)
+                ok_(ret.data.startswith('<Planet name="Earth"'))
+                if storage == "blob":
+                    # changes are made to a copy, cached once saved
+                    eq_(cached.find_path("Milky Way>Sun>Earth"), None)
+                    cached = ipamapi.domain_cache._domains["TestPath7261"][1]
+                    ok_(cached.find_path("Milky Way>Sun>Earth") is not None)
+                ret = self.test_app.post(base + "/path/Milky Way%3ESun", headers=json_headers,
+                        data=json.dumps({"name": "Mars", "network": "10.0.1.0/25"}))
+                eq_(ret.status_code, 400)
+                if storage == "blob":
+                    ok_(ipamapi.domain_cache._domains["TestPath7261"][1] is cached)
+                ret = self.test_app.put(base + "/path/Milky Way%3ESun", headers=json_headers,
+                        data=json.dumps({"name": "Sol"}))
+                eq_(ret.status_code, 200)
+                ok_('name="Earth"' in self.test_app.get(base + "/path/Milky Way%3ESol%3EEarth").data)
+                ret = self.test_app.put(base + "/path/Milky Way", headers=json_headers,
+                        data=json.dumps({"network": "10.64.0.0/11"}))
+                eq_(ret.status_code, 400)
+                ret = self.test_app.post(base + "/path/", headers=json_headers,
+                        data=json.dumps({"name": "Triangulum", "network": "10.128.0.0/12"}))
+                ok_(ret.data.startswith('<Galaxy name="Triangulum"'))
+                ret = self.test_app.post(base + "/node", data=json.dumps({"parent": "Andromeda", "name": "Alpheratz",
+                        "network": "10.64.0.0/16"}))
+                ok_(ret.data.startswith('<Solar_System name="Alpheratz"'))
+                ret = self.test_app.delete(base + "/node", data=json.dumps({"path": "Andromeda>Alpheratz"}))
+                ok_(ret.data.startswith('<Solar_System name="Alpheratz"'))
+                ret = self.test_app.delete(base + "/path/Milky Way")
+                ok_('name="Earth"' in ret.data)
+                dom = self.test_app.get(base).data
+                ok_("Milky Way" not in dom and "Triangulum" in dom and "Alpheratz" not in dom)
+            finally:
+                self.test_app.delete(base)
+                ipamapi.app.config["DOMAIN_STORAGE"] = "blob"
+
+    def test_11_batch(self):
+        base = "/ipam/api/v1.0/domain/TestBatch5521"
+        domain = """<domain name="TestBatch5521" network="0.0.0.0/0" schema="Test" version="1">
+        <Galaxy name="Milky Way" network="10.0.0.0/12"><Solar_System name="Sun" network="10.0.0.0/19"/></Galaxy>
+        </domain>"""
+        json_headers = {"Content-Type" : "application/json"}
+        for storage in ("delta", "blob"):
+            ipamapi.app.config["DOMAIN_STORAGE"] = storage
+            try:
+                self.test_app.post("/ipam/api/v1.0/schema/Test", headers=json_headers,
+                        data=json.dumps({'Test': ['Galaxy', 'Solar_System', 'Planet']}))
+                self.test_app.post(base, headers={"Content-Type" : "application/xml"}, data=domain)
+                ops = [{"op": "add", "parent": "Milky Way>Sun", "name": "Planet%d" % i, "network": "10.0.%d.%d/28" % (i // 16, i % 16 * 16)}
+                        for i in xrange(200)]
+                ops.append({"op": "set", "path": "Milky Way>Sun", "name": "Sol"})
+                ops.append({"op": "remove", "path": "Milky Way>Sol>Planet7"})
+                ret = self.test_app.post(base + "/batch", headers=json_headers, data=json.dumps(ops))
+                eq_(ret.status_code, 200)
+                ret = json.loads(ret.data)
+                eq_([r["status"] for r in ret["results"]], ["ok"] * 202)
+                eq_(ret["results"][5]["path"], "Milky Way>Sun>Planet5")
+                # the node hash may hold changes to subtrees the batch did not check, read it again
+                eq_("TestBatch5521" in ipamapi.domain_cache, storage == "blob")
+                xml = self.test_app.get(base).data
+                ok_("Planet199" in xml and 'name="Sol"' in xml and "Planet7\"" not in xml)
+                # posting the domain as it was before the batch does not undo it
+                self.test_app.post(base, headers={"Content-Type" : "application/xml"}, data=domain)
+                ok_("Planet199" in self.test_app.get(base).data)
+                ops = [{"op": "add", "parent": "Milky Way", "name": "Vega", "network": "10.1.0.0/19"},
+                        {"op": "add", "parent": "Milky Way", "name": "Altair", "network": "10.1.0.0/20"},
+                        {"op": "remove", "path": "Milky Way>Sol"}]
+                ret = self.test_app.post(base + "/batch", headers=json_headers, data=json.dumps(ops))
+                eq_(ret.status_code, 400)
+                eq_([r["status"] for r in json.loads(ret.data)["results"]], ["ok", "error", "skipped"])
+                # operations applied before the failing one never reach the cached domain
+                ok_(ipamapi.domain_cache._domains["TestBatch5521"][1].find_path("Milky Way>Vega") is None)
+                xml = self.test_app.get(base).data
+                ok_("Vega" not in xml and 'name="Sol"' in xml)
+                ret = self.test_app.post(base + "/batch", headers=json_headers, data=json.dumps([{"op": "remove", "path": "Nope"}]))
+                eq_(json.loads(ret.data)["results"][0]["error"], "KeyError")
+            finally:
+                self.test_app.delete(base)
+                ipamapi.app.config["DOMAIN_STORAGE"] = "blob"
+
+    def test_12_lookup_available(self):
+        base = "/ipam/api/v1.0/domain/TestLookup3310"
+        domain = """<domain name="TestLookup3310" network="0.0.0.0/0" schema="Test">
+        <Galaxy name="Milky Way" network="10.0.0.0/12"><Solar_System name="Sun" network="10.0.0.0/19"/></Galaxy>
+        </domain>"""
+        calls = []
+        class Pool:
+            def apply(self, func, args, kwargs):
+                calls.append(func)
+                return func(*args, **kwargs)
+        ipamapi.cpu_pool = Pool()
+        try:
+            self.test_app.post("/ipam/api/v1.0/schema/Test", headers={"Content-Type" : "application/json"},
+                    data=json.dumps({'Test': ['Galaxy', 'Solar_System', 'Planet']}))
+            self.test_app.post(base, headers={"Content-Type" : "application/xml"}, data=domain)
+            ret = json.loads(self.test_app.get(base + "/network?network=10.0.1.1").data)
+            eq_(ret["path"], "Milky Way>Sun")
+            eq_(ret["node_type"], "Solar_System")
+            ret = json.loads(self.test_app.get(base + "/network?network=10.1.0.0/16").data)
+            eq_(ret["path"], "Milky Way")
+            eq_(self.test_app.get(base + "/network?network=bad").status_code, 400)
+            ret = json.loads(self.test_app.get(base + "/available?path=Milky Way&prefixlen=19&number=2").data)
+            eq_(ret["networks"], ["10.0.32.0/19", "10.0.64.0/19"])
+            ret = json.loads(self.test_app.get(base + "/utilization?path=Milky Way").data)
+            eq_(sorted(ret), ["Milky Way", "Milky Way>Sun"])
+            eq_(ret["Milky Way"]["used"], 1 << 13)
+            eq_(ret["Milky Way"]["nodes"], 2)
+            eq_(ret["Milky Way>Sun"]["percent"], 0.0)
+            # only domains no other request holds yet are handed to the pool
+            eq_(set(calls), set([ipamapi.ipamdomain.Domain]))
+        finally:
+            ipamapi.cpu_pool = None
+            self.test_app.delete(base)
+
+    def test_13_hosts(self):
+        base = "/ipam/api/v1.0/domain/TestHosts4412"
+        domain = """<domain name="TestHosts4412" network="0.0.0.0/0" schema="Test">
+        <Galaxy name="Milky Way" network="10.0.0.0/12"><Solar_System name="Sun" network="10.0.0.0/19">
+        <Planet name="Earth" network="10.0.1.0/24"/></Solar_System></Galaxy>
+        </domain>"""
+        json_headers = {"Content-Type" : "application/json"}
+        for storage in ("delta", "blob"):
+            ipamapi.app.config["DOMAIN_STORAGE"] = storage
+            try:
+                self.test_app.post("/ipam/api/v1.0/schema/Test", headers=json_headers,
+                        data=json.dumps({'Test': ['Galaxy', 'Solar_System', 'Planet']}))
+                self.test_app.post(base, headers={"Content-Type" : "application/xml"}, data=domain)
+                path = "Milky Way>Sun>Earth"
+                ret = json.loads(self.test_app.post(base + "/hosts", headers=json_headers,
+                        data=json.dumps({"path": path})).data)
+                eq_(ret["first"], "10.0.1.1")
+                ret = json.loads(self.test_app.post(base + "/hosts", headers=json_headers,
+                        data=json.dumps({"path": path, "count": 20})).data)
+                eq_(ret["first"], "10.0.1.2")
+                ret = self.test_app.post(base + "/hosts", headers=json_headers,
+                        data=json.dumps({"path": path, "address": "10.0.1.5"}))
+                eq_(ret.status_code, 400)
+                ret = self.test_app.post(base + "/hosts", headers=json_headers,
+                        data=json.dumps({"path": "Milky Way>Sun", "count": 1}))
+                eq_(ret.status_code, 400)
+                ret = json.loads(self.test_app.delete(base + "/hosts", headers=json_headers,
+                        data=json.dumps({"path": path, "address": "10.0.1.10", "count": 5})).data)
+                eq_(ret["released"], 5)
+                ret = json.loads(self.test_app.get(base + "/hosts?path=Milky Way>Sun>Earth").data)
+                eq_((ret["size"], ret["used"], ret["free"]), (256, 16, 238))
+                eq_(ret["ranges"], [["10.0.1.1", "10.0.1.9"], ["10.0.1.15", "10.0.1.21"]])
+                # a domain posted again with a smaller Earth replaces the saved host records
+                with ipamapi.app.test_request_context():
+                    version = ipamapi.init_db().get("ipam:domain:TestHosts4412:version")
+                ret = self.test_app.post(base, headers={"Content-Type" : "application/xml"},
+                        data=domain.replace("10.0.1.0/24", "10.0.1.0/25").replace("<domain ",
+                        '<domain version="%s" ' % version))
+                eq_(ret.status_code, 200)
+                ipamapi.domain_cache.invalidate("TestHosts4412")
+                ret = self.test_app.get(base + "/hosts?path=Milky Way>Sun>Earth")
+                eq_(ret.status_code, 200)
+                eq_(json.loads(ret.data)["used"], 0)
+                eq_(self.test_app.get(base + "/node?name=Earth").status_code, 200)
+            finally:
+                self.test_app.delete(base)
+                ipamapi.app.config["DOMAIN_STORAGE"] = "blob"
+
+    def test_14_not_found(self):
+        ret = self.test_app.get("/ipam/api/v1.0/nothing/here")
+        eq_(ret.status_code, 404)
+        eq_(json.loads(ret.data), {"error": "Not found"})
+        ret = self.test_app.get("/ipam/api/v1.0/domain/NoSuchDomain4412")
+        eq_(ret.status_code, 404)
+        eq_(json.loads(ret.data), {"error": "Not found"})
@@ -54,3 +54,48 @@ class TestSchema:
     def tearDown(self): 
         os.remove(self.file)
         pass
+
+class TestRedisSchema:
+    def setUp(self):
+        import redis
+        self.db = redis.StrictRedis(host="localhost", port=6379, db=0)
+        self.name = "ipam:test:schema"
+        self.db.delete(self.name, self.name + ":version")
+        self.db.set(self.name, json.dumps({"domain1": ["group1", "group2"]}))
+
+    def tearDown(self):
+        self.db.delete(self.name, self.name + ":version")
+
+    def test_migrate_blob(self):
+        schema = Schema(redisdb=self.db, schema_name=self.name)
+        eq_(self.db.type(self.name), "hash")
+        eq_(schema.get_groups("domain1"), ["group1", "group2"])
+        eq_(schema.get_domains(), ["domain1"])
+        eq_(self.db.get(self.name + ":version"), "1")
+
+    def test_writers_do_not_clobber(self):
+        writer1 = Schema(redisdb=self.db, schema_name=self.name)
+        writer2 = Schema(redisdb=self.db, schema_name=self.name)
+        writer1.new_domain("domain2")
+        writer2.new_domain("domain3")
+        writer1.update_domain("domain2", ["a"])
+        writer2.update_domain("domain3", ["b"])
+        schema = Schema(redisdb=self.db, schema_name=self.name)
+        eq_(sorted(schema.get_domains()), ["domain1", "domain2", "domain3"])
+        eq_(schema.get_groups("domain2"), ["a"])
+        eq_(schema.get_groups("domain3"), ["b"])
+        eq_(writer1.delete_domain("domain3"), ["b"])
+        eq_(writer1.delete_domain("domain3"), None)
+
+    @raises(DomainAlreadyExistsError)
+    def test_new_domain_exists(self):
+        Schema(redisdb=self.db, schema_name=self.name).new_domain("domain1")
+
+    def test_cached_groups(self):
+        schema = Schema(redisdb=self.db, schema_name=self.name)
+        schema.get_groups("domain1")
+        self.db.hset(self.name, "domain1", json.dumps(["changed"]))
+        # unchanged version counter, groups come from the process cache
+        eq_(Schema(redisdb=self.db, schema_name=self.name).get_groups("domain1"), ["group1", "group2"])
+        self.db.incr(self.name + ":version")
+        eq_(Schema(redisdb=self.db, schema_name=self.name).get_groups("domain1"), ["changed"])
@@ -0,0 +1,130 @@
+import os
+import sys
+
+from nose.tools import ok_, eq_, raises
+
+try:
+    from ipam.domain import Domain
+    from ipam.snapshot import *
+except ImportError:
+    sys.path.append(os.path.abspath(".."))
+    from ipam.domain import Domain
+    from ipam.snapshot import *
+
+class TestSnapshot:
+    def setUp(self):
+        self.file = "/tmp/test_snapshot.snap"
+        self.domain = Domain(domain="Sedgman", groups=["Region", "City"], schema_name="Sedgman")
+        parent = self.domain.add_node(node_type="Region", name="Australia", network="10.0.0.0/12", parent=self.domain.root)
+        self.domain.add_node(node_type="City", name="Brisbane", network="10.0.0.0/19", parent=parent)
+        self.domain.add_node(node_type="City", name=u"S\xe3o Paulo", network="10.1.0.0/19", parent=parent)
+        self.domain.add_node(node_type="Region", name="Asia", network="10.16.0.0/12", parent=self.domain.root)
+        self.domain.save_snapshot(self.file)
+        self.snap = Snapshot(self.file)
+
+    def tearDown(self):
+        self.snap.close()
+        os.remove(self.file)
+
+    def test_round_trip(self):
+        eq_(len(self.snap), 5)
+        eq_(self.snap.xml(), self.domain.xml())
+        dom = Domain.load_snapshot(self.file)
+        eq_(dom.xml(), self.domain.xml())
+        eq_(dom.groups, self.domain.groups)
+        eq_(str(dom.version), str(self.domain.version))
+
+    def test_read(self):
+        eq_(self.snap.children(0), [1, 4])
+        node = self.snap.find_path(u"Australia>S\xe3o Paulo")
+        eq_(self.snap.get_network(node), "10.1.0.0/19")
+        eq_(self.snap.node_type(node), "City")
+        eq_(self.snap.get_parent(node), 1)
+        eq_(self.snap.get_node(node_type="City"), [2, 3])
+        eq_(self.snap.get_node(network="10.16.0.0/12"), [4])
+        eq_(self.snap.get_path(self.snap.lookup("10.0.1.1")), "Australia>Brisbane")
+        eq_(self.snap.lookup("10.2.0.1"), 1)
+        eq_(self.snap.lookup("192.168.0.1"), 0)
+        eq_(self.snap.lookup("bad"), None)
+
+    def test_ipv6(self):
+        europe = self.domain.add_node(node_type="Region", name="Europe", network="2001:db8::/32", parent=self.domain.root)
+        self.domain.add_node(node_type="City", name="Paris", network="2001:db8:0:1::/64", parent=europe)
+        self.domain.save_snapshot(self.file)
+        snap = Snapshot(self.file)
+        try:
+            eq_(snap.xml(), self.domain.xml())
+            eq_(snap.get_path(snap.lookup("2001:db8:0:1::1")), "Europe>Paris")
+            eq_(snap.get_path(snap.lookup("10.0.1.1")), "Australia>Brisbane")
+            eq_(snap.get_node(network="2001:db8::/32"), [5])
+        finally:
+            snap.close()
+
+    def test_get_node_invalid_network(self):
+        eq_(self.snap.get_node(network="bad"), [])
+        eq_(self.snap.get_node(node_type="City", network="10.300.0.0/19"), [])
+
+    def test_tables(self):
+        parent = self.domain.find_path("Asia")
+        for i in xrange(50):
+            self.domain.add_node(node_type="City", name="C%d" % (49 - i), network="10.16.%d.0/24" % i, parent=parent)
+        self.domain.save_snapshot(self.file)
+        snap = Snapshot(self.file)
+        try:
+            for i in xrange(50):
+                node = snap.find_path("Asia>C%d" % i)
+                eq_(snap.get_network(node), "10.16.%d.0/24" % (49 - i))
+                eq_(snap.lookup("10.16.%d.1" % (49 - i)), node)
+                eq_(snap.get_node(name="C%d" % i), [node])
+                eq_(snap.get_node(network="10.16.%d.0/24" % (49 - i)), [node])
+            eq_(snap.find_path("Asia>C50"), None)
+            eq_(snap.find_path("Australia>C1"), None)
+            eq_(snap.lookup("10.16.50.1"), 4)
+            eq_(snap.get_node(node_type="City"), [2, 3] + range(5, 55))
+            eq_(snap.get_node(node_type="City", name="Brisbane"), [2])
+            eq_(snap.get_node(node_type="Region", name="Brisbane"), [])
+        finally:
+            snap.close()
+
+    def test_overlapping_children(self):
+        # children found by a scan when they overlap, as written by a domain with violations
+        parent = self.domain.find_path("Asia")
+        self.domain.add_node(node_type="City", name="Beijing", network="10.16.0.0/16", parent=parent)
+        self.domain.add_node(node_type="City", name="Tokyo", network="10.17.0.0/24", parent=parent)
+        self.domain.find_path("Asia>Tokyo").set("network", "10.16.1.0/24")
+        self.domain.save_snapshot(self.file)
+        snap = Snapshot(self.file)
+        try:
+            eq_(snap.get_path(snap.lookup("10.16.2.1")), "Asia>Beijing")
+        finally:
+            snap.close()
+
+    def test_invalid_and_raw_networks(self):
+        # invalid networks are kept out of lookups, both kept as written
+        parent = self.domain.find_path("Asia")
+        self.domain.add_node(node_type="City", name="Beijing", network="10.16.0.0/16", parent=parent)
+        self.domain.add_node(node_type="City", name="Tokyo", network="10.17.0.0/24", parent=parent)
+        self.domain.find_path("Asia>Beijing").set("network", "bogus")
+        self.domain.find_path("Asia>Tokyo").set("network", "10.17.0.1/24")
+        self.domain.save_snapshot(self.file)
+        snap = Snapshot(self.file)
+        try:
+            eq_(snap.xml(), self.domain.xml())
+            eq_(snap.get_network(snap.find_path("Asia>Beijing")), "bogus")
+            eq_(snap.get_network(snap.find_path("Asia>Tokyo")), "10.17.0.1/24")
+            eq_(snap.get_path(snap.lookup("10.16.2.1")), "Asia")
+            eq_(snap.get_path(snap.lookup("10.17.0.5")), "Asia>Tokyo")
+            eq_(snap.get_path(snap.lookup("192.168.0.1")), "")
+            eq_(snap.get_node(network="0.0.0.0/0"), [0])
+            eq_(snap.get_node(network="10.17.0.0/24"), [snap.find_path("Asia>Tokyo")])
+        finally:
+            snap.close()
+        dom = Domain.load_snapshot(self.file)
+        eq_(dom.xml(), self.domain.xml())
+        eq_([(v.kind, v.detail) for v in dom.violations()], [(v.kind, v.detail) for v in self.domain.violations()])
+
+    @raises(SnapshotError)
+    def test_not_a_snapshot(self):
+        with open(self.file, "wb") as f:
+            f.write("<domain/>" * 10)
+        Snapshot(self.file)
@@ -0,0 +1,156 @@
+import os
+import json
+import sys
+
+from nose.tools import ok_, eq_, raises
+
+from lxml import etree
+
+try:
+    from ipam.store import *
+except ImportError:
+    sys.path.append(os.path.abspath(".."))
+    from ipam.store import *
+
+class TestNodeStore:
+    def setUp(self):
+        self.domain = Domain(domain="Sedgman", groups=["Region", "City"], schema_name="Sedgman")
+        parent = self.domain.add_node(node_type="Region", name="Australia", network="10.0.0.0/12", parent=self.domain.root)
+        self.domain.add_node(node_type="City", name="Brisbane", network="10.0.0.0/19", parent=parent)
+        self.domain.add_node(node_type="City", name="Perth", network="10.1.0.0/19", parent=parent)
+        self.store = self.domain.to_store()
+
+    def test_xml_round_trip(self):
+        eq_(self.store.xml(), self.domain.xml())
+        eq_(etree.tostring(self.store.to_domain().root), self.domain.xml())
+
+    def test_load_stream(self):
+        test_file = "/tmp/tmpstore.xml"
+        try:
+            self.domain.save(xml_file=test_file)
+            store = NodeStore(xml_file=test_file, groups=["Region", "City"])
+            eq_(store.xml(), self.store.xml().replace('version="1"', 'version="2"'))
+            eq_(store.get_path(store.lookup("10.1.2.3")), "Australia>Perth")
+        finally:
+            os.remove(test_file)
+
+    def test_get_node(self):
+        node = self.store.get_node(node_type="City", name="Perth")
+        eq_(len(node), 1)
+        eq_(self.store.get_network(node[0]), "10.1.0.0/19")
+        eq_(self.store.get_path(node[0]), "Australia>Perth")
+        eq_(self.store.find_path("Australia>Perth"), node[0])
+        eq_(self.store.get_node(network="10.0.0.0/12"), self.store.get_node(node_type="Region"))
+
+    def test_lookup(self):
+        eq_(self.store.get_name(self.store.lookup("10.1.2.3")), "Perth")
+        eq_(self.store.get_name(self.store.lookup("10.2.2.3")), "Australia")
+        eq_(self.store.lookup("bad"), None)
+
+    def test_add_set_remove(self):
+        parent = self.store.find_path("Australia")
+        n = self.store.add_node(node_type="City", parent=parent, name="Darwin", network="10.2.0.0/19")
+        eq_(self.store.get_name(self.store.lookup("10.2.0.1")), "Darwin")
+        self.store.set_node(n, name="Hobart", network="10.3.0.0/19")
+        eq_(self.store.get_path(self.store.lookup("10.3.0.1")), "Australia>Hobart")
+        self.store.remove_node(parent, force=True)
+        eq_(len(self.store), 1)
+        eq_(self.store.get_node(node_type="City"), [])
+
+    @raises(DuplicateSiblingError)
+    def test_add_overlap(self):
+        parent = self.store.find_path("Australia")
+        self.store.add_node(node_type="City", parent=parent, name="Darwin", network="10.0.16.0/20")
+
+    @raises(DuplicateSiblingError)
+    def test_set_duplicate_name(self):
+        self.store.set_node(self.store.find_path("Australia>Perth"), name="BRISBANE")
+
+    @raises(AssignedIPnotinSubnet)
+    def test_set_network_outside_parent(self):
+        self.store.set_node(self.store.find_path("Australia>Perth"), network="10.16.0.0/19")
+
+    @raises(InvalidNodeNameError)
+    def test_add_path_separator(self):
+        self.store.add_node(node_type="City", parent=self.store.find_path("Australia"), name="Perth>CBD",
+                network="10.2.0.0/19")
+
+    @raises(InvalidNodeTypeError)
+    def test_add_invalid_type(self):
+        self.store.add_node(node_type="Region", parent=self.store.find_path("Australia"), name="Asia", network="10.2.0.0/19")
+
+    def test_violations(self):
+        self.domain.get_node(node_type="City", name="Perth")[0].set("network", "10.0.16.0/20")
+        store = self.domain.to_store()
+        eq_([(store.get_name(v.node), v.kind) for v in store.violations()], [("Perth", "overlap")])
+        ok_(self.store.validate())
+
+    def test_invalid_network(self):
+        xml = """<domain name="Sedgman" network="0.0.0.0/0"><Region name="A" network="not a network"/>""" + \
+                """<Region name="B" network="10.0.0.1/8"><City name="C" network="10.1.0.0/16"/></Region></domain>"""
+        store = NodeStore(raw_xml=xml, groups=["Region", "City"])
+        eq_(store.lookup("1.2.3.4"), 0)
+        eq_(store.get_name(store.lookup("10.2.3.4")), "B")
+        eq_(store.get_node(network="0.0.0.0/0"), [0])
+        eq_(store.get_node(network="10.0.0.0/8"), [store.find_path("B")])
+        eq_(store.get_available_networks(0)[:1], ["0.0.0.0/5"])
+        eq_([etree.tostring(e) for e in store.to_element()], [etree.tostring(e) for e in etree.fromstring(xml)])
+        eq_([(store.get_name(v.node), v.kind) for v in store.violations()], [("A", "network")])
+        store.set_node(store.find_path("A"), network="11.0.0.0/8")
+        eq_(store.get_name(store.lookup("11.1.1.1")), "A")
+        eq_(store.violations(), [])
+        test_file = "/tmp/tmpstore.xml"
+        try:
+            with open(test_file, "w") as f:
+                f.write(xml)
+            streamed = NodeStore(xml_file=test_file, groups=["Region", "City"])
+            eq_(streamed.xml(), NodeStore(raw_xml=xml, groups=["Region", "City"]).xml())
+            eq_([(streamed.get_name(v.node), v.kind) for v in streamed.violations()], [("A", "network")])
+        finally:
+            os.remove(test_file)
+
+    def test_get_node_invalid_network(self):
+        eq_(self.store.get_node(network="bad"), [])
+        eq_(self.store.get_node(node_type="City", network="10.300.0.0/19"), [])
+
+    def test_indexes(self):
+        parent = self.store.find_path("Australia")
+        darwin = self.store.add_node(node_type="City", parent=parent, name="Darwin", network="10.2.0.0/19")
+        eq_(self.store.find_path("Australia>Darwin"), darwin)
+        eq_(self.store.get_node(name="Darwin"), [darwin])
+        self.store.set_node(darwin, name="Hobart", network="10.3.0.0/19")
+        eq_(self.store.find_path("Australia>Darwin"), None)
+        eq_(self.store.find_path("Australia>Hobart"), darwin)
+        eq_(self.store.get_node(name="Darwin"), [])
+        eq_(self.store.get_node(network="10.3.0.0/19"), [darwin])
+        # the old network and name are free again
+        self.store.add_node(node_type="City", parent=parent, name="Darwin", network="10.2.0.0/19")
+        self.store.remove_node(darwin, force=True)
+        eq_(self.store.find_path("Australia>Hobart"), None)
+        eq_(self.store.get_node(network="10.3.0.0/19"), [])
+        eq_([self.store.get_name(n) for n in self.store.get_node(node_type="City")], ["Brisbane", "Perth", "Darwin"])
+
+    def test_get_available_networks(self):
+        parent = self.store.find_path("Australia")
+        eq_(self.store.get_available_networks(parent, prefixlen=19, number=2), ["10.0.32.0/19", "10.0.64.0/19"])
+        eq_(self.store.get_available_networks(parent),
+                [str(n) for n in self.domain.get_available_networks(self.domain.get_node(name="Australia")[0])])
+
+    def test_ipv6(self):
+        europe = self.store.add_node(node_type="Region", name="Europe", network="2001:db8::/32")
+        paris = self.store.add_node(node_type="City", parent=europe, name="Paris", network="2001:db8:0:1::/64")
+        eq_(self.store.get_network(paris), "2001:db8:0:1::/64")
+        eq_(self.store.lookup("2001:db8:0:1::1"), paris)
+        eq_(self.store.lookup("2001:db8:1::1"), europe)
+        eq_(self.store.lookup("2001:dead::1"), 0)
+        eq_(self.store.get_node(network="2001:db8::/32"), [europe])
+        eq_(self.store.get_available_networks(europe, prefixlen=64, number=2), ["2001:db8::/64", "2001:db8:0:2::/64"])
+        eq_(self.store.violations(), [])
+        try:
+            self.store.set_node(paris, network="10.0.0.0/24")
+            ok_(False)
+        except AssignedIPnotinSubnet:
+            pass
+        self.store.set_node(paris, network="2001:db8:0:100::/56")
+        eq_(self.store.get_range(paris)[1] - self.store.get_range(paris)[0], (1 << 72) - 1)
+        eq_(NodeStore(raw_xml=self.store.xml(), groups=["Region", "City"]).xml(), self.store.xml())